@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import json
+import numpy as np
+from pathlib import Path
+from pensTables import dataDir
+
+## Where named assumption sets live: <name>.json.
+assumptionDir = dataDir / "assumptionSets"
+
+## The lookup arrays run to these; older ages and longer service use
+## the last row or column.
+maxAge = 130
+maxService = 70
+
+
+def rateTable(spec, size, key):
+    """A rate table from the spec, as an array over 0..size-1 of the key
+    ("age" or "service").  rates[0] applies at spec[key]; the first rate
+    also covers anything below that and the last anything above."""
+    rates = np.asarray(spec["rates"], dtype=float)
+    index = np.clip(np.arange(size) - spec[key], 0, len(rates) - 1)
+    return rates[index]
+
+
+class pensAssumptions:
+    """A plan's member assumptions, read from a JSON assumption set and
+    compiled into lookup arrays: separation rates by [tier, service],
+    the chance of retiring by [tier, age, service], the merit raise by
+    age, and the benefit multiplier.  See assumptionSets/default.json
+    for the format.
+
+    A tier's separation table is indexed by service.  Its retirement
+    rules each hold a table by age or by service and apply from a
+    minimum age and service; a member eligible for several has an
+    independent chance under each, so they combine as 1 - prod(1 - p).
+    The raises are by age band: raises[i] applies below ages[i], the
+    last one from the last age up.
+
+    The ages and services checked are the ones a member has just
+    reached, as in pensMember.ageOneYear.  Like pensMort, sets are
+    shared: use pensAssumptions.get()."""
+
+    _registry = {}
+    # The same sets by the name or path they were asked for, so repeat
+    # lookups (one per member) don't touch the filesystem.
+    _names = {}
+
+    def __init__(self, spec, source=None):
+        # The file the set came from, if any; pickles refer to it.
+        self.source = source
+        self.spec = spec
+        self.description = spec.get("description", "")
+        self.benefitMultiplier = float(spec["benefitMultiplier"])
+
+        self.tiers = tuple(sorted(spec["tiers"]))
+        ages = np.arange(maxAge + 1)
+        services = np.arange(maxService + 1)
+        self.separation = np.zeros((len(self.tiers), maxService + 1))
+        self.retirement = np.zeros((len(self.tiers), maxAge + 1, maxService + 1))
+        ## Beyond serviceCap no rate changes with service.
+        self.serviceCap = 1
+        for t, tier in enumerate(self.tiers):
+            rules = spec["tiers"][tier]
+            sep = rules["separation"]
+            self.separation[t] = rateTable(sep, maxService + 1, "service")
+            self.serviceCap = max(self.serviceCap, sep["service"] + len(sep["rates"]) - 1)
+
+            stay = np.ones((maxAge + 1, maxService + 1))
+            for rule in rules.get("retirement", []):
+                if "age" in rule:
+                    p = rateTable(rule, maxAge + 1, "age")[:, None]
+                else:
+                    p = rateTable(rule, maxService + 1, "service")[None, :]
+                    self.serviceCap = max(self.serviceCap, rule["service"] + len(rule["rates"]) - 1)
+                eligible = (ages[:, None] >= rule.get("minAge", 0)) & (
+                    services[None, :] >= rule.get("minService", 0)
+                )
+                self.serviceCap = max(self.serviceCap, rule.get("minService", 0))
+                stay *= np.where(eligible, 1 - p, 1.0)
+            self.retirement[t] = 1 - stay
+
+        scale = spec["salaryScale"]
+        self.raises = np.asarray(scale["raises"], dtype=float)[
+            np.searchsorted(scale["ages"], ages, side="right")
+        ]
+
+        for array in (self.separation, self.retirement, self.raises):
+            array.setflags(write=False)
+
+    @classmethod
+    def get(cls, name=None):
+        """The assumption set with this name (in assumptionDir) or at this
+        path, compiled once per process.  None is the default set."""
+        if isinstance(name, pensAssumptions):
+            return name
+        if name is None:
+            name = "default"
+        found = cls._names.get(name)
+        if found is not None:
+            return found
+        path = Path(name)
+        if path.suffix != ".json":
+            path = assumptionDir / ("%s.json" % name)
+        key = str(path.resolve())
+        if key not in cls._registry:
+            with open(path) as f:
+                cls._registry[key] = cls(json.load(f), key)
+        cls._names[name] = cls._registry[key]
+        return cls._registry[key]
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        if self.source is not None:
+            return (pensAssumptions.get, (self.source,))
+        return (pensAssumptions, (self.spec,))
+
+    def tierIndex(self, tier):
+        try:
+            return self.tiers.index(str(tier))
+        except ValueError:
+            raise ValueError("No tier %s in these assumptions (tiers: %s)" % (tier, ", ".join(self.tiers)))
+
+    def separationRate(self, service, tier=0):
+        """Chance of separating, for a tier index and a service (or an
+        array of them)."""
+        return self.separation[tier, np.clip(service, 0, maxService)]
+
+    def retirementRate(self, age, service, tier=0):
+        """Chance of retiring, for a tier index and ages and services."""
+        return self.retirement[tier, np.clip(age, 0, maxAge), np.clip(service, 0, maxService)]
+
+    def salaryDelta(self, age, scale=1.0):
+        """The raise at an age (or array of ages), with the raise above 1
+        multiplied by scale."""
+        delta = self.raises[np.clip(age, 0, maxAge)]
+        if scale != 1.0:
+            delta = 1 + scale * (delta - 1)
+        return delta
+
+
+##### TESTING #####
+
+def testAssumptions():
+    a = pensAssumptions.get()
+    print(a.tiers, a.benefitMultiplier, a.serviceCap)
+    print("separation:", a.separationRate(np.arange(0, 25)))
+    print("retirement at 62, 65, 70:", a.retirementRate(np.array([62, 65, 70]), 25))
+    print("raises at 20, 30, 60:", a.salaryDelta(np.array([20, 30, 60])))
+    assert pensAssumptions.get("default") is a
+    assert pensAssumptions.get(str(assumptionDir / "default.json")) is a
+
+    ## The tables follow the spec: service 0 uses the first rate, the
+    ## two rules at 62 with 25 years combine as 1 - 0.4 * 0.78, and the
+    ## raises step down by age band.
+    tier = a.spec["tiers"]["1"]
+    assert a.separationRate(0) == a.separationRate(1) == tier["separation"]["rates"][0]
+    assert abs(a.retirementRate(62, 25) - (1 - (1 - 0.6) * (1 - 0.22))) < 1e-12
+    assert a.retirementRate(61, 25) == 0 and a.retirementRate(70, 25) == 1
+    assert list(a.salaryDelta(np.array([20, 30, 60]))) == [1.075, 1.0674, 1.035]
+    assert a.salaryDelta(30, 0.5) == 1 + 0.5 * 0.0674
+
+    ## Copies and pickles come back as the shared set.
+    import copy
+    import pickle
+    assert copy.deepcopy(a) is a and pickle.loads(pickle.dumps(a)) is a
+    try:
+        a.tierIndex("9")
+        raise AssertionError("An unknown tier was accepted")
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    testAssumptions()
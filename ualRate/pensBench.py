@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from pensCensus import drawCensus, sexNames
+from pensPop import pensPop, pensMember
+from pensPopArray import pensPopArray
+from pensCohort import pensCohort
+from pensPlan import pensPlan, runModel, getModelData
+
+vol = [0.04, 0.03, 0.02, 0.03, 0.04, 0.04]
+sizes = [100, 1000, 10000, 100000, 1000000]
+benchFile = "pensBench.json"
+baselineFile = "pensBench-baseline.json"
+
+
+def makeMembers(size, seed):
+    rng = np.random.default_rng(seed)
+    c = drawCensus(rng, size)
+    return [pensMember(age, sexNames[sex], service, salary, 2021, rng=rng)
+            for age, sex, service, salary in zip(c["age"].tolist(), c["sex"].tolist(), c["service"].tolist(),
+                                                 c["salary"].tolist())]
+
+
+def makePopulation(engine, size, seed):
+    rng = np.random.default_rng(seed)
+    if engine == "array":
+        return pensPopArray(rng=rng, sampleSize=size)
+    if engine == "cohort":
+        return pensCohort(sampleSize=size)
+    return pensPop([], rng=rng, sampleSize=size)
+
+
+## Every case is a (prepare, run) pair.  prepare() makes the state a
+## call works on and isn't timed; run(state) is timed and returns the
+## number of items it processed.  Cases that change their state get a
+## fresh one for every call, so each repeat times the same workload.
+
+def benchMemberInit(engine, size, seed):
+    def run(state):
+        return len(makeMembers(size, seed))
+    return (lambda: None), run
+
+
+def benchAgeOneYear(engine, size, seed):
+    def run(members):
+        for m in members:
+            m.ageOneYear()
+        return len(members)
+    return (lambda: makeMembers(size, seed)), run
+
+
+def benchLiability(engine, size, seed):
+    pop = makePopulation(engine, size, seed)
+
+    def run(state):
+        pop.calculateTotalLiability()
+        return len(pop)
+    return (lambda: None), run
+
+
+def benchAdvance(engine, size, seed):
+    def run(pop):
+        n = len(pop)
+        pop.advanceOneYear()
+        return n
+    return (lambda: makePopulation(engine, size, seed)), run
+
+
+def benchPlanInit(engine, size, seed):
+    def run(state):
+        p = pensPlan(2000, vol, engine=engine, seed=seed, sampleSize=size)
+        return len(p.population)
+    return (lambda: None), run
+
+
+def benchRunModel(engine, size, seed, years=10):
+    def run(state):
+        d = runModel(vol, years=years, engine=engine, seed=seed, sampleSize=size)
+        return sum(a + r for a, r in zip(d["Active Members"][1:], d["Retired Members"][1:]))
+    return (lambda: None), run
+
+
+def benchGetModelData(engine, size, seed, years=5, replications=4):
+    def run(state):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    mean = getModelData(vol, 1.0, size=replications, years=years, saveAll=False, engine=engine,
+                                        seed=seed, sampleSize=size)[0]
+            finally:
+                os.chdir(cwd)
+        return replications * sum(a + r for a, r in zip(mean["Active Members"][1:], mean["Retired Members"][1:]))
+    return (lambda: None), run
+
+
+## (name, setup, unit, largest size for each engine).  pensMember
+## objects are only built for the "members" engine.  The cohort engine's
+## cost doesn't depend on the size, so its throughput only shows how it
+## compares at that size.
+cases = [
+    ("pensMember.__init__", benchMemberInit, "members", {"members": 1000000}),
+    ("pensMember.ageOneYear", benchAgeOneYear, "member-years", {"members": 1000000}),
+    ("calculateTotalLiability", benchLiability, "members", {"members": 1000000, "array": 1000000,
+                                                           "cohort": 1000000}),
+    ("advanceOneYear", benchAdvance, "member-years", {"members": 1000000, "array": 1000000, "cohort": 1000000}),
+    ("pensPlan.__init__", benchPlanInit, "members", {"members": 100000, "array": 1000000}),
+    ("runModel", benchRunModel, "member-years", {"members": 10000, "array": 1000000, "cohort": 1000000}),
+    ("getModelData", benchGetModelData, "member-years", {"members": 10000, "array": 100000}),
+]
+
+
+def timeCase(case, minTime=0.2, repeat=5):
+    """Best time of up to repeat calls of a (prepare, run) case, each on
+    a freshly prepared state, stopping once minTime has been spent in the
+    calls.  Returns (seconds, items processed by the call)."""
+    prepare, run = case
+    best = np.inf
+    spent = 0.0
+    items = 0
+    for i in range(repeat):
+        state = prepare()
+        t = time.perf_counter()
+        items = run(state)
+        elapsed = time.perf_counter() - t
+        best = min(best, elapsed)
+        spent += elapsed
+        if spent >= minTime:
+            break
+    return best, items
+
+
+def peakMemory(setup, engine, size, seed):
+    """Peak traced memory, in MB, of setting up and running a case once."""
+    tracemalloc.start()
+    try:
+        prepare, run = setup(engine, size, seed)
+        run(prepare())
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def runBenchmarks(sizes=sizes, seed=0, memory=True, only=None):
+    results = []
+    for name, setup, unit, limits in cases:
+        if only and name not in only:
+            continue
+        for engine, largest in limits.items():
+            for size in sizes:
+                if size > largest:
+                    continue
+                seconds, items = timeCase(setup(engine, size, seed))
+                result = {"case": name, "engine": engine, "size": size, "seconds": seconds, "items": items,
+                          "unit": unit, "throughput": items / seconds if seconds else None}
+                if memory:
+                    result["peakMB"] = peakMemory(setup, engine, size, seed)
+                results.append(result)
+                print("%-24s %-8s %8d  %9.4fs  %12.0f %s/s%s" % (
+                    name, engine, size, seconds, result["throughput"], unit,
+                    "  %8.1f MB" % result["peakMB"] if memory else ""))
+    return {
+        "meta": {"date": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+                 "numpy": np.__version__, "machine": platform.machine(), "seed": seed},
+        "results": results,
+    }
+
+
+def compareBaseline(current, baseline, tolerance=0.25):
+    """Prints the cases whose throughput fell more than tolerance below
+    the baseline's, and returns them."""
+    before = {(r["case"], r["engine"], r["size"]): r for r in baseline["results"]}
+    slower = []
+    for r in current["results"]:
+        b = before.get((r["case"], r["engine"], r["size"]))
+        if b is None or not b["throughput"] or not r["throughput"]:
+            continue
+        ratio = r["throughput"] / b["throughput"]
+        if ratio < 1 - tolerance:
+            slower.append((r, ratio))
+            print("SLOWER: %s %s %d runs at %.2fx the baseline throughput" % (r["case"], r["engine"], r["size"],
+                                                                             ratio))
+    if not slower:
+        print("No case is more than %d%% slower than the baseline." % round(100 * tolerance))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pension model's member, population and plan hot paths.  Each case is timed at "
+                    "every population size its engine can handle and reported as throughput (member-years, or "
+                    "members, per second) and peak traced memory.",
+        epilog="Results are saved in pensBench.json.  Throughput depends on the machine, so no baseline is checked "
+               "in: on a fresh checkout, run once with --save-baseline (before making changes) to write "
+               "pensBench-baseline.json.  Later runs flag the cases more than --tolerance slower than it.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=sizes)
+    parser.add_argument("--cases", nargs="+", help="only run these cases")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--out", default=benchFile)
+    parser.add_argument("--baseline", default=baselineFile)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    current = runBenchmarks(args.sizes, args.seed, not args.no_memory, args.cases)
+    with open(args.out, "w") as f:
+        json.dump(current, f, indent=1)
+    print("Results saved at %s" % args.out)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(current, f, indent=1)
+        print("Baseline saved at %s" % args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            compareBaseline(current, json.load(f), args.tolerance)
+    else:
+        print("No baseline at %s, so nothing was compared.  Run with --save-baseline to make this run the "
+              "baseline." % args.baseline)
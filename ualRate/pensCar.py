@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+import numpy as np
+from pensAssumptions import maxAge as tableMaxAge, maxService
+from pensCensus import ACTIVE, RETIRED, SEPARATED, DECEASED
+
+## The Contractual Accrual Rate (CAR), ported from car/car.r and
+## car/newton.r.  A member's premiums and pension payments make a cash
+## flow; the CAR is the rate at which the premiums would have to grow
+## to pay for the pension exactly.  As in the R code, rates are growth
+## factors (1.05 is 5%) until they're reported, when 1 is subtracted.
+
+
+def futureValue(rates, flows):
+    """The value of each column of flows (years x flows), compounded at
+    that column's rate to the last year, and its derivative with
+    respect to the rate.  newton.r's fvFlow, for all the columns at
+    once."""
+    value = np.zeros(flows.shape[1])
+    slope = np.zeros(flows.shape[1])
+    ## Horner's rule, from the first year to the last.
+    for row in flows:
+        slope = slope * rates + value
+        value = value * rates + row
+    return value, slope
+
+
+def findRates(flows, futureVal=0.0, guess=1.5, maxIter=100, tolerance=1e-10, bracket=(0.05, 4.0), steps=80):
+    """The rate that makes each column of flows (years x flows) come
+    out to futureVal at the end, as newton.r's findRate does for one
+    flow.  Newton's method runs on every column at once from guess.
+    Columns where it heads for zero or below, blows up or doesn't
+    converge are solved by bisection instead, on a bracket found by
+    scanning steps rates across the bracket range; where the scan finds
+    more than one root, the one nearest the guess is taken.
+
+    Returns nan for columns with no positive entry (where findRate
+    returns 1) and for those with no root in the bracket range."""
+    flows = np.asarray(flows, dtype=float)
+    if flows.ndim == 1:
+        return findRates(flows[:, None], futureVal, guess, maxIter, tolerance, bracket, steps)[0]
+    rates = np.full(flows.shape[1], np.nan)
+    todo = np.flatnonzero(flows.max(axis=0) > 0)
+    if len(todo) == 0:
+        return rates
+
+    with np.errstate(over="ignore", invalid="ignore", divide="ignore"):
+        r = np.full(len(todo), float(guess))
+        open_ = np.ones(len(todo), dtype=bool)
+        for i in range(maxIter):
+            cols = np.flatnonzero(open_)
+            if len(cols) == 0:
+                break
+            value, slope = futureValue(r[cols], flows[:, todo[cols]])
+            new = r[cols] - (value - futureVal) / slope
+            ## Zero is a degenerate solution; newton.r restarts
+            ## elsewhere and we bisect.
+            bad = ~np.isfinite(new) | (new < tolerance)
+            done = ~bad & (np.abs(1 - new / r[cols]) < tolerance)
+            rates[todo[cols[done]]] = new[done]
+            r[cols] = new
+            open_[cols[bad | done]] = False
+
+        ## Whatever Newton didn't settle.
+        rest = todo[np.isnan(rates[todo])]
+        if len(rest):
+            rates[rest] = bisectRates(flows[:, rest], futureVal, guess, tolerance, bracket, steps)
+    return rates
+
+
+def bisectRates(flows, futureVal, guess, tolerance, bracket, steps):
+    """findRate's fallback: bisection on each column of flows, between
+    the neighbouring grid rates nearest the guess where the value
+    changes sign."""
+    grid = np.geomspace(bracket[0], bracket[1], steps)
+    values = np.array([futureValue(np.full(flows.shape[1], g), flows)[0] - futureVal for g in grid])
+    change = np.sign(values[:-1]) * np.sign(values[1:]) <= 0
+    ## The sign change nearest the guess, by grid distance.
+    distance = np.where(change, np.abs(np.log(grid[:-1, None] / guess)), np.inf)
+    k = np.argmin(distance, axis=0)
+    found = np.isfinite(distance[k, np.arange(flows.shape[1])])
+
+    out = np.full(flows.shape[1], np.nan)
+    if not np.any(found):
+        return out
+    cols = np.flatnonzero(found)
+    lo = grid[k[cols]]
+    hi = grid[k[cols] + 1]
+    f = flows[:, cols]
+    vlo = values[k[cols], cols]
+    while np.max(hi / lo - 1) > tolerance:
+        mid = 0.5 * (lo + hi)
+        vmid = futureValue(mid, f)[0] - futureVal
+        left = np.sign(vmid) == np.sign(vlo)
+        lo = np.where(left, mid, lo)
+        vlo = np.where(left, vmid, vlo)
+        hi = np.where(left, hi, mid)
+    out[cols] = 0.5 * (lo + hi)
+    return out
+
+
+class pensCareers(object):
+    """The whole careers of a set of active members, simulated from the
+    current year back to hire and forward to death, as car.r's
+    projectCareerFromOneYear does for one member, and stored as
+    (years x careers) matrices of salary, premium, pension and status.
+
+    Each member's career is simulated replications times, with its own
+    draws each time, and the careers sit side by side in the columns:
+    column j is member j % len(members) in replication j // len(members).
+    The decrements, raises and benefit multiplier are each member's
+    (pensMember's assumption set, tier and mortality table).  A member
+    who retires gets benefitMultiplier times their highest salary, from
+    the year they retire, growing by cola.  Premiums are premiumRate
+    times salary, employer and employee together.
+
+    Going backward, a year's salary is the next one's over the raise,
+    and the year of hire is a random fraction of a year.  Careers stop
+    at death or at maxAge."""
+
+    def __init__(self, members, replications=1, rng=None, premiumRate=0.25, cola=1.02, maxAge=110):
+        # A pensPop, or a list of pensMember objects.  Only the active ones
+        # have careers to project.
+        members = getattr(members, "members", members)
+        self.members = [m for m in members if m.status == "active"]
+        if not self.members:
+            raise ValueError("No active members to project")
+        years = set(m.currentYear for m in self.members)
+        if len(years) > 1:
+            raise ValueError("Members are in different years: %s" % sorted(years))
+        self.currentYear = years.pop()
+        self.replications = replications
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.premiumRate = premiumRate
+        self.cola = cola
+        self.maxAge = maxAge
+        self.tiers = np.array([str(m.tier) for m in self.members])
+        self.simulate()
+
+    def groupTables(self):
+        """Stacks the decrement and raise tables of every (assumption
+        set, tier) and mortality table the members use, and gives each
+        member its index in the stacks."""
+        sets, tables = {}, {}
+        for m in self.members:
+            sets.setdefault((m.assumptions, m.tierIndex), len(sets))
+            tables.setdefault(m.mortTable, len(tables))
+        self.separation = np.array([a.separation[t] for a, t in sets])
+        self.retirement = np.array([a.retirement[t] for a, t in sets])
+        self.raises = np.array([a.raises for a, t in sets])
+        table = next(iter(tables))
+        self.mortMinAge, self.mortMaxAge = table.minAge, table.maxAge
+        self.mortRates = np.array([t.rates for t in tables])
+        return (np.array([sets[(m.assumptions, m.tierIndex)] for m in self.members]),
+                np.array([tables[m.mortTable] for m in self.members]))
+
+    def simulate(self):
+        n = len(self.members) * self.replications
+        group, table = (np.tile(x, self.replications) for x in self.groupTables())
+        scale = np.tile([m.salaryScale for m in self.members], self.replications)
+        multiplier = np.tile([m.benefitMultiplier for m in self.members], self.replications)
+        age = np.tile([m.age for m in self.members], self.replications)
+        service = np.tile([m.service for m in self.members], self.replications)
+        salary = np.tile([m.salary for m in self.members], self.replications).astype(float)
+        cols = np.arange(n)
+
+        def raises(ages):
+            delta = self.raises[group, np.clip(ages, 0, tableMaxAge)]
+            return np.where(scale != 1.0, 1 + scale * (delta - 1), delta)
+
+        ## Rows before the current year, back to the earliest hire.
+        back = max(int(service.max()) - 1, 0)
+        rows = back + max(self.maxAge - int(age.min()), 0) + 1
+        self.salary = np.zeros((rows, n))
+        self.status = np.full((rows, n), DECEASED, dtype=np.int8)
+        self.hireYear = self.currentYear - np.maximum(service - 1, 0)
+
+        now = back
+        self.salary[now] = salary
+        self.status[now] = ACTIVE
+        s = salary.copy()
+        fraction = self.rng.random(n)
+        for j in range(1, back + 1):
+            hired = service - 1 >= j
+            s = np.where(hired, s / raises(age - j + 1), 0)
+            first = service - 1 == j
+            self.salary[now - j] = np.where(first, s * fraction, s)
+            self.status[now - j, hired] = ACTIVE
+
+        ## Forward, a year at a time, as pensPopArray.applyDecrements.
+        status = np.full(n, ACTIVE, dtype=np.int8)
+        retireRow = np.full(n, -1)
+        for row in range(now + 1, rows):
+            alive = (status != DECEASED) & (age < self.maxAge)
+            if not np.any(alive):
+                rows = row
+                break
+            age = np.where(alive, age + 1, age)
+            active = alive & (status == ACTIVE)
+            service = np.where(active, service + 1, service)
+            salary = np.where(active, salary * raises(age), salary)
+
+            draws = self.rng.random((n, 3))
+            separate = active & (draws[:, 0] < self.separation[group, np.minimum(service, maxService)])
+            retire = active & ~separate & (
+                draws[:, 1] < self.retirement[group, np.minimum(age, tableMaxAge), np.minimum(service, maxService)]
+            )
+            status = np.where(separate, SEPARATED, np.where(retire, RETIRED, status)).astype(np.int8)
+            retireRow[retire] = row
+            ageIdx = np.clip(age, self.mortMinAge, self.mortMaxAge) - self.mortMinAge
+            q = self.mortRates[table, ageIdx, np.where(status == RETIRED, 1, 0)]
+            die = alive & (draws[:, 2] < q)
+            status[die] = DECEASED
+
+            ## Careers that hit maxAge stop here, without a death.
+            self.status[row] = np.where(alive, status, DECEASED)
+            self.salary[row] = np.where(alive & (status == ACTIVE), salary, 0)
+
+        self.salary = self.salary[:rows]
+        self.status = self.status[:rows]
+        self.years = self.currentYear - back + np.arange(rows)
+        self.retireYear = np.where(retireRow >= 0, self.currentYear - back + retireRow, -1)
+
+        ## Pensions, from the year of retirement while the member lives.
+        start = multiplier * self.salary.max(axis=0)
+        since = np.arange(rows)[:, None] - retireRow[None, :]
+        self.pension = np.where(
+            (self.status == RETIRED) & (retireRow >= 0), start * self.cola ** np.maximum(since, 0), 0.0
+        )
+        self.replication = cols // len(self.members)
+
+    @property
+    def premium(self):
+        return self.premiumRate * self.salary
+
+    @property
+    def flow(self):
+        """Premiums in, pensions out, by [year, career]."""
+        return self.premium - self.pension
+
+    def select(self, sampler=None):
+        """The careers that end in retirement, for the members sampler
+        (a function of a pensMember, like makeTbl's) accepts: a boolean
+        mask over the columns."""
+        chosen = np.ones(len(self.members), dtype=bool)
+        if sampler is not None:
+            chosen = np.array([bool(sampler(m)) for m in self.members])
+        return np.tile(chosen, self.replications) & (self.retireYear >= 0)
+
+    def memberRates(self):
+        """Each career's CAR (nan if the member never retires)."""
+        mask = self.select()
+        out = np.full(len(mask), np.nan)
+        out[mask] = findRates(self.flow[:, mask]) - 1
+        return out
+
+    def masterCashFlow(self, sampler=None, replication=0):
+        """car.r's master cash flow matrix for one replication: the net
+        flow of each retirement class by [year, class].  Returns the
+        class (retirement) years and the matrix; the plan's flow is its
+        row sums."""
+        mask = self.select(sampler) & (self.replication == replication)
+        classes = np.unique(self.retireYear[mask])
+        if len(classes):
+            classes = np.arange(classes[0], classes[-1] + 1)
+        index = np.searchsorted(classes, self.retireYear[mask])
+        out = np.zeros((len(self.years), len(classes)))
+        np.add.at(out.T, index, self.flow[:, mask].T)
+        return classes, out
+
+    def groupFlows(self, key, mask, size):
+        """Sums the flows of the masked careers into size columns, by key."""
+        out = np.zeros((size, len(self.years)))
+        np.add.at(out, key[mask], self.flow[:, mask].T)
+        return out.T
+
+    def accrualRates(self, sampler=None):
+        """The plan's CAR in each replication (runModelOnce's "1000"
+        row), over the careers sampler picks: an array with one per
+        replication.  All the replications are solved together."""
+        mask = self.select(sampler)
+        return findRates(self.groupFlows(self.replication, mask, self.replications)) - 1
+
+    def classRates(self, sampler=None):
+        """The CAR of each retirement class in each replication.  Returns
+        the class years and a (replications x classes) array, nan where
+        a class is empty."""
+        mask = self.select(sampler)
+        classes = np.unique(self.retireYear[mask])
+        if len(classes) == 0:
+            return classes, np.zeros((self.replications, 0))
+        classes = np.arange(classes[0], classes[-1] + 1)
+        key = self.replication * len(classes) + (self.retireYear - classes[0])
+        flows = self.groupFlows(key, mask, self.replications * len(classes))
+        return classes, (findRates(flows) - 1).reshape(self.replications, len(classes))
+
+    def tierRates(self):
+        """accrualRates for each tier, as the qc-from-data.r tier studies."""
+        return {str(tier): self.accrualRates(lambda m, t=tier: str(m.tier) == t) for tier in np.unique(self.tiers)}
+
+
+##### TESTING #####
+
+def testFindRates():
+    ## A flow of premiums then payments, at a known 5% rate: 30 years of
+    ## 1, then 20 payments that use it up exactly at 5%.
+    payment = sum(1.05 ** -k for k in range(30)) / sum(1.05 ** -k for k in range(30, 50))
+    flow = np.array([1.0] * 30 + [-payment] * 20)
+    print("5%% flow: %.6f" % findRates(flow))
+    assert abs(findRates(flow) - 1.05) < 1e-8
+    ## A start that sends Newton below zero, and flows with no answer.
+    print("From 0.01:", findRates(flow, guess=0.01))
+    assert abs(findRates(flow, guess=0.01) - 1.05) < 1e-8
+    print("All payments, all premiums:", findRates(np.array([[-1.0, 1.0], [-1.0, 1.0]])))
+    assert np.all(np.isnan(findRates(np.array([[-1.0, 1.0], [-1.0, 1.0]]))))
+
+
+def testCareers():
+    import time
+    from pensPop import pensPop
+    pop = pensPop(None, rng=np.random.default_rng(1), sampleSize=300)
+    t = time.time()
+    careers = pensCareers(pop, replications=250, rng=np.random.default_rng(2))
+    print("%d careers, %d years: %.2fs" % (careers.salary.shape[1], len(careers.years), time.time() - t))
+
+    t = time.time()
+    plan = careers.accrualRates()
+    women = careers.accrualRates(lambda m: m.sex == "F")
+    classes, byClass = careers.classRates()
+    print("Solved in %.2fs" % (time.time() - t))
+    print("Plan CAR: mean %.4f, sd %.4f; women %.4f" % (plan.mean(), plan.std(), np.nanmean(women)))
+    assert plan.shape == (250,) and np.all((plan > 0) & (plan < 0.2))
+    print("By tier:", {tier: round(float(np.mean(r)), 4) for tier, r in careers.tierRates().items()})
+    for year in (2030, 2040, 2050):
+        if year in classes:
+            print("  class of %d: %.4f" % (year, np.nanmean(byClass[:, year - classes[0]])))
+
+    ## The batch solver against one flow at a time.
+    classes, mcf = careers.masterCashFlow()
+    one = findRates(mcf.sum(axis=1)) - 1
+    print("Replication 0: %.6f batch, %.6f alone" % (plan[0], one))
+    assert abs(plan[0] - one) < 1e-8
+    rates = careers.memberRates()
+    print("Retiring members: %d, median CAR %.4f" % (np.sum(~np.isnan(rates)), np.nanmedian(rates)))
+
+
+if __name__ == "__main__":
+    testFindRates()
+    testCareers()
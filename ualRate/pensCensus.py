@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+import numpy as np
+from pensTables import getAgeServiceTable
+
+## Status and sex codes used by the column-based populations.
+statusNames = ("active", "retired", "separated", "deceased")
+ACTIVE, RETIRED, SEPARATED, DECEASED = range(len(statusNames))
+sexNames = ("F", "M")
+
+## The service bands (in years) of the age-service distribution table,
+## with the service value used to estimate each band's average salary.
+serviceBands = [
+    ((0, 1), 1),
+    ((2, 4), 3),
+    ((5, 9), 7),
+    ((10, 14), 12),
+    ((15, 19), 17),
+    ((20, 24), 22),
+    ((25, 29), 27),
+    ((30, 34), 32),
+    ((35, 39), 37),
+    ((40, 44), 42),
+    ((45, 60), 47),
+]
+
+## Retirees aren't in the age-service table.  This is their headcount in
+## the same valuation (CalSTRS 2019, p.75-76), spread over ten five-year
+## age bands from 60, each half the size of the one before.
+## https://www.calstrs.com/sites/main/files/file-attachments/db-valuation-2019.pdf
+totalRetired = 270835
+retiredBands = 10
+
+
+def estimateSalaries(rng, service):
+    """Vectorized pensPop.estimateSalary: a 2020 salary for each entry
+    of the service array."""
+    service = np.asarray(service, dtype=float)
+    n = len(service)
+    early = 51000 + np.minimum(service, 15) * 1600 + rng.normal(0, 2500, n)
+    mid = np.clip(service - 15, 0, 10) * 800 + rng.normal(0, 2500, n)
+    late = np.maximum(service - 25, 0) * rng.normal(500, 100, n)
+    return np.where(service <= 15, early, np.where(service <= 25, early + mid, early + mid + late))
+
+
+def drawCells(rng, counts, ageLow, ageHigh, serviceLow, serviceHigh, avgSalary):
+    """Draws the members of a set of cells at once.  Each cell has a
+    headcount, an age and a service range (both inclusive) and an
+    average salary; members get uniform ages and services within their
+    cell, a random sex, and a salary around the cell average.  Returns a
+    dict of arrays: age, service, sex (an index into sexNames) and
+    salary."""
+    counts = np.asarray(counts, dtype=np.int64)
+    N = int(counts.sum())
+
+    def spread(x):
+        return np.repeat(np.broadcast_to(x, counts.shape), counts)
+
+    avg = spread(avgSalary)
+    return {
+        "age": rng.integers(spread(ageLow), spread(ageHigh), N, endpoint=True),
+        "service": rng.integers(spread(serviceLow), spread(serviceHigh), N, endpoint=True),
+        "sex": (rng.random(N) > 0.5).astype(np.int8),
+        "salary": rng.normal(avg, avg / 15, N),
+    }
+
+
+def drawCensus(rng, sampleSize, tableFile=None):
+    """Draws a whole starting population of about sampleSize members.
+
+    The age-service distribution table, plus the retiree bands, give
+    each (age band, service band) cell a share of the population.  The
+    cell headcounts come from one multinomial draw over those shares and
+    everything else from drawCells(), so the cost is a handful of numpy
+    calls however big the sample.  Returns the drawCells() columns plus
+    status (an index into statusNames)."""
+    if tableFile is None:
+        fractions, ageBands, total = getAgeServiceTable()
+    else:
+        fractions, ageBands, total = getAgeServiceTable(tableFile)
+
+    nAges, nServices = fractions.shape
+    serviceRanges = np.array([band[0] for band in serviceBands[:nServices]])
+    salaryService = np.array([band[1] for band in serviceBands[:nServices]])
+
+    retiredShare = totalRetired / (total + totalRetired)
+    bands = np.arange(retiredBands)
+    shares = np.concatenate((
+        fractions.ravel(),
+        retiredShare * 0.5 ** bands * 0.1,
+    ))
+
+    ## One salary per cell, as pensPop does with estimateSalary.  The
+    ## retirees share a single (pension-sized) salary.
+    s = rng.normal(4000, 4000)
+    if s < 2000:
+        s = rng.uniform(2000, 4000)
+
+    counts = rng.multinomial(int(round(sampleSize * shares.sum())), shares / shares.sum())
+    columns = drawCells(
+        rng,
+        counts,
+        np.concatenate((np.repeat(ageBands[:, 0], nServices), 60 + 5 * bands)),
+        np.concatenate((np.repeat(ageBands[:, 1], nServices), 65 + 5 * bands)),
+        np.concatenate((np.tile(serviceRanges[:, 0], nAges), np.full(retiredBands, 25))),
+        np.concatenate((np.tile(serviceRanges[:, 1], nAges), np.full(retiredBands, 30))),
+        np.concatenate((estimateSalaries(rng, np.tile(salaryService, nAges)), np.full(retiredBands, s))),
+    )
+    columns["status"] = np.repeat(
+        np.concatenate((np.full(nAges * nServices, ACTIVE), np.full(retiredBands, RETIRED))),
+        counts,
+    ).astype(np.int8)
+    return columns
+
+
+##### TESTING #####
+
+def testCensus():
+    import time
+    rng = np.random.default_rng(0)
+    for size in (100, 10000, 500000):
+        t = time.time()
+        c = drawCensus(rng, size)
+        active = c["status"] == ACTIVE
+        print("%d members (%d active) in %.2fs; mean age %.1f, mean service %.1f, mean salary %.0f"
+              % (len(c["age"]), active.sum(), time.time() - t, c["age"][active].mean(),
+                 c["service"][active].mean(), c["salary"][active].mean()))
+        assert set(c) >= {"age", "service", "salary", "sex", "status"}
+        assert all(len(column) == len(c["age"]) for column in c.values())
+        assert np.all(c["service"] >= 0) and np.all(c["service"] < c["age"])
+        assert np.all(c["salary"][active] > 0)
+    ## The headcount is about the size asked for.
+    assert abs(active.sum() - 500000) < 0.01 * 500000
+
+    ## The same seed draws the same census.
+    a, b = drawCensus(np.random.default_rng(3), 1000), drawCensus(np.random.default_rng(3), 1000)
+    assert all(np.array_equal(a[key], b[key]) for key in a)
+
+
+if __name__ == "__main__":
+    testCensus()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import os
+import pickle
+import zlib
+import numpy as np
+
+## A checkpoint is a zlib-compressed pickle, so it holds everything the
+## objects hold: population members or columns, fund holdings and
+## ledger, the state of every random generator, the liability caches
+## and trackers, and any results gathered so far.  Mortality tables are
+## pickled by name and shared again when loaded (see pensMort).
+checkpointVersion = 1
+
+
+def dumpState(state):
+    return zlib.compress(pickle.dumps((checkpointVersion, state), pickle.HIGHEST_PROTOCOL), 1)
+
+
+def loadState(blob):
+    version, state = pickle.loads(zlib.decompress(blob))
+    if version != checkpointVersion:
+        raise ValueError("Checkpoint version %s, expected %s" % (version, checkpointVersion))
+    return state
+
+
+def writeState(path, state):
+    """Writes a state to path.  The file is replaced in one step, so a
+    run killed while writing leaves the previous checkpoint intact."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(dumpState(state))
+    os.replace(tmp, path)
+
+
+def readState(path):
+    with open(path, "rb") as f:
+        return loadState(f.read())
+
+
+def saveCheckpoint(path, plan, data=None, study=None, finished=False):
+    """Saves a pensPlan, and the runModel data recorded so far.  study
+    is the arguments of the run, checked when it's resumed, and finished
+    marks a run that reached the end."""
+    writeState(path, {"plan": plan, "data": data, "study": study, "finished": finished})
+
+
+def loadCheckpoint(path):
+    """Returns the (plan, data) pair saved by saveCheckpoint."""
+    state = readState(path)
+    return state["plan"], state["data"]
+
+
+def forkCheckpoint(source, n, seed=None):
+    """n independent copies of a checkpoint (a path or a (plan, data)
+    pair), to run on from the same point without simulating the years
+    before it again.
+
+    The state is serialized once and each branch is a fresh load of it.
+    With no seed the branches keep the same random streams, so they see
+    the same decrements and returns and any difference comes from what is
+    changed on them (a contribution policy, say).  With a seed each
+    branch gets its own child streams of it; see pensPlan.reseed."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as f:
+            blob = f.read()
+    else:
+        blob = dumpState({"plan": source[0], "data": source[1]})
+
+    branches = []
+    seeds = None
+    if seed is not None:
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        seeds = seed.spawn(n)
+    for i in range(n):
+        state = loadState(blob)
+        if seeds is not None:
+            state["plan"].reseed(seeds[i])
+        branches.append((state["plan"], state["data"]))
+    return branches
+
+
+##### TESTING #####
+
+def testCheckpoint(path="test-checkpoint.pawg"):
+    from pensPlan import runModel
+    vol = [0.04, 0.03, 0.02, 0.03, 0.04, 0.04]
+    for engine in ("members", "array"):
+        whole = runModel(vol, years=20, seed=3, engine=engine, sampleSize=2000)
+        ## Stop at year 10, then pick the run up again from the checkpoint.
+        runModel(vol, years=10, seed=3, engine=engine, sampleSize=2000, checkpoint=path, checkpointEvery=5)
+        print("%s checkpoint: %d bytes" % (engine, os.path.getsize(path)))
+
+        ## Four futures from year 10, under two contribution policies.
+        branches = forkCheckpoint(path, 4, seed=1)
+        finals = []
+        for i, (plan, data) in enumerate(branches):
+            plan.pr = 1.0 if i % 2 == 0 else 1.5
+            d = runModel(vol, years=20, start=(plan, data))
+            print("  branch %d: premium rate %.1f, final assets %.0f" % (i, plan.pr, d["Assets"][-1]))
+            ## Every branch starts from the saved year 10.
+            assert d["Assets"][:11] == whole["Assets"][:11] and len(d["Assets"]) == len(whole["Assets"])
+            finals.append(d["Assets"][-1])
+        ## The branches have their own streams, so their futures differ.
+        assert len(set(finals)) == len(finals)
+
+        ## The run to year 10 finished, so carrying it on is explicit.
+        resumed = runModel(vol, years=20, start=loadCheckpoint(path))
+        print("Resumed run matches:", resumed == whole)
+        assert resumed == whole
+
+        ## A run stopped part way is picked up from its checkpoint, but
+        ## only by a call with the same arguments.
+        state = readState(path)
+        state["finished"] = False
+        writeState(path, state)
+        try:
+            runModel(vol, years=20, seed=4, engine=engine, sampleSize=2000, checkpoint=path)
+            raise AssertionError("A checkpoint of another run was resumed")
+        except ValueError as e:
+            print("Refused:", e)
+        assert runModel(vol, years=20, seed=3, engine=engine, sampleSize=2000, checkpoint=path) == whole
+        assert readState(path)["finished"]
+        ## A finished checkpoint isn't resumed: the run starts over.
+        assert runModel(vol, years=15, seed=3, engine=engine, sampleSize=2000, checkpoint=path)["UAL"] == \
+            whole["UAL"][:16]
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    testCheckpoint()
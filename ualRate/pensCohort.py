@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+import math
+import numpy as np
+from pensTables import pensMort, getAgeServiceTable
+from pensAssumptions import pensAssumptions
+from pensValuation import pensAnnuity, pensDecrements, pensBenefitFlows
+from pensCensus import sexNames, serviceBands, totalRetired, retiredBands
+
+## Service beyond this is kept in the last column.  It changes none of
+## the decrement rates, only the average service.
+maxService = 70
+
+
+def expectedRetireeSalary():
+    """The mean of the salary drawCensus gives its retirees: a normal
+    draw around 4000, redrawn uniformly from 2000-4000 when below 2000."""
+    z = -0.5
+    below = 0.5 * (1 + math.erf(z / math.sqrt(2)))
+    density = math.exp(-z * z / 2) / math.sqrt(2 * math.pi)
+    return 4000 * (1 - below) + 4000 * density + 3000 * below
+
+
+class pensCohort(object):
+    """A plan population stored as expected headcounts over (sex, age,
+    service) cells for active members and (sex, age) cells for retirees,
+    with the total salary or pension of each cell alongside.
+
+    There are no individual lives and no random draws.  Each year the
+    counts move through the same decrements pensMember applies (the
+    assumption set's separation and retirement rates and the mortality
+    tables), each cell splitting by its probabilities, and salaries grow
+    by its raises.  So a run gives the expected headcounts, payroll,
+    benefit outgo and liability that the member and array engines only
+    reach on average, in a few milliseconds for a hundred years.  Every
+    member is in the General mortality class, as in drawCensus.
+
+    Exposes the same interface as pensPop, so pensPlan can use it as
+    engine="cohort".  Headcounts are not whole numbers."""
+
+    def __init__(
+        self,
+        discountRate=0.07,
+        valuation="expected",
+        rng=None,
+        sampleSize=100,
+        cola=1.02,
+        benefitMultiplier=None,
+        salaryScale=1.0,
+        mortalityFudge=1.0,
+        decrementSeed=None,
+        census=None,
+        assumptions=None,
+    ):
+        # rng, decrementSeed and census are taken for pensPop's sake;
+        # nothing here is random.  The valuation is always "expected".
+        self.startingSalary = 50000
+        self.avgAge = 30
+        self.sampleSize = sampleSize
+        self.discount = 1 + discountRate
+        self.cola = cola
+        # Every cell is in the assumption set's tier "1".
+        self.assumptions = a = pensAssumptions.get(assumptions)
+        t = a.tierIndex("1")
+        if benefitMultiplier is None:
+            benefitMultiplier = a.benefitMultiplier
+        self.benefitMultiplier = benefitMultiplier
+        self.salaryScale = salaryScale
+        self.mortalityFudge = mortalityFudge
+        self.valuation = "expected"
+
+        tables = [pensMort.get(sex, "General", fudge=mortalityFudge) for sex in sexNames]
+        self.minAge = tables[0].minAge
+        self.maxAge = tables[0].maxAge
+        self.ages = np.arange(self.minAge, self.maxAge + 1)
+        services = np.arange(maxService + 1)
+
+        ## Decrement probabilities by [sex, age, service] at the age and
+        ## service a member has just reached, which is where
+        ## pensMember.ageOneYear checks them.
+        qActive = np.array([t.rates[:, 0] for t in tables])[:, :, None]
+        self.qRetired = np.array([t.rates[:, 1] for t in tables])
+        separate = a.separationRate(services, t)[None, None, :]
+        retire = a.retirementRate(self.ages[:, None], services[None, :], t)[None]
+        self.stay = (1 - separate) * (1 - retire) * (1 - qActive)
+        self.separate = np.broadcast_to(separate, self.stay.shape)
+        self.retire = (1 - separate) * retire * (1 - self.qRetired[:, :, None])
+        self.raise_ = a.salaryDelta(self.ages, salaryScale)[None, :, None]
+
+        shape = (len(sexNames), len(self.ages), maxService + 1)
+        # Expected active headcount and total salary by [sex, age, service].
+        self.active = np.zeros(shape)
+        self.salary = np.zeros(shape)
+        # Expected retiree headcount and total pension by [sex, age].
+        self.retired = np.zeros(shape[:2])
+        self.pension = np.zeros(shape[:2])
+        self.separated = 0.0
+        self.deceased = 0.0
+        self.factors = None
+
+        self.simulatePopulation()
+
+    def __len__(self):
+        return int(round(self.active.sum() + self.retired.sum()))
+
+    def addCells(self, count, ageLow, ageHigh, serviceLow, serviceHigh, avgSalary, retired=False):
+        """Adds count members spread evenly over the sexes and over the
+        (inclusive) age and service ranges, as drawCells draws them."""
+        if count <= 0:
+            return
+        ages = np.arange(max(ageLow, self.minAge), min(ageHigh, self.maxAge) + 1) - self.minAge
+        services = np.arange(serviceLow, min(serviceHigh, maxService) + 1)
+        share = count / (len(sexNames) * len(ages) * len(services))
+        if retired:
+            ## pensCensus gives retirees a pension-sized salary.
+            self.retired[:, ages] += share * len(services)
+            self.pension[:, ages] += share * len(services) * avgSalary * self.benefitMultiplier
+        else:
+            self.active[:, ages[:, None], services[None, :]] += share
+            self.salary[:, ages[:, None], services[None, :]] += share * avgSalary
+
+    def simulatePopulation(self):
+        """Adds the expected census: drawCensus's cell shares times the
+        sample size, with each cell's expected salary."""
+        fractions, ageBands, total = getAgeServiceTable()
+        nAges, nServices = fractions.shape
+        retiredShare = totalRetired / (total + totalRetired)
+        bands = np.arange(retiredBands)
+        retiredShares = retiredShare * 0.5 ** bands * 0.1
+        N = round(self.sampleSize * (fractions.sum() + retiredShares.sum()))
+        scale = N / (fractions.sum() + retiredShares.sum())
+
+        for i in range(nAges):
+            for j, ((low, high), s) in enumerate(serviceBands[:nServices]):
+                ## The mean of pensCensus.estimateSalaries.
+                avg = 51000 + min(s, 15) * 1600 + min(max(s - 15, 0), 10) * 800 + max(s - 25, 0) * 500
+                self.addCells(scale * fractions[i, j], ageBands[i, 0], ageBands[i, 1], low, high, avg)
+        retireeSalary = expectedRetireeSalary()
+        for b in bands:
+            self.addCells(scale * retiredShares[b], 60 + 5 * b, 65 + 5 * b, 25, 30, retireeSalary, retired=True)
+
+    def advanceOneYear(self):
+        """Moves the counts on by a year: everyone ages, actives gain a
+        year of service and a raise, then each cell splits by its chances
+        of separating, retiring and dying."""
+        A = np.zeros_like(self.active)
+        S = np.zeros_like(self.salary)
+        A[:, 1:, 1:] = self.active[:, :-1, :-1]
+        A[:, 1:, -1] += self.active[:, :-1, -1]
+        S[:, 1:, 1:] = self.salary[:, :-1, :-1]
+        S[:, 1:, -1] += self.salary[:, :-1, -1]
+        S *= self.raise_
+        ## Anyone already at the table's last age has died by now.
+        gone = self.active[:, -1].sum() + self.retired[:, -1].sum()
+
+        R = np.zeros_like(self.retired)
+        P = np.zeros_like(self.pension)
+        R[:, 1:] = self.retired[:, :-1] * (1 - self.qRetired[:, 1:])
+        P[:, 1:] = self.pension[:, :-1] * (1 - self.qRetired[:, 1:])
+        retireeDeaths = self.retired[:, :-1].sum() - R.sum()
+
+        newRetired = (A * self.retire).sum(axis=2)
+        R += newRetired
+        P += (S * self.retire).sum(axis=2) * self.benefitMultiplier
+
+        before = A.sum()
+        separated = (A * self.separate).sum()
+        self.active = A * self.stay
+        self.salary = S * self.stay
+        self.retired = R
+        self.pension = P
+        left = before - self.active.sum()
+
+        self.separated += separated
+        self.deceased += gone + retireeDeaths + left - separated - newRetired.sum()
+        return {"benefit": float(P.sum()), "replace": float(left)}
+
+    def hireReplacements(self, N, pct=1.0):
+        """Replace retired and separated workers to maintain headcount.
+        If pct is less than one, only replace that proportion of the retired
+        and separated."""
+        self.addCells(N * pct, self.avgAge - 5, self.avgAge + 5, 0, 1, self.startingSalary)
+
+    def addNewMembers(self, N):
+        """New hires who aren't replacements, at the expected salary of
+        pensPopArray's."""
+        self.addCells(N, 25, 35, 0, 5, 51000 + 2 * 1600)
+
+    def layoffMembers(self, N):
+        """Remove up to N active members aged 20 to 25, youngest first."""
+        for a in range(20 - self.minAge, 26 - self.minAge):
+            here = self.active[:, a].sum()
+            if N <= 0 or here <= 0:
+                break
+            keep = max(here - N, 0) / here
+            self.active[:, a] *= keep
+            self.salary[:, a] *= keep
+            N -= here
+
+    def countStatus(self, status):
+        if status == "active":
+            return float(self.active.sum())
+        elif status == "retired":
+            return float(self.retired.sum())
+        elif status == "separated":
+            return self.separated
+        elif status == "deceased":
+            return self.deceased
+        return 0.0
+
+    def printReport(self):
+        total = sum(self.countStatus(s) for s in ("active", "retired", "separated", "deceased"))
+        print(
+            "N: %.0f members, %0.f active, %0.f retired, %0.f separated, %0.f deceased"
+            % (
+                total,
+                self.countStatus("active"),
+                self.countStatus("retired"),
+                self.countStatus("separated"),
+                self.countStatus("deceased"),
+            )
+        )
+        sal = self.calculateTotalSalary() / total
+        print("Average salary: $%s" % "{:,}".format(round(sal, 2)))
+
+    def annuityFactors(self):
+        """The pensAnnuity factors, by [sex, age, service] for actives
+        and [sex, age] for retirees."""
+        if self.factors is None:
+            tables = [
+                pensAnnuity.get(sex, "General", self.discount, self.cola, self.mortalityFudge, self.assumptions)
+                for sex in sexNames
+            ]
+            services = np.minimum(np.arange(maxService + 1), tables[0].maxService)
+            self.factors = (
+                np.array([t.active[:, services] for t in tables]) * self.benefitMultiplier,
+                np.array([t.retired for t in tables]),
+            )
+        return self.factors
+
+    def calculateTotalLiability(self):
+        """Pension times the annuity factor, summed over the cells."""
+        active, retired = self.annuityFactors()
+        return float(np.vdot(self.salary, active) + np.vdot(self.pension, retired))
+
+    def benefitFlows(self, entrantYears=0, pct=1.0):
+        """The expected benefit payments by future year; see
+        pensPop.benefitFlows."""
+        flows = pensBenefitFlows()
+        for i, sex in enumerate(sexNames):
+            mort = pensMort.get(sex, "General", fudge=self.mortalityFudge)
+            dec = pensDecrements.get(mort, self.assumptions)
+            ## Service past the decrements' cap goes in the last column.
+            services = np.minimum(np.arange(maxService + 1), dec.maxService)
+            units, heads, retired = flows.cell(dec)
+            np.add.at(units.T, services, self.salary[i].T * self.benefitMultiplier)
+            np.add.at(heads.T, services, self.active[i].T)
+            retired += self.pension[i]
+            flows.addHires(
+                dec, 1 / len(sexNames), (self.avgAge - 5, self.avgAge + 5), (0, 1),
+                self.startingSalary * self.benefitMultiplier,
+            )
+        return flows.project(entrantYears, pct)
+
+    def calculateTotalSalary(self):
+        return float(self.salary.sum())
+
+    def getAvgService(self):
+        count = self.active.sum()
+        if count == 0:
+            return 0
+        return float((self.active.sum(axis=(0, 1)) * np.arange(maxService + 1)).sum() / count)
+
+
+##### TESTING #####
+
+
+if __name__ == "__main__":
+
+    def testCohort():
+        import time
+        from pensPlan import runModel
+        vol = [0.04, 0.0, 0.02, 0.0, 0.04, 0.0]
+        t = time.time()
+        d = runModel(vol, years=100, engine="cohort", sampleSize=10000)
+        print("100 years in %.3fs" % (time.time() - t))
+
+        ## The cohort projection against the average of simulated runs.
+        runs = [runModel(vol, years=30, engine="array", seed=s, sampleSize=10000) for s in range(5)]
+        d = runModel(vol, years=30, engine="cohort", sampleSize=10000)
+        for key in ("Active Members", "Retired Members", "Liability", "Total Salary"):
+            simulated = np.mean([r[key] for r in runs], axis=0)
+            print("%-16s" % key, " ".join("%6.3f" % (d[key][y] / simulated[y]) for y in (1, 5, 10, 20, 30)))
+            ## Five runs of 10000 members land within a few percent of
+            ## the expectation.
+            assert np.all(abs(np.asarray(d[key][1:]) / simulated[1:] - 1) < 0.05)
+        ## The projection is deterministic.
+        assert runModel(vol, years=30, engine="cohort", sampleSize=10000) == d
+
+    testCohort()
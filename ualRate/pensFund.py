@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 import numpy as np
 
+## The target split of the fund across equity, bonds and other assets.
+targetMix = (0.6, 0.3, 0.1)
+
 
 class pensFund(object):
-    def __init__(self, assetTotal, currYear, volatility, pctE=0.6, pctB=0.3, pctO=0.1):
+    def __init__(self, assetTotal, currYear, volatility, pctE=targetMix[0], pctB=targetMix[1], pctO=targetMix[2],
+                 rng=None, antithetic=False):
         self.currentYear = currYear
+        # The numpy.random.Generator for investment returns.
+        self.rng = rng if rng is not None else np.random.default_rng()
+        # With antithetic set, every return is as far from its mean as it would otherwise be, but on the other side.
+        # A fund built from the same seed with and without it makes an antithetic pair.
+        self.antithetic = antithetic
         self.pcts = [pctE, pctB, pctO]
         self.vol = volatility
+        # The (equity, bonds, other) returns of every year so far.
+        self.returns = []
 
         self.equity = round(self.pcts[0] * assetTotal, 2)
         self.bonds = round(self.pcts[1] * assetTotal, 2)
@@ -30,6 +41,9 @@ class pensFund(object):
     def printReport(self):
         print(self.annualReport())
 
+    def totalAssets(self):
+        return sum(self.ledger[self.currentYear])
+
     def addPremiums(self, premiums):
         total = self.equity + self.bonds + self.other
         if total == 0:
@@ -70,9 +84,12 @@ class pensFund(object):
         return self.payGo()
 
     def addInvestmentEarnings(self, year):
-        e = np.random.normal(self.vol[0], self.vol[1])
-        b = np.random.normal(self.vol[2], self.vol[3])
-        o = np.random.normal(self.vol[4], self.vol[5])
+        # One draw for all three asset classes: means and sds alternate in vol.
+        z = self.rng.standard_normal(3)
+        if self.antithetic:
+            z = -z
+        e, b, o = (np.asarray(self.vol[0::2]) + np.asarray(self.vol[1::2]) * z).tolist()
+        self.returns.append([e, b, o])
         # defaults: [0.06, 0.03, 0.04, 0.01, 0.06, 0.05]
 
         # print("Investment Earnings amount to $%s" % '{:,}'.format(round(earnings, 2)))
@@ -89,6 +106,98 @@ class pensFund(object):
         self.ledger[self.currentYear] = [self.equity, self.bonds, self.other]
 
 
+class pensFundBatch(object):
+    """S investment scenarios of pensFund, advanced together.  Holdings
+    are an (S x 3) array of equity, bonds and other, and every premium,
+    benefit payment, payGo shortfall and year of returns is applied to
+    all the scenarios in one vectorized step.  Premiums and benefits can
+    be a single amount for every scenario or an array of S amounts.  The
+    ledger is a preallocated (years x S x 3) array, grown if a run
+    outlasts it.  With antithetic set, the second half of the scenarios
+    get the mirror images of the first half's returns."""
+
+    def __init__(self, assetTotal, currYear, volatility, scenarios, pctE=targetMix[0], pctB=targetMix[1],
+                 pctO=targetMix[2], rng=None, years=100, antithetic=False):
+        self.startYear = currYear
+        self.currentYear = currYear
+        self.pcts = np.array([pctE, pctB, pctO])
+        self.vol = np.asarray(volatility, dtype=float)
+        self.scenarios = scenarios
+        # The numpy.random.Generator for investment returns.
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.antithetic = antithetic
+
+        self.holdings = np.tile(np.round(self.pcts * assetTotal, 2), (scenarios, 1))
+
+        self.ledger = np.full((years + 1, scenarios, len(self.pcts)), np.nan)
+        self.ledger[0] = self.holdings
+
+    def ledgerFor(self, year):
+        """The (S x 3) holdings recorded at the end of the given year."""
+        return self.ledger[year - self.startYear]
+
+    def totalAssets(self):
+        return self.holdings.sum(axis=1)
+
+    def annualReport(self, year=0):
+        if year == 0:
+            year = self.currentYear
+
+        i = year - self.startYear
+        if 0 <= i < len(self.ledger) and not np.isnan(self.ledger[i, 0, 0]):
+            totals = self.ledger[i].sum(axis=1)
+            p5, p50, p95 = np.percentile(totals, [5, 50, 95])
+            return ("Assets over %d scenarios:\n\tMean = $%s\n\t5%% = $%s\n\tMedian = $%s\n\t95%% = $%s" %
+                    (self.scenarios, '{:,}'.format(round(totals.mean(), 2)), '{:,}'.format(round(p5, 2)),
+                     '{:,}'.format(round(p50, 2)), '{:,}'.format(round(p95, 2))))
+        else:
+            return "Assets could not be found for the year %.0f." % year
+
+    def printReport(self):
+        print(self.annualReport())
+
+    def shares(self):
+        """Each scenario's split across asset classes: its current mix,
+        or the target percentages where it holds nothing."""
+        total = self.holdings.sum(axis=1, keepdims=True)
+        mix = np.divide(self.holdings, total, out=np.zeros_like(self.holdings), where=total != 0)
+        return np.where(total == 0, self.pcts, mix)
+
+    def addPremiums(self, premiums):
+        premiums = np.broadcast_to(np.asarray(premiums, dtype=float), (self.scenarios,))
+        self.holdings += self.shares() * premiums[:, None]
+
+    def payGo(self):
+        """Zeroes the negative holdings of scenarios whose total has gone
+        negative and returns the shortfall for each scenario."""
+        short = self.holdings.sum(axis=1) < 0
+        out = np.where(short, -np.minimum(self.holdings, 0).sum(axis=1), 0.0)
+        self.holdings[short] = np.maximum(self.holdings[short], 0)
+        return out
+
+    def payBenefits(self, benefits):
+        benefits = np.broadcast_to(np.asarray(benefits, dtype=float), (self.scenarios,))
+        self.holdings -= self.shares() * benefits[:, None]
+        return self.payGo()
+
+    def addInvestmentEarnings(self, year):
+        if self.antithetic:
+            z = self.rng.standard_normal(((self.scenarios + 1) // 2, self.holdings.shape[1]))
+            z = np.concatenate((z, -z))[:self.scenarios]
+        else:
+            z = self.rng.standard_normal(self.holdings.shape)
+        returns = self.vol[0::2] + self.vol[1::2] * z
+        self.holdings = np.round(self.holdings * (1 + returns), 2)
+
+        self.currentYear = year
+        i = year - self.startYear
+        if i >= len(self.ledger):
+            grown = np.full((2 * len(self.ledger),) + self.ledger.shape[1:], np.nan)
+            grown[:len(self.ledger)] = self.ledger
+            self.ledger = grown
+        self.ledger[i] = self.holdings
+
+
 ##### TESTING #####
 
 def testFund():
@@ -105,5 +214,27 @@ def testFund():
     print(fund.annualReport(2022))
 
 
+def testFundBatch():
+    print("\nCreating 1000 scenarios. assetTotal = 200, currYear = 2020.\n")
+    v = [0.06, 0.03, 0.04, 0.01, 0.06, 0.05]
+    fund = pensFundBatch(200, 2020, v, 1000, years=2, rng=np.random.default_rng(1))
+    for year in range(2021, 2026):
+        fund.addPremiums(50)
+        fund.payBenefits(40)
+        fund.addInvestmentEarnings(year)
+    print(fund.annualReport(2025))
+    print(fund.annualReport(2030))
+    ## The ledger grew past the two years it was made for.
+    assert np.array_equal(fund.ledgerFor(2025), fund.holdings) and fund.ledgerFor(2020).sum() == 200000
+    assert fund.annualReport(2030).startswith("Assets could not be found")
+
+    ## Each scenario is the single fund's arithmetic, with its own returns.
+    fund = pensFundBatch(200, 2020, v, 3, rng=np.random.default_rng(2))
+    fund.addPremiums([50, 0, 10])
+    assert np.allclose(fund.totalAssets(), [250, 200, 210])
+    assert np.allclose(fund.payBenefits([0, 300, 0]), [0, 100, 0]) and fund.totalAssets()[1] == 0
+
+
 if __name__ == "__main__":
     testFund()
+    testFundBatch()
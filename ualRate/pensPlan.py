@@ -1,14 +1,45 @@
 #!/usr/bin/env python3
 from pensPop import pensPop
-from pensFund import pensFund
-import plotly.express as px
-import pandas as pd
-import statistics as stats
+from pensPopArray import pensPopArray
+from pensCohort import pensCohort
+from pensFund import pensFund, pensFundBatch
+from pensTables import pensMort, getAgeServiceTable
+from pensValuation import pensAnnuity
+from pensAssumptions import pensAssumptions
+from pensStats import pensRunStats
+from pensStore import pensResultWriter, partitionName
+from pensProfile import pensProfile
+from pensSnapshot import pensSnapshots, makeCensus
+from pensCheckpoint import saveCheckpoint, loadCheckpoint, forkCheckpoint, writeState, readState
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import numpy as np
 import os
 
 
+# The values runModel records for each year.
+modelMetrics = ["UAL", "Assets", "Liability", "UAL Growth(%)", "Active Members", "Retired Members", "Avg. Service",
+                "Contribution Rate", "payGo", "Total Salary"]
+
+
+def childSeeds(seed, n):
+    """The first n children seed.spawn(n) would give a fresh SeedSequence.  Unlike spawn, this doesn't count
+    against the seed, so plans built from the same SeedSequence object get the same streams."""
+    return [np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (i,), pool_size=seed.pool_size)
+            for i in range(n)]
+
+
 class pensPlan(object):
-    def __init__(self, currentYear, volatility, employmentGrowth=1.0, discountRate=0.07, funds=0.75, premiumRate=1.0):
+    def __init__(self, currentYear, volatility, employmentGrowth=1.0, discountRate=0.07, funds=0.75, premiumRate=1.0,
+                 engine="members", valuation="expected", cacheSize=4096, seed=None, scenarios=None, sampleSize=100,
+                 cola=1.02, benefitMultiplier=None, salaryScale=1.0, mortalityFudge=1.0, antithetic=False,
+                 profile=None, snapshots=None, assumptions=None):
+
+        # A pensProfile to record where the time goes, or None.
+        self.profile = profile
+        if profile is not None:
+            t = profile.clock()
 
         self.currentYear = currentYear
         self.employ = employmentGrowth
@@ -19,16 +50,110 @@ class pensPlan(object):
 
         self.discountRate = discountRate
 
-        self.population = pensPop([], self.discountRate)
-        self.population.simulatePopulation()
-
-        self.liability = round(self.population.calculateTotalLiability(), 2)
-
-        self.fund = pensFund(funds * self.liability, self.currentYear, volatility)
-        self.ual = round(self.liability - sum(self.fund.ledger[self.currentYear]), 2)
-        self.assets = sum(self.fund.ledger[self.currentYear])
-
-        self.growthRate = 0.0
+        # The population and the fund draw from independent streams spawned from the seed, which can be an
+        # int, a SeedSequence or None (fresh entropy).  The yearly decrement draws get a stream of their own, so
+        # plans built from the same seed with different settings share them (see pensPop.decrementRng), and so
+        # does the starting census.
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        popSeed, fundSeed, censusSeed = childSeeds(seed, 3)
+        popRng = np.random.default_rng(popSeed)
+        decrementSeed, valuationSeed = popSeed.spawn(2)
+
+        # With snapshots (a directory, see pensSnapshot), the census and its initial liability are read from the
+        # cache there when another plan has already made them.
+        cache = pensSnapshots.get(snapshots) if snapshots is not None else None
+        if engine == "cohort":
+            census = None
+        elif cache is not None:
+            census = cache.census(sampleSize, censusSeed)
+        else:
+            census = makeCensus(sampleSize, censusSeed)
+
+        # The decrement and salary tables come from an assumption set (a name in assumptionSets/ or a path to a
+        # JSON file, see pensAssumptions), which also gives the benefit multiplier unless one is passed.
+        assumptionSet = pensAssumptions.get(assumptions)
+        if benefitMultiplier is None:
+            benefitMultiplier = assumptionSet.benefitMultiplier
+
+        # "members" keeps a list of pensMember objects, "array" keeps NumPy columns and "cohort" keeps expected
+        # headcounts with no random draws.  The valuation COLA, benefit multiplier, salary scale and mortality fudge
+        # are the assumptions listed in sensitivity.txt.
+        options = dict(sampleSize=sampleSize, cola=cola, benefitMultiplier=benefitMultiplier,
+                       salaryScale=salaryScale, mortalityFudge=mortalityFudge, decrementSeed=decrementSeed,
+                       census=census, assumptions=assumptionSet)
+        if engine == "array":
+            self.population = pensPopArray(self.discountRate, valuation, rng=popRng, valuationSeed=valuationSeed,
+                                           **options)
+        elif engine == "cohort":
+            self.population = pensCohort(self.discountRate, valuation, rng=popRng, **options)
+        else:
+            self.population = pensPop(None, self.discountRate, valuation, cacheSize, rng=popRng, **options)
+
+        # A simulated valuation draws from the population's streams, so only the expected ones are cached.  The
+        # assumptions are keyed by their contents, so sets built in memory or edited on disk don't share a value.
+        if cache is not None and census is not None and valuation != "simulate":
+            spec = json.dumps(assumptionSet.spec, sort_keys=True)
+            settings = dict(engine=engine, valuation=valuation, discountRate=discountRate, cola=cola,
+                            benefitMultiplier=benefitMultiplier, salaryScale=salaryScale, mortalityFudge=mortalityFudge,
+                            assumptions=hashlib.sha1(spec.encode("utf-8")).hexdigest())
+            self.liability = cache.liability(sampleSize, censusSeed, settings,
+                                             lambda: round(self.population.calculateTotalLiability(), 2))
+        else:
+            self.liability = round(self.population.calculateTotalLiability(), 2)
+
+        # With scenarios, one population run drives that many investment paths at once, and the fund-side
+        # values (assets, UAL, payGo, contribution rate, growth rate) are arrays with one entry per path.
+        self.scenarios = scenarios
+        fundRng = np.random.default_rng(fundSeed)
+        if scenarios:
+            self.fund = pensFundBatch(funds * self.liability, self.currentYear, volatility, scenarios, rng=fundRng,
+                                      antithetic=antithetic)
+            self.cr = np.zeros(scenarios)
+            self.payGo = np.zeros(scenarios)
+        else:
+            self.fund = pensFund(funds * self.liability, self.currentYear, volatility, rng=fundRng,
+                                 antithetic=antithetic)
+        self.assets = self.fund.totalAssets()
+        self.ual = np.round(self.liability - self.assets, 2) if scenarios else round(self.liability - self.assets, 2)
+
+        self.growthRate = np.zeros(scenarios) if scenarios else 0.0
+
+        if profile is not None:
+            profile.record(self.currentYear, "setup", t)
+            profile.count("members", len(self.population))
+            profile.count("liabilityEvaluations", self.liabilityEvaluations())
+
+    def reseed(self, seed):
+        """Gives the plan new random streams from seed (an int or a SeedSequence), split between the population
+        and the fund as in __init__.  The generators are changed in place, so the members sharing the population's
+        see the change too."""
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        popSeed, fundSeed = childSeeds(seed, 2)
+        if getattr(self.population, "rng", None) is not None:
+            self.population.rng.bit_generator.state = np.random.default_rng(popSeed).bit_generator.state
+        decrementSeed, valuationSeed = popSeed.spawn(2)
+        if getattr(self.population, "decrementSeed", None) is not None:
+            self.population.decrementSeed = decrementSeed
+        if getattr(self.population, "valuationRng", None) is not None:
+            self.population.valuationRng.bit_generator.state = np.random.default_rng(valuationSeed).bit_generator.state
+        self.fund.rng.bit_generator.state = np.random.default_rng(fundSeed).bit_generator.state
+
+    def fork(self, n, seed=None):
+        """n copies of the plan as it stands; see pensCheckpoint.forkCheckpoint."""
+        return [plan for plan, data in forkCheckpoint((self, None), n, seed)]
+
+    def benefitFlows(self, entrantYears=0):
+        """The population's expected benefit payments by future year (a pensBenefitFlows), with entrantYears of
+        replacement hires at the plan's employment growth.  flows.presentValue(rates, colas) then values the current
+        members at any number of discount rates and COLAs without running the population again."""
+        return self.population.benefitFlows(entrantYears, self.employ)
+
+    def liabilityEvaluations(self):
+        """How many member (or tracker cell) values a liability calculation takes."""
+        tracker = getattr(self.population, "tracker", None)
+        return len(tracker.cells) if tracker is not None else len(self.population)
 
     def annualReport(self):
         # show number of active and retired members
@@ -51,41 +176,72 @@ class pensPlan(object):
             print("Unfunded Liability: $0")
 
     def advanceOneYear(self):
+        prof = self.profile
+        if prof is not None:
+            t = prof.clock()
+            prof.count("members", len(self.population))
+
         self.currentYear += 1
         info = self.population.advanceOneYear()
+        if prof is not None:
+            t = prof.record(self.currentYear, "aging", t)
 
         # variable to record growth in active population after hiring new members.
-        popGrowth = sum([m.status == 'active' for m in self.population.members])
+        popGrowth = self.population.countStatus("active")
         self.population.hireReplacements(info['replace'], self.employ)
-        popGrowth = sum([m.status == 'active' for m in self.population.members]) - popGrowth
+        popGrowth = self.population.countStatus("active") - popGrowth
+        if prof is not None:
+            t = prof.record(self.currentYear, "hiring", t)
 
         ## Calculate the increment of the normal cost.
         newLiability = round(self.population.calculateTotalLiability(), 2)
         normalCost = (newLiability - self.liability)
         self.liability = newLiability
+        if prof is not None:
+            prof.count("liabilityEvaluations", self.liabilityEvaluations())
+            t = prof.record(self.currentYear, "liability", t)
 
         self.fund.addPremiums(self.pr * normalCost)
 
-        self.payGo = round(self.fund.payBenefits(info['benefit']), 2)
+        self.payGo = self.fund.payBenefits(info['benefit'])
+        self.payGo = np.round(self.payGo, 2) if self.scenarios else round(self.payGo, 2)
         self.totalPay = round(self.population.calculateTotalSalary(), 2)
 
         if popGrowth != 0:
             self.cr = (normalCost + self.payGo) / (self.totalPay * popGrowth)
         else:
             self.cr = (normalCost + self.payGo) / self.totalPay
+        if prof is not None:
+            t = prof.record(self.currentYear, "premiums/benefits", t)
 
         self.fund.addInvestmentEarnings(self.currentYear)
-        self.assets = sum(self.fund.ledger[self.currentYear])
+        self.assets = self.fund.totalAssets()
+        if self.scenarios:
+            self.updateUALScenarios()
+            if prof is not None:
+                prof.record(self.currentYear, "earnings", t)
+            return
+
         newUAL = max((self.liability - self.assets - self.payGo), 0)
         try:
             self.growthRate = (newUAL - self.ual) * 100 / self.ual
         except ZeroDivisionError:
             if newUAL != 0:
-                self.growthRate = newUal * 100 / self.liability
+                self.growthRate = newUAL * 100 / self.liability
             else:
                 self.growthRate = 0
         self.growthRate = round(self.growthRate, 2)
         self.ual = newUAL
+        if prof is not None:
+            prof.record(self.currentYear, "earnings", t)
+
+    def updateUALScenarios(self):
+        """The UAL and its growth rate for every investment scenario."""
+        newUAL = np.maximum(self.liability - self.assets - self.payGo, 0)
+        growth = np.divide((newUAL - self.ual) * 100, self.ual, out=newUAL * 100 / self.liability,
+                           where=self.ual != 0)
+        self.growthRate = np.round(growth, 2)
+        self.ual = newUAL
 
     def adjustEmployment(self, N):
         """Adjust employment up or down."""
@@ -95,40 +251,97 @@ class pensPlan(object):
             self.population.layoffMembers(-N)
 
 
+def recordYear(d, p):
+    """Appends the plan's values for the year to runModel's data."""
+    d["UAL"].append(p.ual)
+    d["Assets"].append(p.assets)
+    d["Liability"].append(p.liability)
+    d["UAL Growth(%)"].append(p.growthRate)
+    d["Active Members"].append(p.population.countStatus("active"))
+    d["Retired Members"].append(p.population.countStatus("retired"))
+    d["Avg. Service"].append(round(p.population.getAvgService()))
+    d["Contribution Rate"].append(p.cr)
+    d["payGo"].append(p.payGo)
+    d["Total Salary"].append(p.totalPay)
+
+
 def runModel(volatility, employmentGrowth=1.0, discountRate=0.07, funds=0.75, premiums=1.0, years=40, saveFiles=False,
-             filename="plotly_graph"):
-    # Create Plan and dictionary to keep track of annual data
-    d = {}
-    p = pensPlan(2000, volatility, employmentGrowth, discountRate, funds, premiums)
-
-    d["UAL"] = [p.ual]
-    d["Assets"] = [p.assets]
-    d["Liability"] = [p.liability]
-    d["UAL Growth(%)"] = [round(p.growthRate, 2)]
-    d["Active Members"] = [sum([m.status == 'active' for m in p.population.members])]
-    d["Retired Members"] = [sum([m.status == 'retired' for m in p.population.members])]
-    d["Avg. Service"] = [round(p.population.getAvgService())]
-    d["Contribution Rate"] = [p.cr]
-    d["payGo"] = [p.payGo]
-    d["Total Salary"] = [p.totalPay]
+             filename="plotly_graph", engine="members", seed=None, scenarios=None, cola=1.02, benefitMultiplier=None,
+             salaryScale=1.0, mortalityFudge=1.0, antithetic=False, profile=None, sampleSize=100, start=None,
+             checkpoint=None, checkpointEvery=10, snapshots=None, assumptions=None):
+    # Profiling is off unless profile is a pensProfile or True (make a new one).  The profile comes back in
+    # d["profile"], which is not a yearly metric.
+    if profile is True:
+        profile = pensProfile()
+
+    # A run can pick up where a checkpoint (or a fork of one) left off: start is a (plan, data) pair, or checkpoint
+    # the path of a file saved every checkpointEvery years.  A checkpoint holds the arguments of its run, and one
+    # left by a run stopped part way is resumed if they match this call's (and refused if not).  Once a run reaches
+    # years its checkpoint is marked finished and isn't resumed again; pass it as start to carry it on.  Either way
+    # the run goes on to years in all, and with start the arguments that built the plan are ignored.
+    study = None
+    if checkpoint is not None:
+        seedKey = seed
+        if isinstance(seed, np.random.SeedSequence):
+            seedKey = (seed.entropy, tuple(seed.spawn_key))
+        study = dict(volatility=list(volatility), employmentGrowth=employmentGrowth, discountRate=discountRate,
+                     funds=funds, premiums=premiums, engine=engine, seed=seedKey, scenarios=scenarios, cola=cola,
+                     benefitMultiplier=benefitMultiplier, salaryScale=salaryScale, mortalityFudge=mortalityFudge,
+                     antithetic=antithetic, sampleSize=sampleSize,
+                     assumptions=assumptions.spec if isinstance(assumptions, pensAssumptions) else assumptions)
+    if start is None and checkpoint is not None and os.path.exists(checkpoint):
+        state = readState(checkpoint)
+        if state.get("study") != study:
+            raise ValueError("%s is a checkpoint of a different run" % checkpoint)
+        if not state.get("finished"):
+            start = (state["plan"], state["data"])
+
+    if start is not None:
+        p, d = start
+        d = {key: list(value) for key, value in d.items()}
+        profile = p.profile
+    else:
+        # Create Plan and dictionary to keep track of annual data
+        d = {metric: [] for metric in modelMetrics}
+        p = pensPlan(2000, volatility, employmentGrowth, discountRate, funds, premiums, engine, seed=seed,
+                     scenarios=scenarios, cola=cola, benefitMultiplier=benefitMultiplier, salaryScale=salaryScale,
+                     mortalityFudge=mortalityFudge, antithetic=antithetic, profile=profile, sampleSize=sampleSize,
+                     snapshots=snapshots, assumptions=assumptions)
+        recordYear(d, p)
 
     # Run model for several years, saving data along the way
-    for year in range(years):
+    for year in range(len(d["UAL"]) - 1, years):
         p.advanceOneYear()
-        d["UAL"].append(p.ual)
-        d["Assets"].append(p.assets)
-        d["Liability"].append(p.liability)
-        d["UAL Growth(%)"].append(round(p.growthRate, 2))
-        d["Active Members"].append(sum([m.status == 'active' for m in p.population.members]))
-        d["Retired Members"].append(sum([m.status == 'retired' for m in p.population.members]))
-        d["Avg. Service"].append(round(p.population.getAvgService()))
-        d["Contribution Rate"].append(p.cr)
-        d["payGo"].append(p.payGo)
-        d["Total Salary"].append(p.totalPay)
-
-    # Stops here if you're not trying to save the data visualization.
-    if not saveFiles:
-        return d
+        if profile is not None:
+            t = profile.clock()
+        recordYear(d, p)
+        if profile is not None:
+            profile.record(p.currentYear, "reporting", t)
+        if checkpoint is not None and (year + 1) % checkpointEvery == 0 and year + 1 < years:
+            saveCheckpoint(checkpoint, p, d, study)
+    if checkpoint is not None:
+        saveCheckpoint(checkpoint, p, d, study, finished=True)
+
+    # With investment scenarios, every value is a NumPy array: (years + 1) for the population-side values and
+    # (years + 1) x scenarios for the fund-side ones.  The saved files show the mean over scenarios.
+    if scenarios:
+        d = {key: np.array(value) for key, value in d.items()}
+        if saveFiles:
+            saveModelRun({key: value.mean(axis=1) if value.ndim == 2 else value for key, value in d.items()},
+                         employmentGrowth, discountRate, funds, years, filename)
+    elif saveFiles:
+        saveModelRun(d, employmentGrowth, discountRate, funds, years, filename)
+
+    if profile is not None:
+        profile.finish()
+        d["profile"] = profile
+    return d
+
+
+def saveModelRun(d, employmentGrowth, discountRate, funds, years, filename):
+    """Saves one run's data from runModel as a CSV file and a plotly graph."""
+    import pandas as pd
+    import plotly.express as px
 
     # Convert dictionary data into a DataFrame, used to create the graph.
     df = pd.DataFrame(data=d, index=range(2000, (2001 + years)))
@@ -161,12 +374,29 @@ def runModel(volatility, employmentGrowth=1.0, discountRate=0.07, funds=0.75, pr
     df.to_csv(csv_directory)
     fig.write_html(directory)
 
-    return d
+
+def initWorker(discountRate=0.07, cola=1.02):
+    """Loads the mortality, annuity and age-service tables once in a pool
+    worker, so the replications it runs don't each have to."""
+    for mortalityClass in pensMort.sheets:
+        for sex in ("F", "M"):
+            pensAnnuity.get(sex, mortalityClass, 1 + discountRate, cola)
+    getAgeServiceTable()
+
+
+def runReplication(task):
+    """Runs one replication of runModel with its own random stream.  The
+    task is a (runModel arguments, SeedSequence) pair."""
+    kwargs, seedSeq = task
+    return runModel(seed=seedSeq, **kwargs)
 
 
 def getModelData(volatility, employmentGrowth, discountRate=0.07, funds=0.75, premiums=1.0, size=50, years=100,
                  saveAll=True,
-                 filename="data_1"):
+                 filename="data_1", engine="members", workers=1, seed=None, keepRuns=False,
+                 quantiles=(0.05, 0.5, 0.95), store=None, cola=1.02, benefitMultiplier=None, salaryScale=1.0,
+                 mortalityFudge=1.0, profile=False, sampleSize=100, checkpoint=None, checkpointEvery=10,
+                 snapshots=None, assumptions=None, returnStats=False):
     # Create directory for data visualization, if necessary.
     folder = "eg=%s_dr=%s_f=%s" % (str(employmentGrowth), str(discountRate), str(funds))
     if not os.path.exists('Graphs/%s' % folder):
@@ -190,6 +420,22 @@ def getModelData(volatility, employmentGrowth, discountRate=0.07, funds=0.75, pr
             filename = "%s_%s" % (temp, str(count))
             directory = "Graphs/%s/%s.html" % (folder, filename)
 
+    # With a store (the path of a study file, see pensStore), every run's yearly values are appended to it under a
+    # partition named for this parameter set, instead of going into a CSV and HTML file per run.  The partition
+    # name is the folder plus a digest of all the params, so different parameter sets never share one.
+    writer = None
+    if store is not None:
+        if isinstance(assumptions, pensAssumptions):
+            assumptionName = assumptions.source or assumptions.spec
+        else:
+            assumptionName = assumptions
+        params = dict(volatility=list(volatility), employmentGrowth=employmentGrowth, discountRate=discountRate,
+                      funds=funds, premiums=premiums, years=years, engine=engine, seed=seed, cola=cola,
+                      benefitMultiplier=benefitMultiplier, salaryScale=salaryScale, mortalityFudge=mortalityFudge,
+                      sampleSize=sampleSize, assumptions=assumptionName)
+        writer = pensResultWriter(store, partitionName(folder, params), modelMetrics, years + 1, params)
+        saveAll = False
+
     # If you wish to visualize the data of each individual model, in addition to the mean data...
     if saveAll:
         # Create a folder to hold individual model graphs, based on the mean data filename
@@ -197,73 +443,127 @@ def getModelData(volatility, employmentGrowth, discountRate=0.07, funds=0.75, pr
             os.makedirs('Graphs/%s/%s' % (folder, filename))
 
         # All individual model graphs will be named graph_1, graph_2, graph_3, etc. and placed within the above folder
-        # (The numbers are added within the runModel() function.)
+        # (The numbers are added within the saveModelRun() function.)
         subdir = "%s/model" % filename
 
     else:
         subdir = None
 
-    # Create list to store the data from each run.
+    args = dict(volatility=volatility, employmentGrowth=employmentGrowth, discountRate=discountRate, funds=funds,
+                premiums=premiums, years=years, engine=engine, cola=cola, benefitMultiplier=benefitMultiplier,
+                salaryScale=salaryScale, mortalityFudge=mortalityFudge, profile=profile or None, sampleSize=sampleSize,
+                snapshots=snapshots, assumptions=assumptions)
+
+    # With a checkpoint path, the statistics gathered so far are saved there every checkpointEvery replications,
+    # and a later call with the same arguments carries on from the last one saved.  The root seed's entropy is
+    # saved too, so the remaining replications get the streams they would have had.
+    study = dict(args, size=size, quantiles=list(quantiles), keepRuns=keepRuns, seed=seed)
+    state = None
+    if checkpoint is not None and os.path.exists(checkpoint):
+        state = readState(checkpoint)
+        if state["study"] != study:
+            raise ValueError("%s is a checkpoint of a different study" % checkpoint)
+        print("Resuming from %s: %d of %d models already run." % (checkpoint, state["runStats"].n, size))
+
+    # Each replication gets its own random stream, spawned from the seed, so the
+    # results don't depend on how many workers ran them.
+    rootSeed = np.random.SeedSequence(seed if state is None else state["entropy"])
+    seeds = rootSeed.spawn(size)
+
+    # Each run is folded into running per-year statistics as it arrives.  The runs themselves are only kept if
+    # keepRuns is set.
+    runStats = pensRunStats(modelMetrics, years + 1, quantiles, seed=rootSeed.spawn(1)[0])
     model_data = []
+    # With profile set, every run is profiled and the profiles are merged into one.
+    runProfile = None
+    if state is not None:
+        runStats, model_data, runProfile = state["runStats"], state["runs"], state["profile"]
+    tasks = [(args, s) for s in seeds[runStats.n:]]
+
+    # The writer flushes on its own every chunkSize runs, so the store can hold runs past the last checkpoint.  The
+    # checkpoint records how many runs the partition held when it was saved, and on resume the replications already
+    # in the store beyond that are rerun (to rebuild the statistics) but not appended again.
+    skipStored = 0
+    if state is not None and writer is not None and state.get("stored") is not None:
+        skipStored = max(0, writer.stored() - state["stored"])
+
+    def save():
+        stored = None
+        if writer is not None:
+            writer.flush()
+            stored = writer.stored()
+        writeState(checkpoint, {"study": study, "entropy": rootSeed.entropy, "runStats": runStats,
+                                "runs": model_data, "profile": runProfile, "stored": stored})
+
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(workers, initializer=initWorker, initargs=(discountRate, cola))
+        runs = pool.map(runReplication, tasks)
+    else:
+        runs = map(runReplication, tasks)
 
-    for i in range(size):
-        # Run the model, then append the resulting dictionary to the list.
-        # Set saveAll to True if you want to save individual run visualizations.
-
-        try:
-            model_data.append(
-                runModel(volatility, employmentGrowth, discountRate, funds, premiums, years, saveFiles=saveAll,
-                         filename=subdir))
-        except:
-            print("An error occurred while running models.\n%s out of %s models completed." % (str(i), str(size)))
-            raise
+    # Runs come back in replication order whether or not they ran in parallel.
+    # Individual run visualizations are saved here, rather than by the workers.
+    try:
+        for d in runs:
+            if profile:
+                if runProfile is None:
+                    runProfile = d.pop("profile")
+                else:
+                    runProfile.merge(d.pop("profile"))
+            runStats.add(d)
+            if keepRuns:
+                model_data.append(d)
+            if skipStored > 0:
+                skipStored -= 1
+            elif writer is not None:
+                writer.add(d)
+            if saveAll:
+                saveModelRun(d, employmentGrowth, discountRate, funds, years, subdir)
+            if checkpoint is not None and runStats.n % checkpointEvery == 0:
+                save()
+    except:
+        print("An error occurred while running models.\n%s out of %s models completed." % (str(runStats.n),
+                                                                                         str(size)))
+        if checkpoint is not None:
+            save()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        if writer is not None:
+            writer.flush()
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
 
     print("\nFinished running models. Averaging the data...\n")
 
     # Find the mean values across all runs and visualize them, to see overall shape of the data w/ the given parameters.
-    mean_data = {"UAL": [], "Assets": [], "Liability": [], "UAL Growth(%)": [], "Active Members": [],
-                 "Retired Members": [],
-                 "Avg. Service": [], "Contribution Rate": [], "payGo": [], "Total Salary": []}
-    for i in range(years):
-        m_ual = [run["UAL"][i] for run in model_data]
-        m_assets = [run["Assets"][i] for run in model_data]
-        m_liability = [run["Liability"][i] for run in model_data]
-        m_growth = [run["UAL Growth(%)"][i] for run in model_data]
-        m_active = [run["Active Members"][i] for run in model_data]
-        m_retired = [run["Retired Members"][i] for run in model_data]
-        m_service = [run["Avg. Service"][i] for run in model_data]
-        m_cr = [run["Contribution Rate"][i] for run in model_data]
-        m_payGo = [run["payGo"][i] for run in model_data]
-        m_salary = [run["Total Salary"][i] for run in model_data]
-
-        ual = round(stats.mean(m_ual), 2)
-        assets = round(stats.mean(m_assets), 2)
-        liability = round(stats.mean(m_liability), 2)
-        growth = round(stats.mean(m_growth), 2)
-        active = round(stats.mean(m_active))
-        retired = round(stats.mean(m_retired))
-        service = round(stats.mean(m_service))
-        cr = round(stats.mean(m_cr), 2)
-        payGo = round(stats.mean(m_payGo), 2)
-        salary = round(stats.mean(m_salary), 2)
-
-        mean_data["UAL"].append(ual)
-        mean_data["Assets"].append(assets)
-        mean_data["Liability"].append(liability)
-        mean_data["UAL Growth(%)"].append(round(growth, 2))
-        mean_data["Active Members"].append(active)
-        mean_data["Retired Members"].append(retired)
-        mean_data["Avg. Service"].append(service)
-        mean_data["Contribution Rate"].append(cr)
-        mean_data["payGo"].append(payGo)
-        mean_data["Total Salary"].append(salary)
+    # Headcounts and service are reported as whole numbers.
+    mean_data = {}
+    for i, metric in enumerate(modelMetrics):
+        digits = None if metric in ("Active Members", "Retired Members", "Avg. Service") else 2
+        mean_data[metric] = [round(float(m), digits) for m in runStats.mean[i][:years]]
 
     print("Model data successfully averaged!")
+    import pandas as pd
+    import plotly.express as px
+
     # Convert dictionary data into a DataFrame, used to create the graph.
     df = pd.DataFrame(data=mean_data, index=range(2000, (2000 + years)))
     csv_directory = "Graphs/%s/%s.csv" % (folder, filename)
     df.to_csv(csv_directory)
 
+    # The spread across runs (sd, min, max and quantiles) goes in a second file.
+    stats_directory = "Graphs/%s/%s_stats.csv" % (folder, filename)
+    runStats.toDataFrame(2000).to_csv(stats_directory)
+
+    if runProfile is not None:
+        runProfile.toJSON("Graphs/%s/%s_profile.json" % (folder, filename))
+        runProfile.writeTable("Graphs/%s/%s_profile.csv" % (folder, filename))
+        runProfile.report()
+
     # Print the DataFrame, visible in console as a table.
     # print(df)
 
@@ -271,8 +571,13 @@ def getModelData(volatility, employmentGrowth, discountRate=0.07, funds=0.75, pr
     fig = px.line(df)
     fig.write_html(directory)
     # HTML files can be opened to view interactive plotly visualization.
-    print("Data visualization saved at %s\nCSV file saved at %s" % (directory, csv_directory))
+    print("Data visualization saved at %s\nCSV files saved at %s and %s" % (directory, csv_directory,
+                                                                           stats_directory))
 
+    # The pensRunStats (spread and quantiles across runs) only comes back if asked for, so callers unpacking
+    # [mean_data, model_data] keep working.
+    if returnStats:
+        return [mean_data, model_data, runStats]
     return [mean_data, model_data]
 
 
@@ -311,4 +616,15 @@ if __name__ == "__main__":
 
     getModelData(vol, eg, dr, f, size, years, filename=name)
 
+    ## With a seed, the runs don't depend on how many workers ran them.
+    serial = getModelData(vol, eg, dr, f, p, 4, years, saveAll=False, filename=name, engine="array", seed=1)
+    parallel = getModelData(vol, eg, dr, f, p, 4, years, saveAll=False, filename=name, engine="array", seed=1,
+                            workers=2)
+    assert serial[0] == parallel[0]
+
+    ## A seeded run can be repeated exactly, for either engine.
+    for engine in ("members", "array"):
+        assert runModel(vol, years=years, seed=2, engine=engine) == runModel(vol, years=years, seed=2, engine=engine)
+        assert runModel(vol, years=years, seed=2, engine=engine) != runModel(vol, years=years, seed=3, engine=engine)
+
     print("\nFinished %s tests!" % name)
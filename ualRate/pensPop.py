@@ -1,86 +1,21 @@
 #!/usr/bin/env python3
-import random
-from collections import deque
+import heapq
 import numpy as np
-import pandas as pd
-import openpyxl
-from pathlib import Path
 from copy import deepcopy
-from matplotlib import pyplot as plt
-
-
-class pensMort:
-    def __init__(self, sex, mortalityClass):
-        self.sex = sex
-        self.mortalityClass = mortalityClass
-
-        ## ET: import mortality table
-        m_file = Path("..", "mortalityTables", "pub-2010-headcount-mort-rates.xlsx")
-        m_wb = openpyxl.load_workbook(m_file)
-        pubG = m_wb["PubG.H-2010"]
-
-        if self.mortalityClass == "General":
-            pubG = m_wb["PubG.H-2010"]
-
-        if self.mortalityClass == "Safety":
-            pubG = m_wb["PubS.H-2010"]
-
-        ## ET: convert excel into a dataframe
-        df_pubG = pd.DataFrame(pubG.values)
-        ## ET: clean data frame (i.e. remove extra empty columns, reset index)
-        df_pubG = df_pubG.drop(df_pubG.index[range(3)])
-        df_pubG = df_pubG.drop(labels=[0, 2], axis=1).reset_index()
-
-        self.data = df_pubG
-        self.mortTable = self.getMortalityTables()
-        m_wb.close()
-
-    def getMortalityTables(self):
-        ## ET: convert data frame into dictionary
-        ## index: age (number)
-        ## key: mortality rate of employee(0 position), healthy retiree(1), disabled retiree(2), contingent survivor(3)(list of numbers)
-        ## split into two dictionaries, one for female, one for male
-
-        temp = {}
-        if self.sex == "F":
-            df_pubG = self.data.drop(self.data.iloc[:, 6:20], axis=1)
-            df_pubG = df_pubG.rename(columns=df_pubG.iloc[1])
-
-            df_pubG[
-                ["Healthy Retiree", "Disabled Retiree", "Contingent Survivor"]
-            ] = df_pubG[
-                ["Healthy Retiree", "Disabled Retiree", "Contingent Survivor"]
-            ].fillna(
-                value=0
-            )
-
-            for index, row in df_pubG.iterrows():
-                temp[row["Age"]] = [
-                    row["Employee"],
-                    row["Healthy Retiree"],
-                    row["Disabled Retiree"],
-                    row["Contingent Survivor"],
-                ]
-            return temp
-
-        elif self.sex == "M":
-            df_pubG = self.data.iloc[:, np.r_[1, 7:11]].reset_index()
-            df_pubG = df_pubG.rename(columns=df_pubG.iloc[1])
-            df_pubG[
-                ["Healthy Retiree", "Disabled Retiree", "Contingent Survivor"]
-            ] = df_pubG[
-                ["Healthy Retiree", "Disabled Retiree", "Contingent Survivor"]
-            ].fillna(
-                value=0
-            )
-            for index, row in df_pubG.iterrows():
-                temp[row["Age"]] = [
-                    row["Employee"],
-                    row["Healthy Retiree"],
-                    row["Disabled Retiree"],
-                    row["Contingent Survivor"],
-                ]
-            return temp
+from pensTables import pensMort
+from pensAssumptions import pensAssumptions, maxAge, maxService
+from pensValuation import (
+    pensAnnuity,
+    pensDecrements,
+    pensBenefitFlows,
+    pensLiabilityCache,
+    pensLiabilityTracker,
+)
+from pensCensus import statusNames, sexNames, drawCells, drawCensus
+from pensSalary import pensSalaryHistory
+
+## Random stream for members and populations created without one.
+defaultRng = np.random.default_rng()
 
 
 class pensMember(object):
@@ -95,7 +30,18 @@ class pensMember(object):
         tier="1",
         status="active",
         id="*",
+        rng=None,
+        benefitMultiplier=None,
+        salaryScale=1.0,
+        mortalityFudge=1.0,
+        assumptions=None,
     ):
+        # A numpy.random.Generator, usually shared with the population.
+        self.rng = rng if rng is not None else defaultRng
+        # The decrement and salary tables (a pensAssumptions, or the name
+        # of one), and this member's tier in them.
+        self.assumptions = pensAssumptions.get(assumptions)
+        self.tierIndex = self.assumptions.tierIndex(tier)
         self.age = age
         self.sex = sex
         self.salary = salary
@@ -108,100 +54,61 @@ class pensMember(object):
         self.birthYear = currentYear - age
         self.retireYear = 0
         self.hireYear = currentYear - service
-        self.pension = self.salary * 0.55
+        # Pension as a fraction of salary.
+        if benefitMultiplier is None:
+            benefitMultiplier = self.assumptions.benefitMultiplier
+        self.benefitMultiplier = benefitMultiplier
+        # Multiplies the raise from projectSalaryDelta.
+        self.salaryScale = salaryScale
+        # Multiplies the mortality rates; see pensMort.get.
+        self.mortalityFudge = mortalityFudge
+        self.pension = self.salary * benefitMultiplier
         self.cola = 1.025  # inflation, set to 1 to neutralize
-        self.mortDict = 0
-        self.yearSalaryDict = {}
-        self.salaryHistory = deque([salary])
-        self.simulateCareerBackward()
+        self.mortTable = None
+        # This member's row in the population's salary history; see
+        # pensSalaryHistory.
+        self.slot = None
         self.getMortTable()
 
         if self.id == "*":
-            self.id = "%0.6x" % random.randint(1, pow(16, 6))
-
-    def simulateCareerBackward(self):
-        """Takes the current salary and service and projects a salary
-        history backwards using the salaryGrowth value."""
-
-        year = self.currentYear
-
-        if self.service > 1:
-            for iyear in range(
-                self.currentYear - 1, self.currentYear - self.service, -1
-            ):
-                self.yearSalaryDict[year] = (
-                    self.salaryHistory[0] / self.projectSalaryDelta()
-                )
-                year = year - 1
-
-        ## That first year was probably not a complete year.  Roll
-        ## some dice and pick a random fraction of the year.
-        self.salaryHistory[0] = random.random() * self.salaryHistory[0]
+            self.id = "%0.6x" % self.rng.integers(1, pow(16, 6), endpoint=True)
 
     def projectSalaryDelta(self):
         """Uses the age, service, and tier to project the change in pay
         between one year and the next."""
 
-        ## These are typical values scrounged from a valuation report
-        ## for a fire department in Arizona.  (For which service and
-        ## tier are not relevant.)
-        if self.age < 25:
-            out = 1.075
-        elif self.age >= 25 and self.age < 30:
-            out = 1.0735
-        elif self.age >= 30 and self.age < 35:
-            out = 1.0674
-        elif self.age >= 35 and self.age < 40:
-            out = 1.0556
-        elif self.age >= 40 and self.age < 45:
-            out = 1.0446
-        elif self.age >= 45 and self.age < 50:
-            out = 1.0374
-        elif self.age >= 50:
-            out = 1.035
+        ## The raises come from the assumption set; the default one's
+        ## are typical values scrounged from a valuation report for a
+        ## fire department in Arizona.
+        out = float(self.assumptions.raises[min(self.age, maxAge)])
 
         # out -= 0.035 #to set inflation to 0
 
+        if self.salaryScale != 1.0:
+            out = 1 + self.salaryScale * (out - 1)
         return out
 
     def applyPensionCOLA(self):
         self.pension *= self.cola
 
-    def doesMemberSeparate(self):
-        """TBD: Does member leave employment?"""
+    def doesMemberSeparate(self, draw=None):
+        """TBD: Does member leave employment?  The uniform draw can be
+        supplied by the caller; otherwise it comes from self.rng."""
         if self.status != "active":
             return False
-        rates = [
-            0.070,
-            0.045,
-            0.037,
-            0.030,
-            0.025,
-            0.017,
-            0.017,
-            0.017,
-            0.017,
-            0.015,
-            0.011,
-            0.007,
-            0.007,
-            0.007,
-            0.006,
-            0.005,
-            0.005,
-            0.004,
-            0.004,
-            0.004,
-        ]
 
-        service = min(self.service, 20)
-        if random.random() < rates[service - 1]:
+        rate = self.assumptions.separation[self.tierIndex, min(self.service, maxService)]
+        if draw is None:
+            draw = self.rng.random()
+        if draw < rate:
             return True
         else:
             return False
 
-    def doesMemberRetire(self):
-        """TBD: What it sounds like"""
+    def doesMemberRetire(self, draw=None):
+        """TBD: What it sounds like.  The assumption set combines all the
+        retirement rules into one chance, tested against a uniform draw
+        that can be supplied by the caller."""
         if (
             self.status == "retired"
             or self.status == "deceased"
@@ -209,67 +116,44 @@ class pensMember(object):
         ):
             return False
 
-        if self.age >= 62 and self.service >= 15:
-            if (
-                (self.age == 62 and random.random() > 0.4)
-                or (self.age > 62 and self.age < 70 and random.random() > 0.5)
-                or (self.age >= 70)
-            ):
-                return True
-            elif self.service >= 20:
-                rates = [
-                    0.14,
-                    0.14,
-                    0.07,
-                    0.07,
-                    0.07,
-                    0.22,
-                    0.26,
-                    0.19,
-                    0.32,
-                    0.30,
-                    0.30,
-                    0.30,
-                    0.55,
-                    0.55,
-                    1.00,
-                ]
-                service = min(self.service, 34)
-                if random.random() < rates[service - 20]:
-                    return True
-        return False
+        rate = self.assumptions.retirement[
+            self.tierIndex, min(self.age, maxAge), min(self.service, maxService)
+        ]
+        if rate == 0:
+            return False
+        if draw is None:
+            draw = self.rng.random()
+        return bool(draw < rate)
 
     def getMortTable(self):
-        """determine with mortality dictionary to use based on pensMember sex and mortality class"""
-        if self.sex == "F":
-            if self.mortalityClass == "General":
-                self.mortDict = pensMort("F", "General").mortTable
-            if self.mortalityClass == "Safety":
-                self.mortDict = pensMort("F", "Safety").mortTable
-
-        elif self.sex == "M":
-            if self.mortalityClass == "General":
-                self.mortDict = pensMort("M", "General").mortTable
-            if self.mortalityClass == "Safety":
-                self.mortDict = pensMort("M", "Safety").mortTable
-
-    def doesMemberDie(self):
+        """Look up the shared mortality table for this member's sex and
+        mortality class."""
+        self.mortTable = pensMort.get(
+            self.sex, self.mortalityClass, fudge=self.mortalityFudge
+        )
+
+    def doesMemberDie(self, draw=None):
         """TBD: Check if member dies"""
 
+        if draw is None:
+            draw = self.rng.random()
+
         if self.status == "active":
-            if random.random() < self.mortDict[self.age][0]:
+            if draw < self.mortTable.rate(self.age, 0):
                 return True
 
         ## ET: Assuming every retiree is healthy for now
         elif self.status == "retired":
-            if random.random() < self.mortDict[self.age][1]:
+            if draw < self.mortTable.rate(self.age, 1):
                 return True
         elif self.status == "deceased":
             return True
 
-    def ageOneYear(self):
+    def ageOneYear(self, draws=None):
         """TBD: Age a year, get a raise, decide whether to separate or retire.
-        Maybe die.  Change status and salary accordingly."""
+        Maybe die.  Change status and salary accordingly.  The three uniform
+        draws for separation, retirement and death can be passed in, e.g.
+        as a row of a block drawn for the whole population."""
 
         # Should members' salary and service increase before or after separation/retire checks?
         # If a person retires, should their service and salary not increase for that year? Or would it increase for the year and then stop?
@@ -277,6 +161,9 @@ class pensMember(object):
         ## ET: Check for a change of status, then adjust the salary if
         ## it's still relevant.
 
+        if draws is None:
+            draws = self.rng.random(3).tolist()
+
         self.currentYear += 1
 
         if self.status != "deceased":
@@ -285,18 +172,17 @@ class pensMember(object):
         if self.status == "active":
             self.service += 1
             self.salary *= self.projectSalaryDelta()
-            self.yearSalaryDict[self.currentYear] = self.salary
-            self.pension = self.yearSalaryDict[self.currentYear] * 0.55
+            self.pension = self.salary * self.benefitMultiplier
 
-            if self.doesMemberSeparate():
+            if self.doesMemberSeparate(draws[0]):
                 self.status = "separated"
                 self.salary = 0
-            elif self.doesMemberRetire():
+            elif self.doesMemberRetire(draws[1]):
                 self.status = "retired"
                 self.retireYear = self.currentYear
                 self.salary = 0
 
-        if self.doesMemberDie():
+        if self.doesMemberDie(draws[2]):
             self.status = "deceased"
             self.salary = 0
 
@@ -315,21 +201,72 @@ class pensMember(object):
 #        self.pension = 0
 #        self.cola = 1.025
 #        self.discountrate = 1.07
-#        self.mortDict = 0
 #        self.salaryHistory = deque([salary])
 #        self.simulateCareerBackward()
 #        self.getMortSex()
 
 
 class pensPop(object):
-    def __init__(self, members=[], discountRate=0.07):
-        # A list of member objects.
-        self.members = members
+    def __init__(
+        self,
+        members=None,
+        discountRate=0.07,
+        valuation="expected",
+        cacheSize=4096,
+        rng=None,
+        sampleSize=100,
+        cola=1.02,
+        benefitMultiplier=None,
+        salaryScale=1.0,
+        mortalityFudge=1.0,
+        decrementSeed=None,
+        census=None,
+        assumptions=None,
+    ):
+        # A list of member objects.  Only active and retired members are
+        # kept here; separated and deceased ones move to the archive.
+        self.members = [] if members is None else members
+        self.archive = []
+        self.archiveCounts = {}
+        # The numpy.random.Generator for this population and its members.
+        self.rng = rng if rng is not None else np.random.default_rng()
+        # A SeedSequence for the yearly decrement draws; see decrementRng.
+        self.decrementSeed = decrementSeed
         self.startingSalary = 50000
         self.avgAge = 30
-        self.sampleSize = 100
-        self.simulatePopulation()
+        self.sampleSize = sampleSize
         self.discount = 1 + discountRate
+        # Valuation COLA, and the member assumptions passed on to
+        # pensMember; the sensitivity tests vary these.  The benefit
+        # multiplier defaults to the assumption set's.
+        self.cola = cola
+        self.assumptions = pensAssumptions.get(assumptions)
+        if benefitMultiplier is None:
+            benefitMultiplier = self.assumptions.benefitMultiplier
+        self.benefitMultiplier = benefitMultiplier
+        self.salaryScale = salaryScale
+        self.mortalityFudge = mortalityFudge
+        # Everyone's recent salaries, for final-average benefit formulas.
+        self.salaries = pensSalaryHistory(salaryScale=salaryScale, assumptions=self.assumptions)
+        self.assignSlots(self.members)
+        # Indexes of self.members, kept up to date as members come, go
+        # and change status, so counts and selections don't scan the
+        # list.  Every member ages a year at a time, so age buckets are
+        # keyed by age minus the years advanced, which doesn't change.
+        self.statusCounts = {}
+        self.activeService = 0
+        self.ageBuckets = {}
+        self.yearsAdvanced = 0
+        self.indexMembers(self.members)
+        # "expected" values liabilities from the decrement probabilities,
+        # "simulate" from one simulated life per member, "incremental"
+        # keeps the expected value up to date with a pensLiabilityTracker.
+        self.valuation = valuation
+        self.tracker = None
+        # Unit liabilities by member state, for the "expected" valuation.
+        # A cacheSize of 0 turns the cache off.
+        self.liabilityCache = pensLiabilityCache(cacheSize) if cacheSize else None
+        self.simulatePopulation(census)
 
     def simulateMembers(
         self,
@@ -344,195 +281,143 @@ class pensPop(object):
     ):
         """Generates N member objects with randomly distributed ages and
         services.  Sex is random, too, unless it's specified."""
-        out = []
-        for i in range(0, int(N)):
-            if sex == "*":
-                if random.random() > 0.5:
-                    chosenSex = "M"
-                else:
-                    chosenSex = "F"
-            else:
-                chosenSex = sex
-
-            out.append(
-                pensMember(
-                    random.randint(ageRange[0], ageRange[1]),
-                    chosenSex,
-                    random.randint(serviceRange[0], serviceRange[1]),
-                    np.random.normal(avgSalary, avgSalary / 15),
-                    2021,
-                    mortalityClass=mortalityClass,
-                    tier=tier,
-                    status=status,
-                )
-            )
+        N = int(N)
+        columns = drawCells(
+            self.rng, [N], ageRange[0], ageRange[1],
+            serviceRange[0], serviceRange[1], avgSalary,
+        )
+        return self.membersFromColumns(columns, mortalityClass, tier, status, sex)
 
-        return out
+    def membersFromColumns(
+        self, columns, mortalityClass="General", tier="1", status="active", sex="*"
+    ):
+        """Builds member objects from a dict of drawn age, service, sex
+        and salary columns (and optionally status), as made by the
+        pensCensus functions."""
+        N = len(columns["age"])
+        ages = columns["age"].tolist()
+        services = columns["service"].tolist()
+        salaries = columns["salary"].tolist()
+        if sex == "*":
+            sexes = np.take(sexNames, columns["sex"]).tolist()
+        else:
+            sexes = [sex] * N
+        if "status" in columns:
+            statuses = np.take(statusNames, columns["status"]).tolist()
+        else:
+            statuses = [status] * N
+        if "id" in columns:
+            ids = columns["id"].tolist()
+        else:
+            ids = self.rng.integers(1, pow(16, 6), N, endpoint=True).tolist()
+
+        return [
+            pensMember(
+                ages[i],
+                sexes[i],
+                services[i],
+                salaries[i],
+                2021,
+                mortalityClass=mortalityClass,
+                tier=tier,
+                status=statuses[i],
+                id="%0.6x" % ids[i],
+                rng=self.rng,
+                benefitMultiplier=self.benefitMultiplier,
+                salaryScale=self.salaryScale,
+                mortalityFudge=self.mortalityFudge,
+                assumptions=self.assumptions,
+            )
+            for i in range(N)
+        ]
 
     def estimateSalary(self, serviceYears):
         """Estimates a starting salary in 2020 dollars."""
 
         if serviceYears <= 15:
-            salary = 51000 + serviceYears * 1600 + np.random.normal(0, 2500)
+            salary = 51000 + serviceYears * 1600 + self.rng.normal(0, 2500)
         elif serviceYears <= 25:
             salary = (
                 self.estimateSalary(15)
                 + (serviceYears - 15) * 800
-                + np.random.normal(0, 2500)
+                + self.rng.normal(0, 2500)
             )
         else:
-            salary = self.estimateSalary(25) + (serviceYears - 25) * np.random.normal(
+            salary = self.estimateSalary(25) + (serviceYears - 25) * self.rng.normal(
                 500, 100
             )
         return salary
 
-    def simulatePopulation(self):
+    def simulatePopulation(self, census=None):
         """Generates a collection of plan members.  This can be taken from
-        the table of population demographics in any valuation report."""
-
-        m_file = Path("..", "ageServiceTables", "age-service-distribution.xlsx")
-        m_wb = openpyxl.load_workbook(m_file, data_only=True)
-        asd = m_wb["Cal-T"]
-        m_wb.close()
-        df_asd = pd.DataFrame(asd.values)
-        df_asd = df_asd.rename(columns=df_asd.iloc[0])
-        df_asd = df_asd.set_index("age")
-        total = df_asd["total"]["total"]
-        total_retired = 270835
-        df_asd = df_asd.drop(index=["age", "total"], columns=["total"])
-        df_asd = df_asd.applymap(lambda x: x / total)
-
-        for index, row in df_asd.iterrows():
-            ageR = index.split(",")
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[0]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(0, 1),
-                    avgSalary=self.estimateSalary(1),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[1]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(2, 4),
-                    avgSalary=self.estimateSalary(3),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[2]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(5, 9),
-                    avgSalary=self.estimateSalary(7),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[3]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(10, 14),
-                    avgSalary=self.estimateSalary(12),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[4]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(15, 19),
-                    avgSalary=self.estimateSalary(17),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[5]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(20, 24),
-                    avgSalary=self.estimateSalary(22),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[6]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(25, 29),
-                    avgSalary=self.estimateSalary(27),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[7]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(30, 34),
-                    avgSalary=self.estimateSalary(32),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[8]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(35, 39),
-                    avgSalary=self.estimateSalary(37),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[9]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(40, 44),
-                    avgSalary=self.estimateSalary(42),
-                )
-            )
-
-            self.members.extend(
-                self.simulateMembers(
-                    round(self.sampleSize * row[10]),
-                    ageRange=(int(ageR[0]), int(ageR[1])),
-                    serviceRange=(45, 60),
-                    avgSalary=self.estimateSalary(47),
-                )
-            )
-
-            ## retired members
-        s = np.random.normal(4000, 4000)
-        if s < 2000:
-            s = random.uniform(2000, 4000)
-
-        age_lower = 60
-        age_upper = 65
+        the table of population demographics in any valuation report.
+        The census (drawCensus columns, e.g. from pensSnapshots) is drawn
+        from self.rng unless one is given."""
+        if census is None:
+            census = drawCensus(self.rng, self.sampleSize)
+        self.addMembers(self.membersFromColumns(census))
+
+    def __len__(self):
+        return len(self.members)
+
+    def decrementRng(self):
+        """The generator for this year's decrement draws.  With a
+        decrementSeed, each year gets a fresh child of it, so two
+        populations built from the same seed see the same draws in the
+        same year even once their headcounts differ (common random
+        numbers).  Otherwise the draws come from self.rng."""
+        if self.decrementSeed is None:
+            return self.rng
+        return np.random.default_rng(self.decrementSeed.spawn(1)[0])
+
+    def assignSlots(self, newMembers):
+        """Gives members rows in the salary history."""
+        slots = self.salaries.add(
+            [m.salary for m in newMembers],
+            [m.age for m in newMembers],
+            [m.service for m in newMembers],
+            [m.assumptions for m in newMembers],
+        )
+        for m, slot in zip(newMembers, slots.tolist()):
+            m.slot = slot
 
-        for i in range(10):
+    def finalAverageSalary(self, member):
+        """The member's average salary over their last five years of
+        active service."""
+        return float(self.salaries.finalAverage([member.slot])[0])
 
-            self.members.extend(
-                self.simulateMembers(
-                    round(
-                        self.sampleSize
-                        * ((total_retired / (total + total_retired)) * (0.5 ** i))
-                        * 0.1
-                    ),
-                    ## change 0.93 if you want to change the mortality rate of the reitred population
-                    ageRange=(age_lower, age_upper),
-                    serviceRange=(25, 30),
-                    avgSalary=s,
-                    status="retired",
-                )
-            )
-
-            age_lower += 5
-            age_upper += 5
+    def indexMembers(self, newMembers):
+        for m in newMembers:
+            self.statusCounts[m.status] = self.statusCounts.get(m.status, 0) + 1
+            if m.status == "active":
+                self.activeService += m.service
+            ## A dict rather than a set, to keep the insertion order.
+            self.ageBuckets.setdefault(m.age - self.yearsAdvanced, {})[m] = None
 
-        ## data source: California State Teacher's Retiremenet System (p.75-76)
-        ## https://www.calstrs.com/sites/main/files/file-attachments/db-valuation-2019.pdf
+    def unindexMembers(self, oldMembers):
+        for m in oldMembers:
+            self.statusCounts[m.status] -= 1
+            if m.status == "active":
+                self.activeService -= m.service
+            key = m.age - self.yearsAdvanced
+            del self.ageBuckets[key][m]
+            if not self.ageBuckets[key]:
+                del self.ageBuckets[key]
+
+    def ageCounts(self):
+        """The number of members (not counting the archive) of each age."""
+        return {
+            key + self.yearsAdvanced: len(bucket)
+            for key, bucket in sorted(self.ageBuckets.items())
+        }
+
+    def addMembers(self, newMembers):
+        self.members.extend(newMembers)
+        self.assignSlots(newMembers)
+        self.indexMembers(newMembers)
+        if self.tracker is not None:
+            for m in newMembers:
+                self.tracker.add(m)
 
     def advanceOneYear(self):
         """TBD: Advance the population by a year -- increase everyone's age
@@ -540,25 +425,55 @@ class pensPop(object):
         or separate. """
         retirementBenefit = 0
         replacements = 0
-        for member in self.members:
+        changes = []
+        paid = []
+        ## Every active member gains a year of service, and every live
+        ## one a year of age, which the age buckets' keys allow for.
+        self.activeService += self.statusCounts.get("active", 0)
+        self.yearsAdvanced += 1
+        ## One block of uniform draws per year: separation, retirement
+        ## and death for every member.
+        draws = self.decrementRng().random((len(self.members), 3)).tolist()
+        for member, memberDraws in zip(self.members, draws):
             wasActive = False
             if member.status == "active":
                 wasActive = True
-            member.ageOneYear()
-            if member.status == "retired":
+            oldStatus = member.status
+            member.ageOneYear(memberDraws)
+            if member.status != oldStatus:
+                changes.append((member, oldStatus))
+            if member.status == "active":
+                paid.append(member)
+            elif member.status == "retired":
                 retirementBenefit += member.pension
                 if wasActive:
                     replacements += 1
             elif member.status != "active" and wasActive:
                 replacements += 1
 
+        self.salaries.record(
+            [m.slot for m in paid], [m.salary for m in paid]
+        )
+        for member, oldStatus in changes:
+            self.statusCounts[oldStatus] -= 1
+            self.statusCounts[member.status] = self.statusCounts.get(member.status, 0) + 1
+            if oldStatus == "active":
+                self.activeService -= member.service
+
+        if self.tracker is not None:
+            self.tracker.rollForward()
+            self.tracker.update(changes)
+
+        if changes:
+            self.compact()
+
         return {"benefit": retirementBenefit, "replace": replacements}
 
     def hireReplacements(self, N, pct=1.0):
         """TBD: Replace retired and separated workers to maintain headcount.
         If pct is less than one, only replace that proportion of the retired
         and separated."""
-        self.members.extend(
+        self.addMembers(
             self.simulateMembers(
                 int(N * pct),
                 ageRange=(self.avgAge - 5, self.avgAge + 5),
@@ -579,7 +494,7 @@ class pensPop(object):
     ):
         """TBD: New hires who aren't replacements."""
 
-        self.members.extend(
+        self.addMembers(
             self.simulateMembers(
                 N,
                 ageRange=(25, 35),
@@ -588,36 +503,91 @@ class pensPop(object):
             )
         )
 
+    def selectMembers(self, N, ageRange=(0, 200), status="active", by="age"):
+        """Up to N members of the given status with ages in ageRange
+        (inclusive): the youngest ones, or with by="service" the ones with
+        the least service.  Only the age buckets in the range are looked
+        at, and picking by service keeps a heap of N, so this costs at
+        most O(M log N) for the M members in the range."""
+        low = ageRange[0] - self.yearsAdvanced
+        high = ageRange[1] - self.yearsAdvanced
+        candidates = (
+            m
+            for key in sorted(k for k in self.ageBuckets if low <= k <= high)
+            for m in self.ageBuckets[key]
+            if m.status == status
+        )
+        if by == "service":
+            return heapq.nsmallest(N, candidates, key=lambda m: m.service)
+        out = []
+        for m in candidates:
+            if len(out) >= N:
+                break
+            out.append(m)
+        return out
+
+    def removeMembers(self, oldMembers):
+        """Takes members out of the population altogether."""
+        gone = set(map(id, oldMembers))
+        self.members = [m for m in self.members if id(m) not in gone]
+        self.unindexMembers(oldMembers)
+        if self.tracker is not None:
+            for m in oldMembers:
+                self.tracker.remove(m)
+
     def layoffMembers(self, N):
-        """TBD: Remove given number of members.  Favor removal of the
-        younger members."""
+        """Remove up to N active members aged 20 to 25, youngest first."""
+        self.removeMembers(self.selectMembers(N, (20, 25)))
+
+    def compact(self):
+        """Moves separated and deceased members out of the working set and
+        into the archive.  Nothing happens to them after that, so the
+        yearly loops only need to visit the members who are left."""
+        live = []
+        gone = []
+        for m in self.members:
+            if m.status == "active" or m.status == "retired":
+                live.append(m)
+            else:
+                gone.append(m)
+                self.archiveCounts[m.status] = self.archiveCounts.get(m.status, 0) + 1
+        self.members = live
+        self.archive.extend(gone)
+        self.unindexMembers(gone)
 
-        for i in range(N):
-            for m in self.members:
-                if m.age >= 20 and m.age <= 25:
-                    self.members.remove(m)
+    def allMembers(self):
+        """Everyone who has ever been in the population, archive included."""
+        return self.members + self.archive
+
+    def countStatus(self, status):
+        return self.statusCounts.get(status, 0) + self.archiveCounts.get(status, 0)
 
     def printReport(self):
         print(
             "N: %.0f members, %0.f active, %0.f retired, %0.f separated, %0.f deceased"
             % (
-                len(self.members),
-                sum([m.status == "active" for m in self.members]),
-                sum([m.status == "retired" for m in self.members]),
-                sum([m.status == "separated" for m in self.members]),
-                sum([m.status == "deceased" for m in self.members]),
+                len(self.members) + len(self.archive),
+                self.countStatus("active"),
+                self.countStatus("retired"),
+                self.countStatus("separated"),
+                self.countStatus("deceased"),
             )
         )
-        sal = sum([m.salary for m in self.members]) / len(self.members)
+        sal = self.calculateTotalSalary() / (len(self.members) + len(self.archive))
         print("Average salary: $%s" % "{:,}".format(round(sal, 2)))
 
     def calculateLiability(self, member, discountrate, cola):
         """TBD: Estimate accrued liability for this member."""
 
+        if self.valuation != "simulate":
+            return self.calculateExpectedLiability(member, discountrate, cola)
+
         ## Step 1: if person is active, estimate year of retirement
         ## ET: created a deep copy of the member so not to effect the actual member's attribute
         ## when generating annual report
-        simulateMemberLife = deepcopy(member)
+        ## The copy shares the member's random stream rather than
+        ## cloning it, which would replay the member's future draws.
+        simulateMemberLife = deepcopy(member, {id(member.rng): member.rng})
 
         yearsUntilRetirement = 0
         if simulateMemberLife.status == "active":
@@ -647,15 +617,66 @@ class pensPop(object):
             )
         return liabilityPresentValue
 
+    def calculateExpectedLiability(self, member, discountrate, cola):
+        """The expected value of what calculateLiability simulates: the
+        member's pension times the annuity factor for their age, service
+        and status."""
+        if self.liabilityCache is not None:
+            return member.pension * self.liabilityCache.unitValue(
+                member, discountrate, cola
+            )
+        table = pensAnnuity.get(
+            member.sex, member.mortalityClass, discountrate, cola,
+            member.mortTable.fudge, member.assumptions, member.tier,
+        )
+        return member.pension * table.factor(member.age, member.service, member.status)
+
     def calculateTotalLiability(self):
         """Calculate the present value of the liability, aka normal cost, for all the
             members."""
 
+        if self.valuation == "incremental":
+            if self.tracker is None:
+                self.tracker = pensLiabilityTracker(
+                    self.discount, self.cola, self.salaryScale, self.mortalityFudge,
+                    self.assumptions,
+                )
+                for m in self.members:
+                    self.tracker.add(m)
+            return self.tracker.total()
+
         sum = 0
         for m in self.members:
-            sum += self.calculateLiability(m, self.discount, 1.02)
+            sum += self.calculateLiability(m, self.discount, self.cola)
         return sum
 
+    def benefitFlows(self, entrantYears=0, pct=1.0):
+        """The expected benefit payments of the members by future year,
+        and of entrantYears of replacement hires (pct of the actives
+        lost each year, as hireReplacements takes them); see
+        pensBenefitFlows.  Its presentValue at the population's discount
+        rate and COLA is the "expected" calculateTotalLiability."""
+        groups = {}
+        for m in self.members:
+            dec = pensDecrements.get(m.mortTable, m.assumptions, m.tier)
+            groups.setdefault((dec, m.status), []).append(m)
+        flows = pensBenefitFlows()
+        for (dec, status), members in groups.items():
+            ages = [m.age for m in members]
+            pensions = [m.pension for m in members]
+            if status == "active":
+                flows.addActive(dec, ages, [m.service for m in members], pensions)
+            else:
+                flows.addRetired(dec, ages, pensions)
+        for sex in sexNames:
+            mort = pensMort.get(sex, "General", fudge=self.mortalityFudge)
+            flows.addHires(
+                pensDecrements.get(mort, self.assumptions), 1 / len(sexNames),
+                (self.avgAge - 5, self.avgAge + 5), (0, 1),
+                self.startingSalary * self.benefitMultiplier,
+            )
+        return flows.project(entrantYears, pct)
+
     def calculateTotalSalary(self):
         total_salary = 0
         for m in self.members:
@@ -677,15 +698,10 @@ class pensPop(object):
         return report
 
     def getAvgService(self):
-        sum = 0
-        count = 0
-        for m in self.members:
-            if m.status == "active":
-                count += 1
-                sum += m.service
+        count = self.statusCounts.get("active", 0)
         if count == 0:
             return 0
-        return sum / count
+        return self.activeService / count
 
 
 ##################### TESTING FUNCTIONS ######################
@@ -752,6 +768,8 @@ if __name__ == "__main__":
             print(x.advanceOneYear())
 
     def testSimulatePopulation():
+        from matplotlib import pyplot as plt
+
         total_retired = 270835
         x = pensPop()
         counter = []
@@ -776,6 +794,39 @@ if __name__ == "__main__":
         x = pensPop()
         print(x.calculateTotalSalary())
 
+    def testLayoffMembers():
+        import collections
+        x = pensPop([], sampleSize=1000)
+        print(x.countStatus("active"), x.ageCounts())
+        before = x.countStatus("active")
+        young = sorted(m.age for m in x.members if m.status == "active" and 20 <= m.age <= 25)
+        x.layoffMembers(20)
+        print(x.countStatus("active"), x.ageCounts())
+        ## The index agrees with a scan of the members, and the layoffs
+        ## took the youngest.
+        assert x.countStatus("active") == before - min(20, len(young))
+        assert x.countStatus("active") == sum(m.status == "active" for m in x.members)
+        counts = collections.Counter(m.age for m in x.members)
+        assert {age: n for age, n in x.ageCounts().items() if n} == dict(counts)
+        left = sorted(m.age for m in x.members if m.status == "active" and 20 <= m.age <= 25)
+        assert left == young[min(20, len(young)):]
+        picked = x.selectMembers(5, (50, 60), by="service")
+        print([(m.age, m.service) for m in picked])
+        service = sorted(m.service for m in x.members if m.status == "active" and 50 <= m.age <= 60)
+        assert [m.service for m in picked] == service[:5]
+
+    def testFinalAverageSalary():
+        x = pensPop([], sampleSize=20)
+        for i in range(3):
+            x.advanceOneYear()
+        for m in x.members[:5]:
+            print(m.status, m.service, round(m.salary), round(x.finalAverageSalary(m)))
+            ## Active members' averages run up to this year's salary.
+            if m.status == "active":
+                history = x.salaries.history(m.slot)
+                assert history[-1] == m.salary
+                assert abs(x.finalAverageSalary(m) - np.mean(history[-5:])) < 1e-6
+
     # testdoesMemberRetire()
     # testcalculateLiability()
     # testgetAnnualReport()
@@ -783,6 +834,8 @@ if __name__ == "__main__":
     # testAgeOneYear()
     # testcalculateTotalLiability()
     # testCalculateTotalSalary()
+    testFinalAverageSalary()
+    testLayoffMembers()
     testSimulatePopulation()
     # testSimulatePopulation()
     # testAdvanceOneYear()
@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+import numpy as np
+from pensTables import pensMort
+from pensAssumptions import pensAssumptions
+from pensValuation import pensAnnuity, pensDecrements, pensBenefitFlows
+from pensSalary import pensSalaryHistory
+from pensCensus import (
+    statusNames,
+    ACTIVE,
+    RETIRED,
+    SEPARATED,
+    DECEASED,
+    sexNames,
+    drawCells,
+    drawCensus,
+)
+
+mortalityClasses = ("General", "Safety")
+
+columnTypes = {
+    "age": np.int64,
+    "sex": np.int8,
+    "service": np.int64,
+    "salary": np.float64,
+    "pension": np.float64,
+    "status": np.int8,
+    "year": np.int64,
+    "mortalityClass": np.int8,
+    "slot": np.int64,
+}
+
+
+class pensPopArray(object):
+    """A plan population stored as NumPy columns, one row per member,
+    rather than as a list of pensMember objects.  The yearly decrements
+    are applied to all the rows at once.  Exposes the same interface
+    as pensPop, so pensPlan can use either one."""
+
+    def __init__(
+        self,
+        discountRate=0.07,
+        valuation="expected",
+        rng=None,
+        sampleSize=100,
+        cola=1.02,
+        benefitMultiplier=None,
+        salaryScale=1.0,
+        mortalityFudge=1.0,
+        decrementSeed=None,
+        census=None,
+        assumptions=None,
+        valuationSeed=None,
+    ):
+        # The numpy.random.Generator for all of this population's draws.
+        self.rng = rng if rng is not None else np.random.default_rng()
+        # A SeedSequence for the yearly decrement draws; see pensPop.decrementRng.
+        self.decrementSeed = decrementSeed
+        # The "simulate" valuation's draws come from a stream of their own
+        # (from valuationSeed, else self.rng), so valuing the population
+        # never uses up its decrement streams.
+        if valuationSeed is not None:
+            self.valuationRng = np.random.default_rng(valuationSeed)
+        else:
+            self.valuationRng = self.rng
+        self.columns = {
+            name: np.zeros(0, dtype=dtype) for name, dtype in columnTypes.items()
+        }
+        # Rows for separated and deceased members, moved out of the
+        # working columns by compact().
+        self.archive = {
+            name: np.zeros(0, dtype=dtype) for name, dtype in columnTypes.items()
+        }
+        self.startingSalary = 50000
+        self.avgAge = 30
+        self.sampleSize = sampleSize
+        self.discount = 1 + discountRate
+        # The same assumptions pensPop and pensMember take.  Every row
+        # is in the assumption set's tier "1".
+        self.cola = cola
+        self.assumptions = pensAssumptions.get(assumptions)
+        self.tier = self.assumptions.tierIndex("1")
+        if benefitMultiplier is None:
+            benefitMultiplier = self.assumptions.benefitMultiplier
+        self.benefitMultiplier = benefitMultiplier
+        self.salaryScale = salaryScale
+        self.mortalityFudge = mortalityFudge
+        # Recent salaries, by the rows' slot column; see pensPop.salaries.
+        self.salaries = pensSalaryHistory(salaryScale=salaryScale, assumptions=self.assumptions)
+        # "expected" or "simulate", as in pensPop.  The columns are valued
+        # in one vectorized pass, so "incremental" is the same as "expected".
+        self.valuation = valuation
+
+        ## Mortality rates by [class, sex, age - minAge, member type].
+        tables = [
+            [pensMort.get(sex, mc, fudge=mortalityFudge) for sex in sexNames]
+            for mc in mortalityClasses
+        ]
+        self.mortMinAge = tables[0][0].minAge
+        self.mortMaxAge = tables[0][0].maxAge
+        self.mortRates = np.array([[t.rates for t in row] for row in tables])
+
+        self.simulatePopulation(census)
+
+    def __len__(self):
+        return len(self.columns["age"])
+
+    def append(self, newColumns):
+        """Adds the rows in newColumns (a dict of arrays) to the population."""
+        for name, dtype in columnTypes.items():
+            self.columns[name] = np.concatenate(
+                (self.columns[name], np.asarray(newColumns[name], dtype=dtype))
+            )
+
+    def simulateMembers(
+        self,
+        N,
+        ageRange,
+        serviceRange,
+        avgSalary,
+        sex="*",
+        mortalityClass="General",
+        status="active",
+        currentYear=2021,
+    ):
+        """Generates the columns for N members with randomly distributed
+        ages and services.  Sex is random, too, unless it's specified."""
+        N = int(N)
+        columns = drawCells(
+            self.rng, [N], ageRange[0], ageRange[1],
+            serviceRange[0], serviceRange[1], avgSalary,
+        )
+        return self.fillColumns(columns, status, mortalityClass, currentYear, sex)
+
+    def fillColumns(
+        self, columns, status="active", mortalityClass="General",
+        currentYear=2021, sex="*",
+    ):
+        """Completes a dict of drawn age, service, sex and salary columns
+        with the rest of the population's columns."""
+        N = len(columns["age"])
+        if sex != "*":
+            columns["sex"] = np.full(N, sexNames.index(sex))
+        if "status" not in columns:
+            columns["status"] = np.full(N, statusNames.index(status))
+        columns["pension"] = columns["salary"] * self.benefitMultiplier
+        columns["year"] = np.full(N, currentYear)
+        columns["mortalityClass"] = np.full(N, mortalityClasses.index(mortalityClass))
+        columns["slot"] = self.salaries.add(
+            columns["salary"], columns["age"], columns["service"]
+        )
+        return columns
+
+    def estimateSalary(self, serviceYears):
+        """Estimates a starting salary in 2020 dollars."""
+
+        if serviceYears <= 15:
+            salary = 51000 + serviceYears * 1600 + self.rng.normal(0, 2500)
+        elif serviceYears <= 25:
+            salary = (
+                self.estimateSalary(15)
+                + (serviceYears - 15) * 800
+                + self.rng.normal(0, 2500)
+            )
+        else:
+            salary = self.estimateSalary(25) + (serviceYears - 25) * self.rng.normal(
+                500, 100
+            )
+        return salary
+
+    def simulatePopulation(self, census=None):
+        """Generates the plan members from the age-service distribution
+        table in one batch; see pensCensus.drawCensus.  A census given
+        (e.g. by pensSnapshots) is copied rather than drawn."""
+        if census is None:
+            census = drawCensus(self.rng, self.sampleSize)
+        self.append(self.fillColumns(dict(census)))
+
+    def mortalityRate(self, age, sex, mortalityClass, column):
+        """Looks up the mortality rates for arrays of members."""
+        ageIdx = np.clip(age, self.mortMinAge, self.mortMaxAge) - self.mortMinAge
+        return self.mortRates[mortalityClass, sex, ageIdx, column]
+
+    def decrementRng(self):
+        if self.decrementSeed is None:
+            return self.rng
+        return np.random.default_rng(self.decrementSeed.spawn(1)[0])
+
+    def applyDecrements(self, age, service, status, sex, mortalityClass, rng):
+        """Decides separation, retirement and death for members who have
+        just aged a year, as pensMember.ageOneYear does, with draws from
+        rng.  Returns the new status array."""
+        n = len(age)
+        draws = rng.random((n, 3))
+        status = status.copy()
+        active = status == ACTIVE
+
+        a = self.assumptions
+        separate = active & (draws[:, 0] < a.separationRate(service, self.tier))
+        ## One draw against the combined chance of retiring, as in
+        ## pensMember.doesMemberRetire.
+        retire = (
+            active & ~separate
+            & (draws[:, 1] < a.retirementRate(age, service, self.tier))
+        )
+
+        status[separate] = SEPARATED
+        status[retire] = RETIRED
+
+        die = np.zeros(n, dtype=bool)
+        for code, column in ((ACTIVE, 0), (RETIRED, 1)):
+            rows = status == code
+            die[rows] = draws[rows, 2] < self.mortalityRate(
+                age[rows], sex[rows], mortalityClass[rows], column
+            )
+        status[die] = DECEASED
+        return status
+
+    def advanceOneYear(self):
+        """Advance the population by a year -- increase everyone's age
+        and service, give them raises, retire some people, others die,
+        or separate."""
+        c = self.columns
+        wasActive = c["status"] == ACTIVE
+
+        c["year"] += 1
+        c["age"][c["status"] != DECEASED] += 1
+        c["service"][wasActive] += 1
+        c["salary"][wasActive] *= self.assumptions.salaryDelta(
+            c["age"][wasActive], self.salaryScale
+        )
+        c["pension"][wasActive] = c["salary"][wasActive] * self.benefitMultiplier
+
+        c["status"] = self.applyDecrements(
+            c["age"], c["service"], c["status"], c["sex"], c["mortalityClass"],
+            self.decrementRng(),
+        )
+        c["salary"][c["status"] != ACTIVE] = 0
+        active = c["status"] == ACTIVE
+        self.salaries.record(c["slot"][active], c["salary"][active])
+
+        retired = c["status"] == RETIRED
+        info = {
+            "benefit": float(c["pension"][retired].sum()),
+            "replace": int(np.sum(wasActive & (c["status"] != ACTIVE))),
+        }
+        self.compact()
+        return info
+
+    def hireReplacements(self, N, pct=1.0):
+        """Replace retired and separated workers to maintain headcount.
+        If pct is less than one, only replace that proportion of the retired
+        and separated."""
+        self.append(
+            self.simulateMembers(
+                int(N * pct),
+                ageRange=(self.avgAge - 5, self.avgAge + 5),
+                serviceRange=(0, 1),
+                avgSalary=self.startingSalary,
+            )
+        )
+
+    def addNewMembers(self, N):
+        """New hires who aren't replacements."""
+        self.append(
+            self.simulateMembers(
+                N,
+                ageRange=(25, 35),
+                serviceRange=(0, 5),
+                avgSalary=self.estimateSalary(2),
+            )
+        )
+
+    def layoffMembers(self, N):
+        """Remove up to N active members aged 20 to 25, youngest first,
+        as pensPop.layoffMembers does."""
+        c = self.columns
+        young = np.flatnonzero(
+            (c["status"] == ACTIVE) & (c["age"] >= 20) & (c["age"] <= 25)
+        )
+        young = young[np.argsort(c["age"][young], kind="stable")]
+        keep = np.ones(len(self), dtype=bool)
+        keep[young[:N]] = False
+        for name in c:
+            c[name] = c[name][keep]
+
+    def compact(self):
+        """Moves separated and deceased rows out of the working columns
+        and into the archive."""
+        c = self.columns
+        live = (c["status"] == ACTIVE) | (c["status"] == RETIRED)
+        if np.all(live):
+            return
+        for name in c:
+            self.archive[name] = np.concatenate((self.archive[name], c[name][~live]))
+            c[name] = c[name][live]
+
+    def finalAverageSalary(self, rows):
+        """The average salary over their last five years of active
+        service for the members in rows."""
+        return self.salaries.finalAverage(self.columns["slot"][rows])
+
+    def countStatus(self, status):
+        code = statusNames.index(status)
+        return int(np.sum(self.columns["status"] == code)) + int(
+            np.sum(self.archive["status"] == code)
+        )
+
+    def printReport(self):
+        print(
+            "N: %.0f members, %0.f active, %0.f retired, %0.f separated, %0.f deceased"
+            % (
+                len(self) + len(self.archive["age"]),
+                self.countStatus("active"),
+                self.countStatus("retired"),
+                self.countStatus("separated"),
+                self.countStatus("deceased"),
+            )
+        )
+        sal = self.calculateTotalSalary() / (len(self) + len(self.archive["age"]))
+        print("Average salary: $%s" % "{:,}".format(round(sal, 2)))
+
+    def calculateLiability(self, rows, discountrate, cola):
+        """Estimate the accrued liability for the members in rows (an
+        index or boolean array) the way pensPop.calculateLiability does:
+        simulate each one's remaining career and retirement, then
+        discount a pension payment for each of those years."""
+        if self.valuation != "simulate":
+            return self.calculateExpectedLiability(rows, discountrate, cola)
+
+        c = self.columns
+        age = c["age"][rows].copy()
+        service = c["service"][rows].copy()
+        status = c["status"][rows].copy()
+        sex = c["sex"][rows]
+        mc = c["mortalityClass"][rows]
+        years = np.zeros(len(age), dtype=np.int64)
+
+        ## Step 1: if person is active, estimate year of retirement.
+        ## Step 2: estimate how many years of retirement this person is
+        ## likely to enjoy.
+        for phase in (ACTIVE, RETIRED):
+            live = np.flatnonzero(status == phase)
+            while len(live) > 0:
+                years[live] += 1
+                age[live] += 1
+                if phase == ACTIVE:
+                    service[live] += 1
+                status[live] = self.applyDecrements(
+                    age[live], service[live], status[live], sex[live], mc[live],
+                    self.valuationRng,
+                )
+                live = live[status[live] == phase]
+
+        ## Steps 3 and 4: sum the pension payments for those years,
+        ## discounted to the present, as a geometric series.
+        pension = c["pension"][rows]
+        ratio = cola / discountrate
+        if ratio == 1:
+            factor = years.astype(float)
+        else:
+            factor = (1 - ratio ** years) / (1 - ratio)
+        return pension * factor / cola
+
+    def calculateExpectedLiability(self, rows, discountrate, cola):
+        """Pension times the annuity factor, for the members in rows."""
+        c = self.columns
+        age = c["age"][rows]
+        service = c["service"][rows]
+        status = c["status"][rows]
+        sex = c["sex"][rows]
+        mc = c["mortalityClass"][rows]
+
+        factors = np.zeros(len(age))
+        for i, mortalityClass in enumerate(mortalityClasses):
+            for j, s in enumerate(sexNames):
+                group = (mc == i) & (sex == j)
+                if np.any(group):
+                    table = pensAnnuity.get(
+                        s, mortalityClass, discountrate, cola, self.mortalityFudge,
+                        self.assumptions,
+                    )
+                    factors[group] = table.factors(
+                        age[group],
+                        service[group],
+                        status[group] == ACTIVE,
+                        status[group] == RETIRED,
+                    )
+        return c["pension"][rows] * factors
+
+    def calculateTotalLiability(self):
+        """Calculate the present value of the liability, aka normal cost, for all the
+            members."""
+        live = np.flatnonzero(np.isin(self.columns["status"], (ACTIVE, RETIRED)))
+        return float(np.sum(self.calculateLiability(live, self.discount, self.cola)))
+
+    def benefitFlows(self, entrantYears=0, pct=1.0):
+        """The expected benefit payments by future year; see
+        pensPop.benefitFlows."""
+        c = self.columns
+        flows = pensBenefitFlows()
+        for i, mortalityClass in enumerate(mortalityClasses):
+            for j, sex in enumerate(sexNames):
+                mort = pensMort.get(sex, mortalityClass, fudge=self.mortalityFudge)
+                dec = pensDecrements.get(mort, self.assumptions)
+                group = (c["mortalityClass"] == i) & (c["sex"] == j)
+                active = group & (c["status"] == ACTIVE)
+                retired = group & (c["status"] == RETIRED)
+                if np.any(active):
+                    flows.addActive(dec, c["age"][active], c["service"][active], c["pension"][active])
+                if np.any(retired):
+                    flows.addRetired(dec, c["age"][retired], c["pension"][retired])
+                if mortalityClass == "General":
+                    flows.addHires(
+                        dec, 1 / len(sexNames), (self.avgAge - 5, self.avgAge + 5), (0, 1),
+                        self.startingSalary * self.benefitMultiplier,
+                    )
+        return flows.project(entrantYears, pct)
+
+    def calculateTotalSalary(self):
+        return float(np.sum(self.columns["salary"]))
+
+    def getAvgService(self):
+        active = self.columns["status"] == ACTIVE
+        if not np.any(active):
+            return 0
+        return float(np.mean(self.columns["service"][active]))
+
+
+##################### TESTING FUNCTIONS ######################
+
+
+if __name__ == "__main__":
+
+    def testAdvanceOneYear():
+        x = pensPopArray()
+        for i in range(10):
+            print(x.advanceOneYear())
+        x.printReport()
+        ## Only active and retired rows are left in the working columns;
+        ## everyone else is counted from the archive.
+        live = x.columns["status"]
+        assert np.all((live == ACTIVE) | (live == RETIRED))
+        everyone = len(x) + len(x.archive["age"])
+        assert sum(x.countStatus(status) for status in statusNames) == everyone
+        assert x.countStatus("separated") > 0 and x.countStatus("deceased") > 0
+
+    def testCalculateTotalLiability():
+        x = pensPopArray()
+        x.advanceOneYear()
+        print(x.calculateTotalLiability())
+
+    def testValuationStreams():
+        ## Simulated valuations mustn't move the decrement draws: a
+        ## population valued every year sees the same decrements as one
+        ## that never is.
+        counts = []
+        for valueEachYear in (False, True):
+            decrementSeed, valuationSeed = np.random.SeedSequence(5).spawn(2)
+            x = pensPopArray(valuation="simulate", rng=np.random.default_rng(1), sampleSize=2000,
+                             decrementSeed=decrementSeed, valuationSeed=valuationSeed)
+            history = []
+            for i in range(10):
+                if valueEachYear:
+                    x.calculateTotalLiability()
+                x.advanceOneYear()
+                history.append((x.countStatus("active"), x.countStatus("retired")))
+            counts.append(history)
+        print(counts[0][-1], counts[1][-1])
+        assert counts[0] == counts[1]
+
+    def testLayoffMembers():
+        ## Both engines lay off the same members from the same census.
+        from pensPop import pensPop
+        from pensSnapshot import makeCensus
+        census = makeCensus(2000, np.random.SeedSequence(7))
+        x = pensPopArray(census=census, rng=np.random.default_rng(1))
+        y = pensPop(None, census=census, rng=np.random.default_rng(1))
+        for N in (5, 20):
+            x.layoffMembers(N)
+            y.layoffMembers(N)
+            arrayAges = sorted(x.columns["age"][x.columns["status"] == ACTIVE].tolist())
+            memberAges = sorted(m.age for m in y.members if m.status == "active")
+            assert arrayAges == memberAges
+
+    testAdvanceOneYear()
+    testCalculateTotalLiability()
+    testValuationStreams()
+    testLayoffMembers()
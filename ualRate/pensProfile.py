@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import json
+import time
+import pensTables
+from pensTables import pensMort
+from pensValuation import pensAnnuity
+
+## The phases of pensPlan.advanceOneYear (and runModel's bookkeeping),
+## in the order they run.  "setup" is building the plan.
+phases = ("setup", "aging", "hiring", "liability", "premiums/benefits", "earnings", "reporting")
+
+
+def tablesLoaded():
+    """How many mortality, annuity and age-service tables this process
+    has built so far."""
+    return len(pensMort._registry) + len(pensAnnuity._registry) + len(pensTables._ageServiceTables)
+
+
+class pensProfile(object):
+    """Wall time and call counts for each phase of each simulated year,
+    plus counts of members processed, liability evaluations and table
+    loads.
+
+    pensPlan and runModel take one of these as profile=.  When they get
+    None, every hook is a single "if profile is not None" test, so an
+    unprofiled run costs nothing extra.  Profiles from several runs can
+    be merged, and exported as JSON or as a flat table of (year, phase,
+    seconds, calls) rows."""
+
+    def __init__(self):
+        # (year, phase) -> [seconds, calls]
+        self.phases = {}
+        self.counts = {"members": 0, "liabilityEvaluations": 0, "tableLoads": 0}
+        self.runs = 1
+        self.tables = tablesLoaded()
+
+    @staticmethod
+    def clock():
+        return time.perf_counter()
+
+    def record(self, year, phase, start):
+        """Charges the time since start to a phase and returns the clock,
+        ready to start the next phase."""
+        now = time.perf_counter()
+        entry = self.phases.setdefault((year, phase), [0.0, 0])
+        entry[0] += now - start
+        entry[1] += 1
+        return now
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def finish(self):
+        """Picks up the table loads since the profile was made."""
+        loaded = tablesLoaded()
+        self.count("tableLoads", loaded - self.tables)
+        self.tables = loaded
+
+    def merge(self, other):
+        """Adds another profile's times and counts to this one."""
+        for key, (seconds, calls) in other.phases.items():
+            entry = self.phases.setdefault(key, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+        for name, n in other.counts.items():
+            self.count(name, n)
+        self.runs += other.runs
+
+    def totals(self):
+        """Seconds and calls for each phase, over all the years."""
+        out = {phase: [0.0, 0] for phase in phases}
+        for (year, phase), (seconds, calls) in self.phases.items():
+            out.setdefault(phase, [0.0, 0])
+            out[phase][0] += seconds
+            out[phase][1] += calls
+        return out
+
+    def ordered(self):
+        """The (year, phase) entries in year order, phases in running order."""
+        return sorted(self.phases.items(), key=lambda item: (item[0][0], phases.index(item[0][1])))
+
+    def toDict(self):
+        return {
+            "runs": self.runs,
+            "counts": dict(self.counts),
+            "totals": {phase: {"seconds": s, "calls": c} for phase, (s, c) in self.totals().items()},
+            "years": [{"year": year, "phase": phase, "seconds": s, "calls": c}
+                      for (year, phase), (s, c) in self.ordered()],
+        }
+
+    def toJSON(self, path=None):
+        """The profile as a JSON string, also written to path if given."""
+        out = json.dumps(self.toDict(), indent=1)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(out)
+        return out
+
+    def toTable(self):
+        """A flat list of (year, phase, seconds, calls) rows."""
+        return [(year, phase, s, c) for (year, phase), (s, c) in self.ordered()]
+
+    def writeTable(self, path):
+        with open(path, "w") as f:
+            f.write("year,phase,seconds,calls\n")
+            for row in self.toTable():
+                f.write("%d,%s,%.6f,%d\n" % row)
+
+    def report(self):
+        totals = self.totals()
+        whole = sum(s for s, c in totals.values())
+        print("Profile of %d run(s):" % self.runs)
+        for phase, (seconds, calls) in totals.items():
+            print("  %-18s %9.3fs %5.1f%% %8d calls" % (phase, seconds, 100 * seconds / whole if whole else 0, calls))
+        for name, n in self.counts.items():
+            print("  %-18s %9d" % (name, n))
+
+
+##### TESTING #####
+
+def testProfile():
+    import copy
+    from pensPlan import runModel
+    vol = [0.04, 0.03, 0.02, 0.03, 0.04, 0.04]
+    for engine in ("members", "array"):
+        d = runModel(vol, years=10, seed=1, engine=engine, profile=True)
+        profile = d.pop("profile")
+        profile.report()
+        ## Profiling doesn't change the run.
+        assert d == runModel(vol, years=10, seed=1, engine=engine)
+        totals = profile.totals()
+        assert totals["setup"][1] == 1 and totals["aging"][1] == 10
+        assert profile.counts["members"] > 0 and profile.counts["liabilityEvaluations"] > 0
+    print(profile.toTable()[:4])
+    assert len(profile.toTable()) == len(profile.phases)
+
+    ## Merging adds the calls and runs; the JSON holds the same totals.
+    calls = {phase: c for phase, (s, c) in profile.totals().items()}
+    profile.merge(copy.deepcopy(profile))
+    assert profile.runs == 2 and all(profile.totals()[phase][1] == 2 * c for phase, c in calls.items())
+    assert json.loads(profile.toJSON())["totals"]["aging"]["calls"] == 20
+
+
+if __name__ == "__main__":
+    testProfile()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import numpy as np
+from pensAssumptions import pensAssumptions
+
+
+class pensSalaryHistory(object):
+    """The salary histories of a whole population, kept in one array
+    with a row of the last few years' salaries for each member (a slot)
+    instead of a history on every member.
+
+    Each row is a ring buffer of window years with a running sum beside
+    it, so a final average salary is one division however long the
+    career.  A row fills as record() is given each year's salaries and
+    stops changing once the member leaves active service.  The years
+    before a member joined the population are not stored up front: the
+    first time an average is asked for, they are projected backwards
+    from the first salary seen, with the same raises the members get."""
+
+    def __init__(self, window=5, salaryScale=1.0, capacity=1024, assumptions=None):
+        self.window = window
+        self.salaryScale = salaryScale
+        # The assumption set whose raises the backfill projects with,
+        # for slots added without one of their own.
+        self.assumptions = pensAssumptions.get(assumptions)
+        # The assumption sets the slots were added with; each slot holds
+        # an index into this list.
+        self.sets = [self.assumptions]
+        self.size = 0
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        self.ring = np.zeros((capacity, self.window))
+        self.total = np.zeros(capacity)
+        # Years recorded (or backfilled) for each slot.
+        self.count = np.zeros(capacity, dtype=np.int64)
+        # The first salary seen, the age it was paid at, and how many
+        # years of service came before it and are still to be backfilled.
+        self.firstSalary = np.zeros(capacity)
+        self.firstAge = np.zeros(capacity, dtype=np.int64)
+        self.prior = np.zeros(capacity, dtype=np.int64)
+        self.setIndex = np.zeros(capacity, dtype=np.int64)
+
+    def grow(self, needed):
+        names = ("ring", "total", "count", "firstSalary", "firstAge", "prior", "setIndex")
+        old = [getattr(self, name) for name in names]
+        capacity = len(self.total)
+        while capacity < needed:
+            capacity *= 2
+        self.allocate(capacity)
+        for name, array in zip(names, old):
+            getattr(self, name)[: self.size] = array[: self.size]
+
+    def __len__(self):
+        return self.size
+
+    def setIndexOf(self, assumptions):
+        """The index of an assumption set in self.sets, adding it if it
+        isn't there yet."""
+        a = pensAssumptions.get(assumptions) if assumptions is not None else self.assumptions
+        for i, known in enumerate(self.sets):
+            if known is a:
+                return i
+        self.sets.append(a)
+        return len(self.sets) - 1
+
+    def add(self, salary, age, service, assumptions=None):
+        """Gives new members slots, with their current salaries as the
+        first year of their histories.  Takes arrays (or scalars) and
+        returns the array of slots.  assumptions is the members' one
+        assumption set, or a list with one per member, for the raises
+        their missing years are projected with; None means the
+        history's own."""
+        salary = np.atleast_1d(np.asarray(salary, dtype=float))
+        n = len(salary)
+        if self.size + n > len(self.total):
+            self.grow(self.size + n)
+        slots = np.arange(self.size, self.size + n)
+        self.size += n
+        self.ring[slots, 0] = salary
+        self.total[slots] = salary
+        self.count[slots] = 1
+        self.firstSalary[slots] = salary
+        self.firstAge[slots] = age
+        self.prior[slots] = np.maximum(np.asarray(service) - 1, 0)
+        if isinstance(assumptions, (list, tuple)):
+            self.setIndex[slots] = [self.setIndexOf(a) for a in assumptions]
+        else:
+            self.setIndex[slots] = self.setIndexOf(assumptions)
+        return slots
+
+    def record(self, slots, salary):
+        """Adds a year's salary to each slot's history, dropping the
+        oldest one once the window is full."""
+        slots = np.asarray(slots, dtype=np.int64)
+        pos = self.count[slots] % self.window
+        self.total[slots] += salary - self.ring[slots, pos]
+        self.ring[slots, pos] = salary
+        self.count[slots] += 1
+
+    def backfill(self, slots):
+        """Projects the missing years before each slot's first salary,
+        for the slots whose window isn't full yet."""
+        slots = np.asarray(slots, dtype=np.int64)
+        need = slots[(self.prior[slots] > 0) & (self.count[slots] < self.window)]
+        for slot in np.unique(need).tolist():
+            c = self.count[slot]
+            k = min(self.window - c, self.prior[slot])
+            ## Salary at age a-1 is the salary at a over the raise at a.
+            ages = self.firstAge[slot] - np.arange(k)
+            raises = self.sets[self.setIndex[slot]].salaryDelta(ages, self.salaryScale)
+            earlier = self.firstSalary[slot] / np.cumprod(raises)
+            ## No wrap yet, so the recorded years are in order at the
+            ## front of the row.  Put the projected ones ahead of them.
+            row = np.concatenate((earlier[::-1], self.ring[slot, :c]))
+            self.ring[slot, : k + c] = row
+            self.total[slot] = row.sum()
+            self.count[slot] = k + c
+        self.prior[slots] = 0
+
+    def finalAverage(self, slots):
+        """The average salary over the last window years (or the whole
+        career, if shorter) for each slot."""
+        slots = np.asarray(slots, dtype=np.int64)
+        self.backfill(slots)
+        return self.total[slots] / np.minimum(self.count[slots], self.window)
+
+    def history(self, slot):
+        """A slot's stored salaries, oldest first."""
+        self.backfill([slot])
+        c = self.count[slot]
+        if c <= self.window:
+            return self.ring[slot, :c].tolist()
+        pos = c % self.window
+        return np.roll(self.ring[slot], -pos).tolist()
+
+
+##### TESTING #####
+
+def testSalaryHistory():
+    h = pensSalaryHistory(window=5, capacity=2)
+    slots = h.add([50000, 80000, 60000], [30, 50, 40], [1, 20, 3])
+    for year in range(2):
+        h.record(slots[:2], [50000 * 1.07 ** (year + 1), 80000 * 1.035 ** (year + 1)])
+    for slot in slots.tolist():
+        print(slot, [round(s) for s in h.history(slot)], round(h.finalAverage([slot])[0]))
+    ## A new hire has no years to project; the others are filled out to
+    ## the window with the default raises.
+    assert h.history(0) == [50000, 50000 * 1.07, 50000 * 1.07 ** 2]
+    assert len(h.history(1)) == 5 and len(h.history(2)) == 3
+    assert h.history(2)[2] == 60000
+    assert abs(h.history(2)[1] - 60000 / h.assumptions.salaryDelta(40)) < 1e-9
+    h.record(slots, [1, 2, 3])
+    print(h.finalAverage(slots))
+    assert h.finalAverage(slots)[2] == np.mean(h.history(2))
+
+    ## Each slot's missing years use the raises of its own assumption set.
+    import copy
+    spec = copy.deepcopy(pensAssumptions.get().spec)
+    spec["salaryScale"]["raises"] = [1.1] * len(spec["salaryScale"]["raises"])
+    high = pensAssumptions(spec)
+    h = pensSalaryHistory(window=3)
+    slots = h.add([60000, 60000], [40, 40], [10, 10], [None, high])
+    low, fast = (h.history(slot)[0] for slot in slots.tolist())
+    print(round(low), round(fast))
+    assert abs(fast - 60000 / 1.1 ** 2) < 1e-9 and fast < low
+
+
+if __name__ == "__main__":
+    testSalaryHistory()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import numpy as np
+from pensTables import pensMort, getAgeServiceTable, bundleVersion
+from pensCensus import drawCensus
+
+_tableVersion = None
+
+
+def tableVersion():
+    """A digest of the tables a starting population depends on: the
+    age-service distribution and the base mortality rates."""
+    global _tableVersion
+    if _tableVersion is None:
+        h = hashlib.sha1(str(bundleVersion).encode())
+        fractions, ageBands, total = getAgeServiceTable()
+        for array in (fractions, ageBands, np.array(total)):
+            h.update(np.ascontiguousarray(array).tobytes())
+        for mortalityClass in sorted(pensMort.sheets):
+            for sex in ("F", "M"):
+                h.update(pensMort.get(sex, mortalityClass).rates.tobytes())
+        _tableVersion = h.hexdigest()[:16]
+    return _tableVersion
+
+
+def makeCensus(sampleSize, seed):
+    """The starting census for a seed (a SeedSequence): drawCensus's
+    columns plus an id for every member, all drawn from the seed's own
+    stream."""
+    rng = np.random.default_rng(seed)
+    census = drawCensus(rng, sampleSize)
+    census["id"] = rng.integers(1, pow(16, 6), len(census["age"]), endpoint=True)
+    return census
+
+
+class pensSnapshots(object):
+    """A cache of starting censuses and their initial liabilities, kept
+    in a directory so that runs in other processes, and later sessions,
+    can share them.
+
+    A census is keyed by the table version, the sample size and the seed
+    it was drawn from, and stored as an .npz file of columns.  Next to it
+    a JSON file holds the census's initial liability for each engine and
+    set of valuation and salary assumptions it has been valued under.
+    The arrays handed out are read-only; the populations copy what they
+    keep, so one cached census can start any number of plans.  Use
+    pensSnapshots.get() to share one cache per directory in a process."""
+
+    _registry = {}
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.censuses = {}
+        self.liabilities = {}
+
+    @classmethod
+    def get(cls, directory):
+        key = os.path.abspath(str(directory))
+        if key not in cls._registry:
+            cls._registry[key] = cls(directory)
+        return cls._registry[key]
+
+    def key(self, sampleSize, seed):
+        raw = repr((tableVersion(), sampleSize, seed.entropy, tuple(seed.spawn_key), seed.pool_size))
+        return hashlib.sha1(raw.encode()).hexdigest()[:20]
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, "census-%s%s" % (key, suffix))
+
+    def census(self, sampleSize, seed):
+        """The census for a sample size and SeedSequence, drawn and saved
+        the first time it's asked for."""
+        key = self.key(sampleSize, seed)
+        if key not in self.censuses:
+            census = None
+            path = self.path(key, ".npz")
+            if os.path.exists(path):
+                try:
+                    with np.load(path) as npz:
+                        census = {name: npz[name] for name in npz.files}
+                except (OSError, ValueError):
+                    census = None
+            if census is None:
+                census = makeCensus(sampleSize, seed)
+                tmp = self.path(key, ".npz.tmp")
+                with open(tmp, "wb") as f:
+                    np.savez(f, **census)
+                os.replace(tmp, path)
+            for array in census.values():
+                array.setflags(write=False)
+            self.censuses[key] = census
+        return self.censuses[key]
+
+    def readLiabilities(self, key):
+        if key not in self.liabilities:
+            path = self.path(key, ".json")
+            try:
+                with open(path) as f:
+                    self.liabilities[key] = json.load(f)
+            except (OSError, ValueError):
+                self.liabilities[key] = {}
+        return self.liabilities[key]
+
+    def liability(self, sampleSize, seed, settings, calculate):
+        """The initial liability of a census under settings (a dict of
+        the engine and the assumptions it's valued with), from the cache
+        or else from calculate()."""
+        key = self.key(sampleSize, seed)
+        values = self.readLiabilities(key)
+        name = json.dumps(settings, sort_keys=True)
+        if name not in values:
+            values[name] = calculate()
+            tmp = self.path(key, ".json.tmp")
+            with open(tmp, "w") as f:
+                json.dump(values, f, indent=1)
+            os.replace(tmp, self.path(key, ".json"))
+        return values[name]
+
+
+##### TESTING #####
+
+def testSnapshots(directory="test-snapshots"):
+    import shutil
+    import time
+    from pensPlan import pensPlan
+    vol = [0.04, 0.03, 0.02, 0.03, 0.04, 0.04]
+    for engine in ("members", "array"):
+        starts = []
+        for attempt in ("cold", "warm"):
+            pensSnapshots._registry.clear()
+            t = time.time()
+            p = pensPlan(2000, vol, engine=engine, seed=5, sampleSize=20000, snapshots=directory)
+            print("%s %s start: %.3fs, %d members, liability %.0f" % (engine, attempt, time.time() - t,
+                                                                     len(p.population), p.liability))
+            starts.append((len(p.population), p.liability))
+        p = pensPlan(2000, vol, engine=engine, seed=5, sampleSize=20000)
+        print("%s uncached start: liability %.0f" % (engine, p.liability))
+        ## A snapshot starts the plan exactly where drawing it afresh would.
+        assert starts[0] == starts[1] == (len(p.population), p.liability)
+
+    ## Unsaved assumption sets that differ only in the benefit multiplier,
+    ## or only in a table, don't share a cached liability.
+    import copy
+    from pensAssumptions import pensAssumptions
+    liabilities = []
+    for multiplier, separation in ((0.55, None), (0.6, None), (0.55, [0.3])):
+        spec = copy.deepcopy(pensAssumptions.get().spec)
+        spec["benefitMultiplier"] = multiplier
+        if separation is not None:
+            spec["tiers"]["1"]["separation"]["rates"] = separation
+        p = pensPlan(2000, vol, engine="array", seed=5, sampleSize=20000, snapshots=directory,
+                     assumptions=pensAssumptions(spec))
+        liabilities.append(p.liability)
+    print("Liability at 55%%, at 60%% and with 30%% separation: %.0f, %.0f, %.0f" % tuple(liabilities))
+    assert liabilities[1] > liabilities[0] and liabilities[2] != liabilities[0]
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    testSnapshots()
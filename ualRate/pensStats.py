@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import numpy as np
+
+
+class pensRunStats(object):
+    """Running statistics, year by year, over a stream of model runs.
+
+    Each run (a runModel dictionary of per-year lists) is folded in as
+    soon as it finishes and can then be thrown away.  The mean and
+    variance are kept with Welford's method, along with the min and
+    max.  Quantiles come from a reservoir sample of at most sampleSize
+    runs, so memory stays fixed however many runs go by; they are exact
+    until the reservoir fills."""
+
+    def __init__(self, metrics, years, quantiles=(0.05, 0.5, 0.95), sampleSize=1000, seed=None):
+        self.metrics = list(metrics)
+        self.years = years
+        self.quantiles = list(quantiles)
+        self.sampleSize = sampleSize
+        self.rng = np.random.default_rng(seed)
+
+        shape = (len(self.metrics), years)
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.reservoir = np.empty((sampleSize,) + shape)
+
+    def add(self, run):
+        """Folds one run into the statistics."""
+        x = np.array([run[m][:self.years] for m in self.metrics], dtype=float)
+
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        np.minimum(self.min, x, out=self.min)
+        np.maximum(self.max, x, out=self.max)
+
+        # Reservoir sampling: every run so far has the same chance of being in the sample.
+        if self.n <= self.sampleSize:
+            self.reservoir[self.n - 1] = x
+        else:
+            j = self.rng.integers(self.n)
+            if j < self.sampleSize:
+                self.reservoir[j] = x
+
+    def variance(self):
+        if self.n < 2:
+            return np.zeros_like(self.mean)
+        return self.m2 / (self.n - 1)
+
+    def quantile(self, q):
+        return np.quantile(self.reservoir[:min(self.n, self.sampleSize)], q, axis=0)
+
+    def summary(self, metric):
+        """A dictionary of per-year arrays for one metric: mean, sd, min,
+        max and the configured quantiles."""
+        i = self.metrics.index(metric)
+        out = {"mean": self.mean[i], "sd": np.sqrt(self.variance()[i]), "min": self.min[i], "max": self.max[i]}
+        for q in self.quantiles:
+            out["q%g" % (100 * q)] = self.quantile(q)[i]
+        return out
+
+    def toDataFrame(self, startYear=2000):
+        """All the statistics as one table, a row per year and columns
+        like "UAL mean" and "UAL q95"."""
+        import pandas as pd
+
+        data = {}
+        for metric in self.metrics:
+            for name, values in self.summary(metric).items():
+                data["%s %s" % (metric, name)] = values
+        return pd.DataFrame(data=data, index=range(startYear, startYear + self.years))
+
+
+##### TESTING #####
+
+def testRunStats():
+    rng = np.random.default_rng(1)
+    runs = [{"UAL": list(rng.normal(100, 10, 5)), "Contribution Rate": list(rng.normal(0.2, 0.05, 5))}
+            for i in range(5000)]
+    s = pensRunStats(["UAL", "Contribution Rate"], 5, sampleSize=500)
+    for run in runs:
+        s.add(run)
+    ual = np.array([run["UAL"] for run in runs])
+    print("mean:", s.mean[0], ual.mean(axis=0))
+    print("sd:", np.sqrt(s.variance()[0]), ual.std(axis=0, ddof=1))
+    print("q95:", s.quantile(0.95)[0], np.quantile(ual, 0.95, axis=0))
+    print(s.toDataFrame())
+    assert s.n == 5000
+    assert np.allclose(s.mean[0], ual.mean(axis=0))
+    assert np.allclose(np.sqrt(s.variance()[0]), ual.std(axis=0, ddof=1))
+    assert np.array_equal(s.min[0], ual.min(axis=0)) and np.array_equal(s.max[0], ual.max(axis=0))
+    ## The quantiles come from a reservoir of 500 runs, so they are only
+    ## close: the standard error of this one is about 1.
+    assert np.all(abs(s.quantile(0.95)[0] - np.quantile(ual, 0.95, axis=0)) < 4)
+
+
+if __name__ == "__main__":
+    testRunStats()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import struct
+import numpy as np
+
+## A study file is a header, then blocks of raw array data, then a JSON
+## index and a fixed-size footer pointing back at the index.  New
+## results are always written after the old footer, followed by a new
+## index and footer, so flushing never rewrites data already on disk
+## and the arrays can be memory-mapped straight from the file.
+MAGIC = b"PAWGSTR1"
+FOOTER = struct.Struct("<QQ8s")
+ALIGN = 64
+
+
+def readIndex(path):
+    """Returns the index of a study file, or None if there isn't one yet."""
+    if not os.path.exists(path) or os.path.getsize(path) < len(MAGIC) + FOOTER.size:
+        return None
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a results store" % path)
+        f.seek(-FOOTER.size, os.SEEK_END)
+        offset, length, magic = FOOTER.unpack(f.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError("%s has no index; was a flush interrupted?" % path)
+        f.seek(offset)
+        return json.loads(f.read(length).decode("utf-8"))
+
+
+def partitionName(prefix, params):
+    """A partition name for a parameter set: the prefix and a short
+    digest of every parameter, so runs that differ in any of them go to
+    different partitions."""
+    raw = json.dumps(params, sort_keys=True)
+    return "%s-%s" % (prefix, hashlib.sha1(raw.encode("utf-8")).hexdigest()[:10])
+
+
+class pensResultWriter(object):
+    """Collects the per-year metrics of many runModel runs into
+    preallocated (runs x years) arrays, one per metric, and appends them
+    in bulk to a single study file under a partition named for the
+    parameter set (see partitionName).  Holds at most chunkSize runs in
+    memory at a time.  Appending to a partition written with different
+    params is an error."""
+
+    def __init__(self, path, partition, metrics, years, params=None, chunkSize=1000):
+        self.path = path
+        self.partition = partition
+        self.metrics = list(metrics)
+        self.years = years
+        self.params = params or {}
+        self.chunkSize = chunkSize
+        self.data = {m: np.empty((chunkSize, years)) for m in self.metrics}
+        self.count = 0
+
+    def add(self, run):
+        """Records one run (a runModel dictionary), flushing first if the
+        arrays are full."""
+        if self.count == self.chunkSize:
+            self.flush()
+        for m in self.metrics:
+            self.data[m][self.count] = run[m][:self.years]
+        self.count += 1
+
+    def stored(self):
+        """The number of runs in this writer's partition of the study
+        file, not counting any still held in memory."""
+        index = readIndex(self.path)
+        if index is None or self.partition not in index["partitions"]:
+            return 0
+        return sum(chunk["runs"] for chunk in index["partitions"][self.partition]["chunks"])
+
+    def flush(self):
+        """Appends the runs collected so far to the study file."""
+        if self.count == 0:
+            return
+
+        index = readIndex(self.path) or {"version": 1, "partitions": {}}
+        params = json.loads(json.dumps(self.params))
+        part = index["partitions"].setdefault(self.partition, {"params": params, "chunks": []})
+        if part["params"] != params:
+            raise ValueError("Partition %s of %s holds runs with other params: %s"
+                             % (self.partition, self.path, part["params"]))
+
+        with open(self.path, "ab") as f:
+            if f.tell() == 0:
+                f.write(MAGIC)
+            chunk = {"runs": self.count, "metrics": {}}
+            for m in self.metrics:
+                block = np.ascontiguousarray(self.data[m][:self.count])
+                f.write(b"\0" * (-f.tell() % ALIGN))
+                chunk["metrics"][m] = {"offset": f.tell(), "shape": list(block.shape), "dtype": block.dtype.str}
+                f.write(block.tobytes())
+            part["chunks"].append(chunk)
+
+            raw = json.dumps(index).encode("utf-8")
+            offset = f.tell()
+            f.write(raw)
+            f.write(FOOTER.pack(offset, len(raw), MAGIC))
+
+        self.count = 0
+
+
+class pensResultReader(object):
+    """Reads a study file written by pensResultWriter.  Metrics come back
+    as memory-mapped arrays, so loading one metric for every run of a
+    partition doesn't touch the rest of the file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = readIndex(path)
+        if self.index is None:
+            raise ValueError("%s is not a results store" % path)
+
+    def partitions(self):
+        return list(self.index["partitions"])
+
+    def params(self, partition):
+        return self.index["partitions"][partition]["params"]
+
+    def runs(self, partition):
+        return sum(chunk["runs"] for chunk in self.index["partitions"][partition]["chunks"])
+
+    def metric(self, name, partition):
+        """A (runs x years) array of one metric over every run in the
+        partition.  A memory map if the partition was written in one
+        flush, otherwise the chunks are joined into a new array."""
+        maps = []
+        for chunk in self.index["partitions"][partition]["chunks"]:
+            info = chunk["metrics"][name]
+            maps.append(np.memmap(self.path, dtype=np.dtype(info["dtype"]), mode="r", offset=info["offset"],
+                                  shape=tuple(info["shape"])))
+        if len(maps) == 1:
+            return maps[0]
+        return np.concatenate(maps)
+
+
+##### TESTING #####
+
+def testStore(path="test-store.pawg"):
+    if os.path.exists(path):
+        os.remove(path)
+    rng = np.random.default_rng(0)
+    runs = [{"UAL": list(rng.normal(100, 10, 4)), "Assets": list(rng.normal(50, 5, 4))} for i in range(7)]
+
+    w = pensResultWriter(path, "dr=0.07", ["UAL", "Assets"], 4, params={"discountRate": 0.07}, chunkSize=3)
+    for run in runs:
+        w.add(run)
+    ## Two full chunks were flushed on their own; the last run is still in memory.
+    assert w.stored() == 6
+    w.flush()
+    assert w.stored() == 7
+    w = pensResultWriter(path, "dr=0.065", ["UAL", "Assets"], 4, params={"discountRate": 0.065})
+    w.add(runs[0])
+    w.flush()
+
+    r = pensResultReader(path)
+    print(r.partitions(), r.params("dr=0.065"), r.runs("dr=0.07"))
+    print(type(r.metric("Assets", "dr=0.065")), r.metric("Assets", "dr=0.065"))
+    assert r.runs("dr=0.07") == 7 and r.params("dr=0.065") == {"discountRate": 0.065}
+    assert np.allclose(r.metric("UAL", "dr=0.07"), [run["UAL"] for run in runs])
+
+    ## The same partition with other params is refused, not merged.
+    w = pensResultWriter(path, "dr=0.07", ["UAL", "Assets"], 4, params={"discountRate": 0.08})
+    w.add(runs[0])
+    try:
+        w.flush()
+        raise AssertionError("Mismatched params were appended")
+    except ValueError as e:
+        print("Refused:", e)
+    assert pensResultReader(path).runs("dr=0.07") == 7
+    assert partitionName("a", {"x": 1, "y": 2}) == partitionName("a", {"y": 2, "x": 1})
+    assert partitionName("a", {"x": 1}) != partitionName("a", {"x": 2})
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    testStore()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+import csv
+import itertools
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pensPlan import runReplication
+from pensTables import pensMort, getAgeServiceTable
+from pensValuation import pensAnnuity
+from pensStats import pensRunStats
+
+## The inputs from sensitivity.txt that a sweep can vary.  Most are
+## runModel arguments.  The fund's volatility list holds a mean and a
+## standard deviation for each asset class, so it is varied through two
+## derived parameters instead: returnShift is added to every mean and
+## volatilityScale multiplies every standard deviation.  assumptions
+## takes the names of assumption sets (see pensAssumptions).
+sweepParameters = [
+    "discountRate",
+    "employmentGrowth",
+    "cola",
+    "benefitMultiplier",
+    "salaryScale",
+    "mortalityFudge",
+    "assumptions",
+    "funds",
+    "premiums",
+    "returnShift",
+    "volatilityScale",
+]
+
+## The runModel metrics summarized for every point.
+sweepMetrics = ["UAL", "UAL Growth(%)", "Contribution Rate"]
+
+
+def gridDesign(**values):
+    """Every combination of the given values, e.g.
+    gridDesign(discountRate=[0.06, 0.07], cola=[1.02, 1.03])."""
+    names = sorted(values)
+    return [dict(zip(names, combo)) for combo in itertools.product(*[values[n] for n in names])]
+
+
+def latinHypercube(ranges, n, seed=None):
+    """n points spread over the (low, high) ranges given for each
+    parameter, with each range cut into n strata and every stratum used
+    exactly once."""
+    rng = np.random.default_rng(seed)
+    names = sorted(ranges)
+    columns = {}
+    for name in names:
+        low, high = ranges[name]
+        u = (rng.permutation(n) + rng.random(n)) / n
+        columns[name] = low + u * (high - low)
+    return [{name: float(columns[name][i]) for name in names} for i in range(n)]
+
+
+def pointKey(point):
+    """A stable name for a design point, used to recognize it when a
+    sweep is resumed."""
+    return ";".join("%s=%r" % (name, point[name]) for name in sorted(point))
+
+
+def initSweepWorker(valuations):
+    """Loads the tables a sweep will need once per pool worker.  The
+    valuations are (discount rate, COLA, mortality fudge) triples."""
+    getAgeServiceTable()
+    for discountRate, cola, fudge in valuations:
+        for mortalityClass in pensMort.sheets:
+            for sex in ("F", "M"):
+                pensAnnuity.get(sex, mortalityClass, 1 + discountRate, cola, fudge)
+
+
+class pensSweep(object):
+    """Runs getModelData-style replications at every point of a design
+    (a list of dicts of sweepParameters, e.g. from gridDesign or
+    latinHypercube) and writes one row of UAL growth and contribution
+    rate summaries per point to a CSV file.
+
+    All the (point x replication) runs go to one worker pool, whose
+    workers keep their mortality and annuity tables from one point to
+    the next.  Rows are written as points finish, and points already in
+    the results file are skipped, so an interrupted sweep picks up where
+    it left off.  Replication seeds are spawned from the seed in design
+    order, so with a seed a resumed sweep gives the same rows as an
+    uninterrupted one.
+
+    With commonSeeds, every point uses the same replication seeds
+    instead, so the points start from the same censuses and see the same
+    draws.  Passing snapshots= (a directory; see pensSnapshot) as well
+    then builds each census, and values it under each set of valuation
+    assumptions, only once for the whole sweep."""
+
+    def __init__(self, design, volatility, replications=20, years=40, results="sweep.csv", workers=1, seed=None,
+                 engine="members", quantiles=(0.05, 0.5, 0.95), commonSeeds=False, **fixed):
+        self.design = list(design)
+        for point in self.design:
+            for name in point:
+                if name not in sweepParameters:
+                    raise ValueError("Unknown sweep parameter: %s" % name)
+        self.volatility = list(volatility)
+        self.replications = replications
+        self.years = years
+        self.results = results
+        self.workers = workers
+        self.seed = seed
+        self.engine = engine
+        self.quantiles = list(quantiles)
+        self.commonSeeds = commonSeeds
+        # Other runModel arguments, held the same at every point.
+        self.fixed = fixed
+        self.names = sorted(set(itertools.chain.from_iterable(self.design)))
+
+    def runArgs(self, point):
+        """The runModel arguments for one design point."""
+        args = dict(self.fixed, volatility=self.volatility, years=self.years, engine=self.engine)
+        for name, value in point.items():
+            if name == "returnShift":
+                args["volatility"] = [v + value if i % 2 == 0 else v for i, v in enumerate(args["volatility"])]
+            elif name == "volatilityScale":
+                args["volatility"] = [v * value if i % 2 == 1 else v for i, v in enumerate(args["volatility"])]
+            else:
+                args[name] = value
+        return args
+
+    def columns(self):
+        out = ["point"] + self.names + ["runs"]
+        for metric in sweepMetrics:
+            if metric != "UAL":
+                out.append("%s mean" % metric)
+            out += ["%s final" % metric, "%s final sd" % metric]
+            out += ["%s final q%g" % (metric, 100 * q) for q in self.quantiles]
+        return out
+
+    def finished(self):
+        """The keys of the points already in the results file."""
+        if not os.path.exists(self.results) or os.path.getsize(self.results) == 0:
+            return set()
+        with open(self.results, newline="") as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames != self.columns():
+                raise ValueError("%s holds results for a different sweep" % self.results)
+            return set(row["point"] for row in reader)
+
+    def summarize(self, point, stats):
+        """The results row for one point.  Means are over every year
+        after the first; final values are the last year's, across
+        runs."""
+        row = {"point": pointKey(point), "runs": stats.n}
+        row.update(point)
+        for metric in sweepMetrics:
+            s = stats.summary(metric)
+            if metric != "UAL":
+                row["%s mean" % metric] = float(np.mean(s["mean"][1:]))
+            row["%s final" % metric] = float(s["mean"][-1])
+            row["%s final sd" % metric] = float(s["sd"][-1])
+            for q in self.quantiles:
+                row["%s final q%g" % (metric, 100 * q)] = float(s["q%g" % (100 * q)][-1])
+        return row
+
+    def run(self):
+        """Runs every point not already in the results file.  Returns
+        the rows written."""
+        done = self.finished()
+        rootSeed = np.random.SeedSequence(self.seed)
+        pointSeeds = rootSeed.spawn(len(self.design))
+        common = rootSeed.spawn(self.replications) if self.commonSeeds else None
+
+        pending = []
+        tasks = []
+        for point, pointSeed in zip(self.design, pointSeeds):
+            if pointKey(point) in done:
+                continue
+            args = self.runArgs(point)
+            pending.append((point, pensRunStats(sweepMetrics, self.years + 1, self.quantiles,
+                                                seed=pointSeed.spawn(1)[0])))
+            seeds = pointSeed.spawn(self.replications)
+            tasks += [(args, s) for s in (common if self.commonSeeds else seeds)]
+        print("%d of %d points left to run." % (len(pending), len(self.design)))
+        if not pending:
+            return []
+
+        valuations = set()
+        for point in self.design:
+            args = self.runArgs(point)
+            valuations.add((args.get("discountRate", 0.07), args.get("cola", 1.02), args.get("mortalityFudge", 1.0)))
+
+        pool = None
+        if self.workers > 1:
+            pool = ProcessPoolExecutor(self.workers, initializer=initSweepWorker, initargs=(valuations,))
+            runs = pool.map(runReplication, tasks, chunksize=max(1, self.replications // self.workers))
+        else:
+            runs = map(runReplication, tasks)
+
+        rows = []
+        newFile = not os.path.exists(self.results) or os.path.getsize(self.results) == 0
+        try:
+            with open(self.results, "a", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=self.columns())
+                if newFile:
+                    writer.writeheader()
+                # Runs come back in task order, so the points finish one after another.
+                for point, stats in pending:
+                    for i in range(self.replications):
+                        stats.add(next(runs))
+                    row = self.summarize(point, stats)
+                    writer.writerow(row)
+                    f.flush()
+                    rows.append(row)
+                    print("Finished point %s" % row["point"])
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        return rows
+
+
+##### TESTING #####
+
+def testSweep(path="test-sweep.csv"):
+    if os.path.exists(path):
+        os.remove(path)
+    vol = [0.04, 0.03, 0.02, 0.03, 0.04, 0.04]
+
+    design = gridDesign(discountRate=[0.065, 0.075], cola=[1.02, 1.03])
+    s = pensSweep(design[:2], vol, replications=4, years=5, results=path, workers=2, seed=1, engine="array")
+    assert len(s.run()) == 2
+    ## Resuming with the full design only runs the two new points.
+    s = pensSweep(design, vol, replications=4, years=5, results=path, workers=2, seed=1, engine="array")
+    assert len(s.run()) == 2
+    assert s.run() == []
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        print(row["point"], row["runs"], round(float(row["UAL Growth(%) mean"]), 2),
+              round(float(row["Contribution Rate final"]), 4))
+    assert [row["point"] for row in rows] == [pointKey(point) for point in design]
+    assert all(int(row["runs"]) == 4 for row in rows)
+
+    ## The same as one uninterrupted sweep, in a single process.
+    whole = "whole-" + path
+    pensSweep(design, vol, replications=4, years=5, results=whole, workers=1, seed=1, engine="array").run()
+    with open(whole) as f:
+        assert list(csv.DictReader(f)) == rows
+    os.remove(whole)
+
+    points = latinHypercube({"salaryScale": (0.5, 1.5), "mortalityFudge": (0.9, 1.1)}, 4, seed=0)
+    print(points)
+    ## One point in each quarter of each range.
+    assert sorted(int((p["salaryScale"] - 0.5) / 0.25) for p in points) == [0, 1, 2, 3]
+    assert sorted(int((p["mortalityFudge"] - 0.9) / 0.05) for p in points) == [0, 1, 2, 3]
+    os.remove(path)
+
+
+if __name__ == "__main__":
+    testSweep()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+import hashlib
+import numpy as np
+from pathlib import Path
+
+## The input workbooks live in the repository next to this directory.
+## Paths are resolved from this file, so the model runs from anywhere.
+dataDir = Path(__file__).resolve().parent.parent
+
+## Location of the PUB-2010 headcount-weighted mortality workbook.
+mortalityFile = dataDir / "mortalityTables" / "pub-2010-headcount-mort-rates.xlsx"
+
+## Location of the age-service distribution workbook (CalSTRS actives).
+ageServiceFile = dataDir / "ageServiceTables" / "age-service-distribution.xlsx"
+
+## The compiled bundle: the default workbooks' tables as plain arrays,
+## which load in milliseconds without openpyxl or pandas.  Build it with
+## compileTables() (or "python pensTables.py").  Bump bundleVersion
+## whenever the layout or the parsing changes.  The bundle also records
+## a digest of each workbook it was compiled from; an out-of-date bundle,
+## or one whose workbooks have since changed, is ignored and the
+## workbooks are read instead.
+bundleFile = Path(__file__).resolve().parent / "pensTables.npz"
+bundleVersion = 2
+bundleSources = {"mortalitySource": mortalityFile, "ageServiceSource": ageServiceFile}
+
+## Loaded bundles by path; an empty dict marks one that wasn't usable.
+_bundles = {}
+
+
+def fileDigest(path):
+    """The SHA-1 of a file's contents, or "" if it can't be read."""
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return ""
+
+
+def loadBundle(path=bundleFile):
+    """Returns the compiled tables as a dict of arrays, or None if there
+    is no usable bundle.  A workbook that is missing doesn't invalidate
+    the bundle, so it still works where only the bundle is shipped."""
+    key = str(path)
+    if key not in _bundles:
+        _bundles[key] = {}
+        try:
+            with np.load(path) as npz:
+                if int(npz["version"]) == bundleVersion and all(
+                    fileDigest(source) in ("", str(npz[name]))
+                    for name, source in bundleSources.items()
+                ):
+                    _bundles[key] = {name: npz[name] for name in npz.files}
+        except (OSError, KeyError, ValueError):
+            pass
+    return _bundles[key] or None
+
+
+def compileTables(path=bundleFile):
+    """Parses the default workbooks and writes the bundle."""
+    arrays = {"version": np.array(bundleVersion)}
+    for key, source in bundleSources.items():
+        arrays[key] = np.array(fileDigest(source))
+    for mortalityClass, sheet in pensMort.sheets.items():
+        for sex, (rates, minAge) in pensMort.readSheet(sheet, mortalityFile).items():
+            arrays["mort_%s_%s" % (mortalityClass, sex)] = rates
+            arrays["mortMinAge_%s_%s" % (mortalityClass, sex)] = np.array(minAge)
+    fractions, ageBands, total = readAgeServiceTable(ageServiceFile)
+    arrays["ageServiceFractions"] = fractions
+    arrays["ageServiceBands"] = ageBands
+    arrays["ageServiceTotal"] = np.array(total)
+    np.savez(path, **arrays)
+    _bundles.pop(str(path), None)
+    return path
+
+
+class pensMort:
+    """Mortality rates for one sex and mortality class, taken from the
+    PUB-2010 tables.  The rates are held in a read-only NumPy array with
+    one row per age and one column per member type: employee (0),
+    healthy retiree (1), disabled retiree (2) and contingent survivor
+    (3).
+
+    Tables are shared.  Use pensMort.get() instead of the constructor;
+    it loads each table once per process, from the compiled bundle if
+    there is one and the workbook otherwise, and hands every caller a
+    reference to the same table."""
+
+    ## Registry of loaded tables, keyed by (sex, mortalityClass, file, fudge).
+    _registry = {}
+
+    sheets = {"General": "PubG.H-2010", "Safety": "PubS.H-2010"}
+
+    ## Workbook columns holding the four rates, by sex.
+    rateColumns = {"F": slice(3, 7), "M": slice(8, 12)}
+
+    def __init__(
+        self, sex, mortalityClass, rates, minAge, tableFile=mortalityFile, fudge=1.0
+    ):
+        self.sex = sex
+        self.mortalityClass = mortalityClass
+        self.tableFile = str(tableFile)
+        # The published rates are multiplied by this (and capped at 1).
+        self.fudge = fudge
+        self.minAge = minAge
+        self.maxAge = minAge + len(rates) - 1
+        self.rates = rates
+        self.rates.setflags(write=False)
+
+    @classmethod
+    def get(cls, sex, mortalityClass, tableFile=mortalityFile, fudge=1.0):
+        """Returns the shared table for this sex and mortality class,
+        loading it if it hasn't been seen yet.  A fudge other than 1
+        scales every rate up or down, for sensitivity testing."""
+        key = (sex, mortalityClass, str(tableFile), fudge)
+        if key not in cls._registry:
+            if fudge == 1.0:
+                cls.loadSheet(mortalityClass, tableFile)
+            else:
+                base = cls.get(sex, mortalityClass, tableFile)
+                cls._registry[key] = cls(
+                    sex,
+                    mortalityClass,
+                    np.minimum(base.rates * fudge, 1.0),
+                    base.minAge,
+                    tableFile,
+                    fudge,
+                )
+        return cls._registry[key]
+
+    @classmethod
+    def loadSheet(cls, mortalityClass, tableFile=mortalityFile):
+        """Loads the tables for both sexes of one mortality class and
+        registers them."""
+        if mortalityClass not in cls.sheets:
+            raise ValueError("Unknown mortality class: %s" % mortalityClass)
+
+        bundle = loadBundle() if str(tableFile) == str(mortalityFile) else None
+        if bundle is not None:
+            tables = {
+                sex: (
+                    bundle["mort_%s_%s" % (mortalityClass, sex)].copy(),
+                    int(bundle["mortMinAge_%s_%s" % (mortalityClass, sex)]),
+                )
+                for sex in cls.rateColumns
+            }
+        else:
+            tables = cls.readSheet(cls.sheets[mortalityClass], tableFile)
+
+        for sex, (rates, minAge) in tables.items():
+            cls._registry[(sex, mortalityClass, str(tableFile), 1.0)] = cls(
+                sex, mortalityClass, rates, minAge, tableFile
+            )
+
+    @classmethod
+    def readSheet(cls, sheet, tableFile=mortalityFile):
+        """Parses one sheet of the workbook.  Returns a (rates, minAge)
+        pair for each sex."""
+        import openpyxl
+
+        m_wb = openpyxl.load_workbook(tableFile, read_only=True)
+        rows = [
+            row
+            for row in m_wb[sheet].values
+            if len(row) > 1 and isinstance(row[1], int)
+        ]
+        m_wb.close()
+
+        ages = [row[1] for row in rows]
+        out = {}
+        for sex, cols in cls.rateColumns.items():
+            rates = np.array(
+                [[np.nan if r in ("", None) else r for r in row[cols]] for row in rows],
+                dtype=float,
+            )
+            out[sex] = (cls.completeRates(rates), ages[0])
+        return out
+
+    @staticmethod
+    def completeRates(rates):
+        """The published tables leave the employee rates blank past 80
+        and the retiree rates blank below 45 or 50.  Fill the gaps so
+        every age has a usable rate: employees past the end of their
+        table use the healthy retiree rate, retirees below the start of
+        theirs use the employee rate."""
+        employee = rates[:, 0].copy()
+        healthy = rates[:, 1].copy()
+        rates[:, 0] = np.where(np.isnan(employee), healthy, employee)
+        for col in range(1, rates.shape[1]):
+            rates[:, col] = np.where(np.isnan(rates[:, col]), employee, rates[:, col])
+        return np.nan_to_num(rates)
+
+    def rate(self, age, column=0):
+        """The mortality rate at the given age.  Ages outside the table
+        are clamped to its ends."""
+        return self.rates[min(max(age, self.minAge), self.maxAge) - self.minAge, column]
+
+    def __getitem__(self, age):
+        return self.rates[min(max(age, self.minAge), self.maxAge) - self.minAge]
+
+    ## The tables are immutable, so copies of a member can share them
+    ## and pickles only need the registry key.
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (
+            pensMort.get,
+            (self.sex, self.mortalityClass, self.tableFile, self.fudge),
+        )
+
+
+_ageServiceTables = {}
+
+
+def readAgeServiceTable(tableFile=ageServiceFile):
+    """Parses the age-service workbook.  Returns the fractions of the
+    active headcount (a row per age band, a column per service band),
+    the age bands as (low, high) rows, and the headcount."""
+    import openpyxl
+    import pandas as pd
+
+    m_wb = openpyxl.load_workbook(tableFile, data_only=True)
+    asd = m_wb["Cal-T"]
+    m_wb.close()
+    df_asd = pd.DataFrame(asd.values)
+    df_asd = df_asd.rename(columns=df_asd.iloc[0])
+    df_asd = df_asd.set_index("age")
+    total = df_asd["total"]["total"]
+    df_asd = df_asd.drop(index=["age", "total"], columns=["total"])
+    ageBands = np.array([[int(a) for a in index.split(",")] for index in df_asd.index])
+    return df_asd.to_numpy(dtype=float) / total, ageBands, float(total)
+
+
+def getAgeServiceTable(tableFile=ageServiceFile):
+    """Returns the age-service distribution as (fractions, ageBands,
+    total); see readAgeServiceTable.  Loaded once per process, from the
+    bundle when it can be.  The arrays are read-only."""
+    key = str(tableFile)
+    if key not in _ageServiceTables:
+        bundle = loadBundle() if key == str(ageServiceFile) else None
+        if bundle is not None:
+            table = (
+                bundle["ageServiceFractions"].copy(),
+                bundle["ageServiceBands"].copy(),
+                float(bundle["ageServiceTotal"]),
+            )
+        else:
+            table = readAgeServiceTable(tableFile)
+        table[0].setflags(write=False)
+        table[1].setflags(write=False)
+        _ageServiceTables[key] = table
+    return _ageServiceTables[key]
+
+
+##### TESTING #####
+
+def testBundle():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = compileTables(Path(tmp) / "tables.npz")
+        bundle = loadBundle(path)
+        ## The bundle holds the same tables the workbooks parse to.
+        for mortalityClass, sheet in pensMort.sheets.items():
+            for sex, (rates, minAge) in pensMort.readSheet(sheet, mortalityFile).items():
+                assert np.array_equal(bundle["mort_%s_%s" % (mortalityClass, sex)], rates)
+                assert int(bundle["mortMinAge_%s_%s" % (mortalityClass, sex)]) == minAge
+        assert np.array_equal(bundle["ageServiceFractions"], readAgeServiceTable(ageServiceFile)[0])
+
+        ## A bundle compiled from other workbooks is ignored, and doesn't
+        ## stop the good one loading.
+        stale = Path(tmp) / "stale.npz"
+        np.savez(stale, **dict(bundle, mortalitySource=np.array("0" * 40)))
+        assert loadBundle(stale) is None
+        assert loadBundle(path) is bundle
+
+
+if __name__ == "__main__":
+    testBundle()
+    print("Wrote %s" % compileTables())
@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+from collections import OrderedDict
+import numpy as np
+from pensTables import pensMort
+from pensAssumptions import pensAssumptions
+
+
+class pensDecrements:
+    """The chances of separating, retiring and dying for one mortality
+    table and one tier of a pensAssumptions, laid out for the expected
+    value calculations: rates by age index (age - minAge, running one
+    past maxAge, where everyone dies) and service (to one past
+    maxService).  Shared like pensMort: use pensDecrements.get()."""
+
+    _registry = {}
+
+    def __init__(self, mort, assumptions=None, tier="1"):
+        self.mort = mort
+        self.assumptions = pensAssumptions.get(assumptions)
+        self.tier = tier
+        self.minAge = mort.minAge
+        self.maxAge = mort.maxAge
+        self.nAges = self.maxAge - self.minAge + 1
+        ## Service beyond this changes none of the decrement rates.
+        self.maxService = self.assumptions.serviceCap
+
+        ages = np.arange(self.minAge, self.maxAge + 2)
+        services = np.arange(self.maxService + 2)
+        self.qActive = np.array([mort.rate(a, 0) for a in ages])
+        self.qRetired = np.array([mort.rate(a, 1) for a in ages])
+        self.qActive[-1] = self.qRetired[-1] = 1.0
+        t = self.assumptions.tierIndex(tier)
+        self.separate = self.assumptions.separationRate(services, t)
+        self.retire = self.assumptions.retirementRate(ages[:, None], services[None, :], t)
+
+    @classmethod
+    def get(cls, mort, assumptions=None, tier="1"):
+        assumptions = pensAssumptions.get(assumptions)
+        key = (mort, assumptions, tier)
+        if key not in cls._registry:
+            cls._registry[key] = cls(mort, assumptions, tier)
+        return cls._registry[key]
+
+    def ageIndex(self, age):
+        return np.clip(age, self.minAge, self.maxAge) - self.minAge
+
+    def serviceIndex(self, service):
+        return np.clip(service, 0, self.maxService)
+
+    def project(self, active, retired, years, inPayment=True):
+        """Rolls amounts held by active members, by [age index, service],
+        and retirees, by [age index], forward a year at a time with the
+        decrement rates.  Returns what is still held by members in
+        payment status (active or retired) in each of the years, the
+        first being now, or with inPayment False by active members
+        only."""
+        A = np.array(active, dtype=float)
+        R = np.array(retired, dtype=float)
+        out = np.zeros(years)
+        ## Rates at the next age and service, which is where
+        ## pensMember.ageOneYear checks them.
+        s = np.arange(self.maxService + 1)
+        stay = (1 - self.separate[s + 1]) * (1 - self.retire[1:, s + 1]) * (1 - self.qActive[1:, None])
+        leave = (1 - self.separate[s + 1]) * self.retire[1:, s + 1] * (1 - self.qRetired[1:, None])
+        live = 1 - self.qRetired[1:]
+        for k in range(years):
+            out[k] = A.sum() + R.sum() if inPayment else A.sum()
+            if out[k] == 0 and not R.any():
+                break
+            nextA = np.zeros_like(A)
+            nextR = np.zeros_like(R)
+            moved = A[:-1] * stay[:-1]
+            nextA[1:, 1:] = moved[:, :-1]
+            nextA[1:, -1] += moved[:, -1]
+            nextR[1:] = R[:-1] * live[:-1] + (A[:-1] * leave[:-1]).sum(axis=1)
+            A, R = nextA, nextR
+        return out
+
+
+class pensAnnuity:
+    """Expected present value factors for one sex, mortality class,
+    discount rate and COLA.
+
+    pensPop.calculateLiability simulates one life and discounts a
+    pension payment for every year until that member dies (or
+    separates).  This table gives the expected value of the same sum,
+    per dollar of pension, computed from the separation, retirement and
+    mortality probabilities (a pensDecrements) with the usual backward
+    recursion over ages.  A member's liability is then pension * factor.
+    The separation and retirement rates are one tier's of a
+    pensAssumptions.
+
+    Like pensMort, tables are shared: use pensAnnuity.get().  The
+    fudge is passed on to pensMort.get."""
+
+    _registry = {}
+
+    def __init__(self, mort, discountrate, cola, assumptions=None, tier="1"):
+        self.mort = mort
+        self.discountrate = discountrate
+        self.cola = cola
+        dec = pensDecrements.get(mort, assumptions, tier)
+        self.assumptions = dec.assumptions
+        self.tier = tier
+        self.minAge = dec.minAge
+        self.maxAge = dec.maxAge
+        self.maxService = dec.maxService
+
+        r = cola / discountrate
+        qActive, qRetired = dec.qActive, dec.qRetired
+        separate, retire = dec.separate, dec.retire
+
+        nAges = dec.nAges
+        retired = np.ones(nAges + 1)
+        active = np.ones((nAges + 1, self.maxService + 1))
+        for i in range(nAges - 1, -1, -1):
+            retired[i] = 1 + r * (1 - qRetired[i + 1]) * retired[i + 1]
+
+            s = np.arange(self.maxService + 1)
+            nextS = np.minimum(s + 1, self.maxService)
+            rho = retire[i + 1, s + 1]
+            stay = (1 - rho) * (1 - qActive[i + 1]) * active[i + 1, nextS]
+            leave = rho * (1 - qRetired[i + 1]) * retired[i + 1]
+            active[i] = 1 + r * (1 - separate[s + 1]) * (leave + stay)
+
+        ## Fold in the 1/cola of the first payment.
+        self.retired = retired[:nAges] / cola
+        self.active = active[:nAges] / cola
+        self.retired.setflags(write=False)
+        self.active.setflags(write=False)
+
+    @classmethod
+    def get(cls, sex, mortalityClass, discountrate, cola, fudge=1.0, assumptions=None, tier="1"):
+        assumptions = pensAssumptions.get(assumptions)
+        key = (sex, mortalityClass, discountrate, cola, fudge, assumptions, tier)
+        if key not in cls._registry:
+            cls._registry[key] = cls(
+                pensMort.get(sex, mortalityClass, fudge=fudge), discountrate, cola, assumptions, tier
+            )
+        return cls._registry[key]
+
+    def ageIndex(self, age):
+        return np.clip(age, self.minAge, self.maxAge) - self.minAge
+
+    def factor(self, age, service, status):
+        """Expected present value of a unit pension for one member."""
+        ageIdx = min(max(age, self.minAge), self.maxAge) - self.minAge
+        if status == "active":
+            return self.active[ageIdx, min(max(service, 0), self.maxService)]
+        elif status == "retired":
+            return self.retired[ageIdx]
+        return 0.0
+
+    def factors(self, age, service, active, retired):
+        """Vectorized factor(): age and service are arrays, active and
+        retired boolean masks."""
+        ageIdx = self.ageIndex(age)
+        out = np.zeros(len(age))
+        out[active] = self.active[
+            ageIdx[active], np.clip(service[active], 0, self.maxService)
+        ]
+        out[retired] = self.retired[ageIdx[retired]]
+        return out
+
+
+class pensLiabilityCache:
+    """A bounded cache of unit-pension present values keyed on member
+    state.  Members with the same age, sex, status, service, mortality
+    class and tier have the same liability per dollar of pension, so
+    pensPop only needs to work each state out once and scale it by the
+    member's pension.  The least recently used entries are dropped once
+    the cache holds maxSize of them."""
+
+    def __init__(self, maxSize=4096):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def unitValue(self, member, discountrate, cola):
+        """Present value of one dollar of this member's pension."""
+        if member.status != "active" and member.status != "retired":
+            return 0.0
+
+        ## Service past the assumptions' serviceCap doesn't change the value,
+        ## so those states can share an entry.
+        key = (
+            member.age,
+            member.sex,
+            member.status,
+            min(member.service, member.assumptions.serviceCap),
+            member.mortalityClass,
+            member.tier,
+            member.mortTable.fudge,
+            member.assumptions,
+            discountrate,
+            cola,
+        )
+        value = self.entries.get(key)
+        if value is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return value
+
+        self.misses += 1
+        table = pensAnnuity.get(
+            member.sex, member.mortalityClass, discountrate, cola,
+            member.mortTable.fudge, member.assumptions, member.tier,
+        )
+        value = float(table.factor(member.age, member.service, member.status))
+        self.entries[key] = value
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "maxSize": self.maxSize,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class pensLiabilityTracker:
+    """Carries the expected liability of a population from one year to
+    the next without revaluing every member.
+
+    Members are pooled into cells by (sex, mortality class, tier, status,
+    age, service), each holding a headcount and a pension total.  Everyone in
+    a cell has the same annuity factor, so the liability is the sum over
+    cells of pension total times factor.  A year later the survivors of
+    a cell are all in the next cell along, and the actives' pensions
+    have all grown by the same salary scale, so rollForward() moves
+    whole cells rather than members.  Only the members whose status
+    changed, plus new hires and layoffs, are handled one at a time.
+    The salary scale, mortality fudge and assumptions are the
+    population's."""
+
+    def __init__(self, discountrate, cola, salaryScale=1.0, mortalityFudge=1.0, assumptions=None):
+        self.discountrate = discountrate
+        self.cola = cola
+        self.salaryScale = salaryScale
+        self.mortalityFudge = mortalityFudge
+        self.assumptions = pensAssumptions.get(assumptions)
+        self.cells = {}
+        self.updates = 0
+
+    def key(self, member, status=None):
+        status = status or member.status
+        if status == "active":
+            service = min(member.service, self.assumptions.serviceCap)
+        else:
+            service = 0
+        return (member.sex, member.mortalityClass, member.tier, status, member.age, service)
+
+    def add(self, member):
+        if member.status != "active" and member.status != "retired":
+            return
+        cell = self.cells.setdefault(self.key(member), [0, 0.0])
+        cell[0] += 1
+        cell[1] += member.pension
+        self.updates += 1
+
+    def remove(self, member, status=None):
+        """Takes a member out of the cell for the given status (their
+        current one by default)."""
+        key = self.key(member, status)
+        cell = self.cells.get(key)
+        if cell is None:
+            return
+        cell[0] -= 1
+        cell[1] -= member.pension
+        if cell[0] <= 0:
+            del self.cells[key]
+        self.updates += 1
+
+    def rollForward(self):
+        """Ages every cell a year: everyone gets a year older, actives
+        get a year of service and their raise."""
+        cells = {}
+        for (sex, mc, tier, status, age, service), (n, pension) in self.cells.items():
+            if status == "active":
+                service = min(service + 1, self.assumptions.serviceCap)
+                pension *= self.assumptions.salaryDelta(age + 1, self.salaryScale)
+            ## Cells at the service cap merge with the one below them.
+            cell = cells.setdefault((sex, mc, tier, status, age + 1, service), [0, 0.0])
+            cell[0] += n
+            cell[1] += pension
+        self.cells = cells
+
+    def update(self, changes):
+        """Applies the year's status changes, given as (member, old
+        status) pairs for members who have already aged a year."""
+        for member, oldStatus in changes:
+            self.remove(member, oldStatus)
+            self.add(member)
+
+    def total(self):
+        out = 0.0
+        for (sex, mc, tier, status, age, service), (n, pension) in self.cells.items():
+            table = pensAnnuity.get(
+                sex, mc, self.discountrate, self.cola, self.mortalityFudge, self.assumptions, tier
+            )
+            out += pension * table.factor(age, service, status)
+        return float(out)
+
+
+class pensBenefitFlows:
+    """The expected benefit payments of a population by future year, so
+    that its liability at any discount rate and COLA is one discounting
+    pass instead of a revaluation.
+
+    Payments are held in the units pensAnnuity works in: dollars of
+    today's pensions, before COLA.  A member with pension P in payment
+    status (active or retired) k years from now is paid P * cola**(k-1)
+    that year, which discounted at d**k and summed gives pension *
+    factor.  Payments are split by the members' status now ("active"
+    or "retired") and "entrant" for the replacements hired over the
+    next entrantYears to keep the active headcount (times pct), as
+    pensPlan hires them; an entrant's COLA starts from the year they
+    are hired.
+
+    Fill it with addActive, addRetired and addHires, then call project()."""
+
+    groups = ("active", "retired", "entrant")
+
+    def __init__(self):
+        # Per pensDecrements: active pensions and headcounts by [age
+        # index, service], retiree pensions by age index.
+        self.cells = {}
+        # (pensDecrements, share of hires, age range, service range,
+        # pension per head) for each kind of replacement hire.
+        self.hires = []
+        self.units = {}
+        self.entrants = np.zeros(0)
+        self.unitEntrant = np.zeros(0)
+
+    def cell(self, dec):
+        if dec not in self.cells:
+            shape = (dec.nAges, dec.maxService + 1)
+            self.cells[dec] = [np.zeros(shape), np.zeros(shape), np.zeros(dec.nAges)]
+        return self.cells[dec]
+
+    def addActive(self, dec, age, service, pension):
+        """Adds active members (arrays of ages, services and pensions)."""
+        units, heads, retired = self.cell(dec)
+        index = (dec.ageIndex(np.asarray(age)), dec.serviceIndex(np.asarray(service)))
+        np.add.at(units, index, pension)
+        np.add.at(heads, index, 1)
+
+    def addRetired(self, dec, age, pension):
+        np.add.at(self.cell(dec)[2], dec.ageIndex(np.asarray(age)), pension)
+
+    def addHires(self, dec, share, ageRange, serviceRange, pension):
+        """Describes a share of each year's replacement hires: uniform
+        over the (inclusive) age and service ranges, each with this
+        pension."""
+        self.hires.append((dec, share, ageRange, serviceRange, pension))
+
+    def project(self, entrantYears=0, pct=1.0):
+        """Works out the payments, for current members until the last of
+        them dies, and for entrantYears of replacement hires."""
+        decs = list(self.cells) + [h[0] for h in self.hires]
+        self.years = max(dec.nAges for dec in decs) + entrantYears + 1
+        self.units = {"active": np.zeros(self.years), "retired": np.zeros(self.years)}
+        activeHeads = np.zeros(self.years)
+        for dec, (units, heads, retired) in self.cells.items():
+            none = np.zeros(dec.nAges)
+            self.units["active"] += dec.project(units, none, self.years)
+            self.units["retired"] += dec.project(0 * units, retired, self.years)
+            activeHeads += dec.project(heads, none, self.years, inPayment=False)
+
+        ## One hire, and how many of them are still active k years on.
+        self.unitEntrant = np.zeros(self.years)
+        unitHeads = np.zeros(self.years)
+        for dec, share, (ageLow, ageHigh), (serviceLow, serviceHigh), pension in self.hires:
+            heads = np.zeros((dec.nAges, dec.maxService + 1))
+            ages = dec.ageIndex(np.arange(ageLow, ageHigh + 1))
+            services = dec.serviceIndex(np.arange(serviceLow, serviceHigh + 1))
+            np.add.at(heads, (ages[:, None], services[None, :]), share / (len(ages) * len(services)))
+            none = np.zeros(dec.nAges)
+            self.unitEntrant += dec.project(heads * pension, none, self.years)
+            unitHeads += dec.project(heads, none, self.years, inPayment=False)
+
+        ## Hires in year h replace the actives lost that year, current
+        ## members and earlier hires alike.
+        self.entrants = np.zeros(self.years)
+        if self.hires:
+            lost = np.diff(unitHeads, prepend=1.0) * -1
+            for h in range(1, entrantYears + 1):
+                losses = activeHeads[h - 1] - activeHeads[h]
+                losses += np.dot(self.entrants[1:h], lost[h - 1:0:-1])
+                self.entrants[h] = pct * losses
+        return self
+
+    def payments(self, cola=1.0, groups=("active", "retired")):
+        """Expected payments by year from now (the first is this year),
+        at a COLA."""
+        k = np.arange(self.years)
+        grow = float(cola) ** (k - 1.0)
+        out = np.zeros(self.years)
+        for group in groups:
+            if group == "entrant":
+                out += np.convolve(self.entrants, self.unitEntrant * grow)[: self.years]
+            else:
+                out += self.units[group] * grow
+        return out
+
+    def presentValue(self, discountRates, colas=1.02, groups=("active", "retired")):
+        """The liability at each discount rate (as in pensPlan, e.g. 0.07)
+        and each COLA (e.g. 1.02): an array of [rate, cola], or a number
+        if both are."""
+        rates = np.atleast_1d(np.asarray(discountRates, dtype=float))
+        colaList = np.atleast_1d(np.asarray(colas, dtype=float))
+        flows = np.array([self.payments(c, groups) for c in colaList])
+        discount = (1 + rates[:, None]) ** -np.arange(self.years)[None, :]
+        out = discount @ flows.T
+        if np.ndim(discountRates) == 0 and np.ndim(colas) == 0:
+            return float(out[0, 0])
+        return out
+
+
+##################### TESTING FUNCTIONS ######################
+
+
+if __name__ == "__main__":
+    from pensPop import pensPop, pensMember
+
+    def testExpectedLiability():
+        ## The expected value should sit in the middle of a pile of
+        ## simulated ones.
+        x = pensPop([], 0.07)
+        x.valuation = "simulate"
+        for age, service, status in ((35, 5, "active"), (60, 25, "active"),
+                                     (70, 30, "retired")):
+            andy = pensMember(age, "M", service, 50000, 2021, status=status)
+            sims = [x.calculateLiability(andy, 1.07, 1.02) for i in range(2000)]
+            table = pensAnnuity.get("M", "General", 1.07, 1.02)
+            expected = andy.pension * table.factor(age, service, status)
+            print(status, age, service, round(np.mean(sims)), round(expected))
+            assert abs(np.mean(sims) - expected) < 4 * np.std(sims) / np.sqrt(len(sims))
+
+    def testLiabilityCache():
+        ## A small cache evicts but never changes the answer.
+        x = pensPop([], 0.07)
+        x.liabilityCache = pensLiabilityCache(maxSize=50)
+        for i in range(5):
+            cached = x.calculateTotalLiability()
+            cache, x.liabilityCache = x.liabilityCache, None
+            uncached = x.calculateTotalLiability()
+            x.liabilityCache = cache
+            assert abs(cached - uncached) < 1e-6 * uncached
+            x.advanceOneYear()
+        report = x.liabilityCache.report()
+        print(report)
+        assert report["size"] <= 50 and report["hits"] > 0
+
+    def testUncachedLiability():
+        ## With the cache off, members are still valued under their own
+        ## assumption set.
+        import copy
+        spec = copy.deepcopy(pensAssumptions.get().spec)
+        spec["tiers"]["1"]["separation"]["rates"] = [0.3]
+        high = pensAssumptions(spec)
+        x = pensPop([], 0.07, sampleSize=500, assumptions=high, rng=np.random.default_rng(1))
+        cached = x.calculateTotalLiability()
+        x.liabilityCache = None
+        uncached = x.calculateTotalLiability()
+        print("Cached %.2f, uncached %.2f" % (cached, uncached))
+        assert abs(cached - uncached) < 1e-6 * cached
+
+    def testLiabilityTracker():
+        ## The rolled-forward total should match a full revaluation.
+        x = pensPop([], 0.07, valuation="incremental")
+        for i in range(20):
+            tracked = x.calculateTotalLiability()
+            full = sum(
+                [x.calculateExpectedLiability(m, x.discount, 1.02) for m in x.members]
+            )
+            print(i, round(tracked, 2), round(full, 2), len(x.tracker.cells))
+            assert abs(tracked - full) < 1e-6 * full
+            x.hireReplacements(x.advanceOneYear()["replace"])
+
+    def testBenefitFlows():
+        ## One set of flows should reproduce the expected liability, and
+        ## then give it at other rates for next to nothing.
+        import time
+        x = pensPop([], 0.07, sampleSize=2000)
+        for i in range(5):
+            x.hireReplacements(x.advanceOneYear()["replace"])
+        flows = x.benefitFlows(entrantYears=20)
+        total, pv = x.calculateTotalLiability(), flows.presentValue(0.07, 1.02)
+        print(round(total, 2), round(pv, 2))
+        assert abs(total - pv) < 1e-6 * total
+        t = time.time()
+        rates = np.arange(0.04, 0.09, 0.005)
+        values = flows.presentValue(rates, [1.0, 1.02, 1.03])
+        print("%d values in %.5fs" % (values.size, time.time() - t))
+        print(np.round(values[:, 1] / 1e6))
+        assert values.shape == (len(rates), 3)
+        assert abs(values[np.argmin(abs(rates - 0.07)), 1] - pv) < 1e-6 * pv
+        ## Worth less at higher rates, more with a bigger COLA.
+        assert np.all(np.diff(values, axis=0) < 0) and np.all(np.diff(values, axis=1) > 0)
+        entrants = flows.presentValue(0.07, 1.02, ("entrant",))
+        print("Entrants at 7%%: %.0f" % entrants)
+        assert entrants > 0
+
+    testExpectedLiability()
+    testLiabilityCache()
+    testUncachedLiability()
+    testLiabilityTracker()
+    testBenefitFlows()
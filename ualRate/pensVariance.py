@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pensPlan import pensPlan, initWorker
+from pensFund import targetMix
+
+## The pensPlan attribute holding each metric a comparison can study.
+planMetrics = {
+    "UAL": "ual",
+    "UAL Growth(%)": "growthRate",
+    "Contribution Rate": "cr",
+    "Assets": "assets",
+    "Liability": "liability",
+}
+
+
+def runStatistic(kwargs, years, metric, statistic, seedSeq, antithetic):
+    """A run's statistic of the metric ("mean" over the years, or
+    "final"), and the plan it came from."""
+    p = pensPlan(2000, seed=seedSeq, antithetic=antithetic, **kwargs)
+    values = []
+    for year in range(years):
+        p.advanceOneYear()
+        values.append(getattr(p, planMetrics[metric]))
+    y = values[-1] if statistic == "final" else np.mean(values)
+    return float(y), p
+
+
+def runArm(task):
+    """One run for a pensComparison.  The task is (pensPlan arguments,
+    years, metric, statistic, SeedSequence, antithetic, control).
+    Returns the run's statistic and its control: with control "cohort",
+    the same statistic from the cohort engine on the same seed (so the
+    same fund returns), otherwise the average yearly return on the
+    fund's target mix."""
+    kwargs, years, metric, statistic, seedSeq, antithetic, control = task
+    y, p = runStatistic(kwargs, years, metric, statistic, seedSeq, antithetic)
+    if control == "cohort":
+        x, _ = runStatistic(dict(kwargs, engine="cohort"), years, metric, statistic, seedSeq, antithetic)
+    else:
+        x = np.mean(np.asarray(p.fund.returns) @ np.asarray(p.fund.pcts))
+    return float(y), float(x)
+
+
+def runCohort(task):
+    """One cohort engine run, for estimating the cohort control's mean."""
+    kwargs, years, metric, statistic, seedSeq, antithetic = task
+    return runStatistic(dict(kwargs, engine="cohort"), years, metric, statistic, seedSeq, antithetic)[0]
+
+
+class pensComparison(object):
+    """Estimates a metric under one setting of pensPlan, or the
+    difference between two settings, with fewer runs than independent
+    replications would need.
+
+    settingA and settingB are dicts of pensPlan arguments (volatility
+    and anything else not given default as usual).  Three things cut the
+    variance, each optional:
+
+    crn         Replication r of both settings uses the same seed, so
+                they see the same census, the same decrement draws each
+                year and the same investment returns.
+    antithetic  Every replication is a pair of runs on the same seed,
+                the second with mirrored fund returns.
+    control     A control variate, whose part of the metric is
+                regressed out.  "cohort" (the default) is the same
+                statistic from the cohort engine, the deterministic
+                expected projection of the population, run on the same
+                seed so it sees the same fund returns.  Its mean is
+                estimated from controlRuns more cohort runs, which take
+                milliseconds each, and the error in that estimate is
+                counted in the standard error.  "return" is the average
+                return on the target asset mix, whose mean is known
+                exactly from the means in volatility; antithetic pairs
+                already cancel it, so it only helps without them.
+                False turns the control off.
+
+    run() reports the estimate with its standard error and a variance
+    reduction factor: how many times more runs plain independent
+    replications would need for the same confidence interval.  The
+    plain variance is estimated from the first run of each replication,
+    which is an ordinary run."""
+
+    def __init__(self, settingA, settingB=None, replications=100, years=40, metric="UAL Growth(%)",
+                 statistic="mean", crn=True, antithetic=True, control="cohort", controlRuns=None, workers=1,
+                 seed=None):
+        if metric not in planMetrics:
+            raise ValueError("Unknown metric: %s" % metric)
+        self.settings = [settingA] if settingB is None else [settingA, settingB]
+        self.replications = replications
+        self.years = years
+        self.metric = metric
+        self.statistic = statistic
+        self.crn = crn
+        self.antithetic = antithetic
+        if control is True:
+            control = "cohort"
+        if control not in (False, None, "cohort", "return"):
+            raise ValueError("Unknown control: %s" % control)
+        self.control = control
+        # Cohort runs per setting for the cohort control's mean.
+        self.controlRuns = controlRuns if controlRuns is not None else 10 * replications
+        self.workers = workers
+        self.seed = seed
+
+    def expectedReturn(self, setting):
+        """The known mean of the control: the target mix's expected return."""
+        vol = np.asarray(setting["volatility"], dtype=float)
+        return float(np.dot(vol[0::2], targetMix))
+
+    def run(self):
+        rootSeed = np.random.SeedSequence(self.seed)
+        common = rootSeed.spawn(self.replications)
+        pairs = (False, True) if self.antithetic else (False,)
+
+        tasks = []
+        for i, setting in enumerate(self.settings):
+            seeds = common if self.crn or i == 0 else rootSeed.spawn(self.replications)
+            for s in seeds:
+                tasks += [(setting, self.years, self.metric, self.statistic, s, a, self.control) for a in pairs]
+
+        ## The cohort control's mean, per setting, from independent seeds.
+        cohortTasks = []
+        if self.control == "cohort":
+            controlSeeds = rootSeed.spawn(self.controlRuns)
+            for setting in self.settings:
+                cohortTasks += [(setting, self.years, self.metric, self.statistic, s, a)
+                                for s in controlSeeds for a in pairs]
+
+        if self.workers > 1:
+            discountRate = self.settings[0].get("discountRate", 0.07)
+            cola = self.settings[0].get("cola", 1.02)
+            with ProcessPoolExecutor(self.workers, initializer=initWorker, initargs=(discountRate, cola)) as pool:
+                results = list(pool.map(runArm, tasks, chunksize=max(1, len(tasks) // (4 * self.workers))))
+                cohortResults = list(pool.map(runCohort, cohortTasks,
+                                              chunksize=max(1, len(cohortTasks) // (4 * self.workers))))
+        else:
+            results = list(map(runArm, tasks))
+            cohortResults = list(map(runCohort, cohortTasks))
+
+        # (settings x replications x runs per replication)
+        out = np.array(results).reshape(len(self.settings), self.replications, len(pairs), 2)
+        y, x = out[..., 0], out[..., 1]
+
+        units = y.mean(axis=2)
+        estimate = units[0] - units[1] if len(self.settings) == 2 else units[0]
+
+        beta = None
+        meanVariance = 0.0
+        if self.control == "cohort":
+            ## Each setting's cohort statistic is a control, centred on
+            ## the mean of the independent cohort runs.
+            cohort = np.array(cohortResults).reshape(len(self.settings), self.controlRuns, len(pairs)).mean(axis=2)
+            C = np.column_stack([x[i].mean(axis=1) - cohort[i].mean() for i in range(len(self.settings))])
+            meanCov = np.atleast_2d(np.cov(cohort)) / self.controlRuns
+        elif self.control == "return":
+            C = np.column_stack([x[i].mean(axis=1) - self.expectedReturn(setting)
+                                 for i, setting in enumerate(self.settings) if i == 0 or not self.crn])
+            meanCov = None
+        if self.control and np.all(C.std(axis=0) > 1e-12):
+            Cc = C - C.mean(axis=0)
+            beta = np.linalg.lstsq(Cc, estimate - estimate.mean(), rcond=None)[0]
+            estimate = estimate - C @ beta
+            if meanCov is not None:
+                meanVariance = float(beta @ meanCov @ beta)
+
+        runs = len(tasks)
+        arms = len(self.settings)
+        ## The error in an estimated control mean doesn't shrink with
+        ## the replications; count it as replications' worth of variance.
+        variance = estimate.var(ddof=1) + meanVariance * self.replications
+        plainVariance = sum(y[i, :, 0].var(ddof=1) for i in range(arms)) * arms
+        reduction = plainVariance / (variance * arms * len(pairs)) if variance > 0 else np.inf
+        se = np.sqrt(variance / self.replications)
+        mean = float(estimate.mean())
+        return {
+            "estimate": mean,
+            "se": float(se),
+            "ci95": (mean - 1.96 * se, mean + 1.96 * se),
+            "runs": runs,
+            "controlRuns": len(cohortTasks),
+            "beta": None if beta is None else beta.tolist(),
+            "varianceReduction": float(reduction),
+            "plainRuns": int(np.ceil(runs * reduction)) if np.isfinite(reduction) else None,
+        }
+
+
+##### TESTING #####
+
+def testStreams():
+    ## Common random numbers: plans from the same seed that differ only
+    ## in the discount rate see the same returns and the same members.
+    vol = [0.04, 0.03, 0.02, 0.03, 0.04, 0.04]
+    histories = []
+    for discountRate in (0.07, 0.065):
+        p = pensPlan(2000, vol, discountRate=discountRate, engine="array", sampleSize=2000,
+                     seed=np.random.SeedSequence(4))
+        history = []
+        for year in range(10):
+            p.advanceOneYear()
+            history.append((p.population.countStatus("active"), p.population.countStatus("retired")))
+        histories.append((history, p.fund.returns))
+    assert histories[0] == histories[1]
+
+    ## An antithetic pair's returns sit either side of the means.
+    pair = []
+    for antithetic in (False, True):
+        p = pensPlan(2000, vol, engine="array", sampleSize=2000, seed=np.random.SeedSequence(4),
+                     antithetic=antithetic)
+        for year in range(10):
+            p.advanceOneYear()
+        pair.append(np.asarray(p.fund.returns))
+    assert np.allclose(pair[0] + pair[1], 2 * np.asarray(vol[0::2]))
+
+
+def testComparison():
+    vol = [0.04, 0.03, 0.02, 0.03, 0.04, 0.04]
+    a = dict(volatility=vol, discountRate=0.07, engine="array")
+    b = dict(volatility=vol, discountRate=0.065, engine="array")
+    se = {}
+    for crn, antithetic, control in ((False, False, False), (True, False, False), (True, False, "return"),
+                                     (True, False, "cohort"), (True, True, False)):
+        r = pensComparison(a, b, replications=40, years=20, metric="Assets", statistic="final", crn=crn,
+                           antithetic=antithetic, control=control, seed=2).run()
+        print("crn=%s antithetic=%s control=%s: %.3f +/- %.3f, reduction %.1fx (%d runs ~ %s plain)"
+              % (crn, antithetic, control, r["estimate"], r["se"], r["varianceReduction"], r["runs"],
+                 r["plainRuns"]))
+        se[crn, antithetic, control] = r["se"]
+    ## Common random numbers, then either control, then antithetic pairs
+    ## should each tighten the difference.
+    assert se[True, False, False] < se[False, False, False]
+    assert se[True, False, "return"] < se[True, False, False]
+    assert se[True, False, "cohort"] < se[True, False, False]
+    assert se[True, True, False] < se[True, False, False]
+
+    r = pensComparison(a, replications=40, years=20, metric="Assets", statistic="final", antithetic=False,
+                       control="cohort", seed=2).run()
+    print("One setting with a control: %.3f +/- %.3f, reduction %.1fx" % (r["estimate"], r["se"],
+                                                                          r["varianceReduction"]))
+    assert r["beta"] is not None and r["varianceReduction"] > 1
+    assert r["controlRuns"] == 400
+
+
+if __name__ == "__main__":
+    testStreams()
+    testComparison()